@@ -1,20 +1,20 @@
 from view.panes import Module
 import tkinter as tk
-from tkinter import Canvas, ttk, simpledialog, messagebox
+from tkinter import Canvas, ttk, simpledialog, messagebox, filedialog
 from view.colors import text_color, bg_color, edit_color, vis_bg_color
 from util.custom_tks import TextAware
 from util.util_tree import tree_subset, limited_branching_tree, limited_distance_tree, flatten_tree, collapsed_wavefunction
 from util.react import react_changes, unchanged
 from util.canvas_util import move_object
 from util.gpt_util import logprobs_to_probs
+from util.prompt_templates import render, TemplateError
 from view.icons import Icons
 from view.styles import textbox_config, code_textbox_config
 from components.templates import *
 from view.tree_vis import round_rectangle
 from pprint import pformat, pprint
-from gpt import completions_text, gen
+from gpt import completions_text, gen_async
 import uuid
-import threading
 from tkinter.colorchooser import askcolor
 from PIL import Image, ImageTk
 import os
@@ -743,14 +743,16 @@ class JanusPlayground(Module):
         if mode == 'completions':
             # disable generate button
             self.generate_button.configure(state='disabled')
-            threading.Thread(target=self.call_model, args=(prompt, settings, config)).start()
+            self.call_model(prompt, settings, config)
         elif mode == 'eval':
             # disable eval button
             self.eval_prompt_button.configure(state='disabled')
-            threading.Thread(target=self.call_model_prompt, args=(prompt, settings, config)).start()
+            self.call_model_prompt(prompt, settings, config)
 
     def call_model(self, prompt, settings, model_config):
-        response, error = gen(prompt, settings, model_config)
+        return gen_async(prompt, settings, model_config, callback=self.receive_completions)
+
+    def receive_completions(self, response, error):
         self.generate_button.configure(state='normal')
         self.textbox.model_response = response
         self.textbox.process_logprobs()
@@ -759,8 +761,8 @@ class JanusPlayground(Module):
             self.completion_windows.open_window(completion)
 
     def call_model_prompt(self, prompt, settings, model_config):
-        self.textbox.call_model_prompt(prompt, settings, model_config)
-        self.eval_prompt_button.configure(state='normal')
+        return self.textbox.call_model_prompt(prompt, settings, model_config,
+                                              callback=lambda: self.eval_prompt_button.configure(state='normal'))
 
     def call_model_inline(self, prompt, settings, selected_range):
         self.textbox.call_model_inline(prompt, settings, selected_range)
@@ -1181,6 +1183,69 @@ class DebugConsole(Module):
         self.debug_box.configure(state="disabled")
 
 
+class GenerationMetrics(Module):
+    def __init__(self, callbacks, state):
+        Module.__init__(self, "generation metrics", callbacks, state)
+        self.metrics_box = None
+        self.button_frame = None
+
+    def build(self, parent):
+        Module.build(self, parent)
+        self.metrics_box = TextAware(self.frame, bd=3, height=3)
+        self.metrics_box.pack(expand=True, fill='both')
+        self.metrics_box.configure(foreground='white', background='black', wrap="none")
+        self.metrics_box.configure(state="disabled")
+        self.button_frame = ttk.Frame(self.frame)
+        self.button_frame.pack(side='bottom', fill='x')
+        ttk.Button(self.button_frame, text='Refresh', command=self.refresh).pack(side='left', padx=5, expand=True)
+        ttk.Button(self.button_frame, text='Export', command=self.export).pack(side='left', padx=5, expand=True)
+        ttk.Button(self.button_frame, text='Clear', command=self.clear).pack(side='left', padx=5, expand=True)
+        self.refresh()
+
+    def refresh(self):
+        self.metrics_box.configure(state="normal")
+        self.metrics_box.delete("1.0", "end")
+        self.metrics_box.insert("1.0", format_generation_metrics(self.state.generation_metrics()))
+        self.metrics_box.configure(state="disabled")
+
+    def export(self):
+        filename = filedialog.asksaveasfilename(title="Export generation metrics", defaultextension=".csv",
+                                                filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if filename:
+            self.state.export_generation_metrics(filename)
+
+    def clear(self):
+        self.state.clear_generation_metrics()
+        self.refresh()
+
+    def tree_updated(self):
+        self.refresh()
+
+
+# lines of per model generation metrics (see TreeModel.generation_metrics)
+def format_generation_metrics(summary):
+    if not summary:
+        return "No generations yet"
+
+    def seconds(histogram, field):
+        return f"{histogram[field]:.2f}s" if histogram[field] is not None else "-"
+
+    lines = []
+    for model, metrics in summary.items():
+        lines.append(f"{model}: {metrics['requests']} requests, {metrics['errors']} errors, "
+                     f"{metrics['retries']} retries")
+        for field in ('queue_wait', 'ttfb', 'latency'):
+            histogram = metrics['histograms'][field]
+            lines.append(f"  {field}: p50 {seconds(histogram, 'p50')}, p90 {seconds(histogram, 'p90')}, "
+                         f"max {seconds(histogram, 'max')}")
+        lines.append(f"  tokens: {metrics['prompt_tokens']} prompt, {metrics['completion_tokens']} completion")
+        if metrics['throughput'] is not None:
+            lines.append(f"  throughput: {metrics['throughput']:.1f} tokens/s")
+        if metrics['cost'] is not None:
+            lines.append(f"  cost: {metrics['cost']:.4f}")
+    return '\n'.join(lines)
+
+
 class Input(Module):
     def __init__(self, callbacks, state):
         Module.__init__(self, "input", callbacks, state)
@@ -1209,7 +1274,7 @@ class Input(Module):
 
     def apply_template(self, input):
         if 'submit_template' in self.settings():
-            return eval(f'f"""{self.settings()["submit_template"]}"""')
+            return render(self.settings()["submit_template"], input=input, self=self)
         else:
             return input
 
@@ -1629,8 +1694,8 @@ class Transformers(Module):
         # TODO database
         inputs = self.inputs 
         try:
-            self.prompt = eval(f'f"""{self.template["template"]}"""')
-        except KeyError as e:
+            self.prompt = render(self.template["template"], inputs=inputs, self=self)
+        except (KeyError, TemplateError) as e:
             print(f'missing input: {e}')
             return
         self.prompt_literal_textbox.configure(state='normal')
@@ -1674,10 +1739,12 @@ class Transformers(Module):
         self.write_all()
         prompt = self.prompt
         n = self.generation_settings["num_continuations"]
-        threading.Thread(target=self.call_model, args=(prompt, n)).start()
+        self.call_model(prompt, n)
 
     def call_model(self, prompt, n):
-        response, error = gen(prompt, self.generation_settings, self.state.model_config)
+        return gen_async(prompt, self.generation_settings, self.state.model_config, callback=self.receive_completions)
+
+    def receive_completions(self, response, error):
         response_text_list = completions_text(response)
         self.completions_frame.show()
         for completion in response_text_list:
@@ -6,7 +6,7 @@ from view.colors import text_color, bg_color, edit_color, default_color, history
 from util.custom_tks import TextAware, ScrollableFrame
 from util.react import *
 from util.util_tk import create_side_label, create_label, Entry, create_button, create_slider, create_combo_box, create_checkbutton
-from util.gpt_util import logprobs_to_probs
+from util.gpt_util import dict_logprobs_to_probs
 from util.util import split_indices
 from util.util_tree import num_descendents
 from tkinter.scrolledtext import ScrolledText
@@ -16,10 +16,10 @@ import time
 import os
 import codecs
 from PIL import Image, ImageTk
-from gpt import gen, completions_text
+from gpt import gen_async, completions_text
+from util.scheduler import INLINE
 import json
 import bisect
-import threading
 import datetime
 import time
 import pyperclip
@@ -824,10 +824,14 @@ class LoomTerminal(TextAware):
             text = self.get("1.0", "insert")
             prompt = text[-prompt_length:]
             selected_range = [len(text), len(text)]
-        threading.Thread(target=self.call_model_inline, args=(prompt, generation_settings, selected_range, config)).start()
+        self.call_model_inline(prompt, generation_settings, selected_range, config)
 
     def call_model_inline(self, prompt, settings, selected_range, model_config):
-        response, error = gen(prompt, settings, model_config)
+        # re-running the completion while it's in flight shares the request
+        return gen_async(prompt, settings, model_config, priority=INLINE, coalesce=True,
+                         callback=lambda response, error: self.receive_inline_completions(response, selected_range))
+
+    def receive_inline_completions(self, response, selected_range):
         response_text_list = completions_text(response)
         print(response_text_list)
         self.alternatives = []
@@ -843,14 +847,19 @@ class LoomTerminal(TextAware):
         self.tag_remove("alternate", "1.0", tk.END)
         self.insert_inline_completion()
 
-    def call_model_prompt(self, prompt, settings, model_config):
+    # callback() is called once the prompt's logprobs are processed
+    def call_model_prompt(self, prompt, settings, model_config, callback=None):
         eval_settings = settings.copy()
         eval_settings.update({'max_tokens': 1, 'num_continuations': 1, 'logprobs': 15})
-        response, error = gen(prompt, eval_settings, model_config)
-        # enable eval button
-        #self.eval_prompt_button.configure(state='normal')
-        self.model_response = response
-        self.process_logprobs()
+
+        def receive(response, error):
+            # enable eval button
+            #self.eval_prompt_button.configure(state='normal')
+            self.model_response = response
+            self.process_logprobs()
+            if callback:
+                callback()
+        return gen_async(prompt, eval_settings, model_config, callback=receive, coalesce=True)
 
     def insert_inline_completion(self, step=1):
         if self.inline_completions:
@@ -880,8 +889,9 @@ class LoomTerminal(TextAware):
                         alt_dict = {'alts': [],
                                     'replace_range': [token_data['position']['start'] + diff, token_data['position']['end'] + diff],}
                         #sorted_counterfactuals = {k: v for k, v in sorted(token_data['counterfactuals'].items(), key=lambda item: item[1], reverse=True)}
+                        probs = dict_logprobs_to_probs(token_data['counterfactuals'])
                         for token, prob in token_data['counterfactuals'].items():
-                            alt_dict['alts'].append({'text': token, 'logprob': prob, 'prob': logprobs_to_probs(prob)})
+                            alt_dict['alts'].append({'text': token, 'logprob': prob, 'prob': probs[token]})
                         self.alternatives.append(alt_dict)
 
 #################################
@@ -1093,6 +1103,9 @@ class Preferences(FrameSettings):
             "model_response": tk.StringVar,
             
             "prob": tk.BooleanVar,
+            "cancel_abandoned_generations": tk.BooleanVar,
+            "prefetch": tk.BooleanVar,
+            "prefetch_tokens": tk.IntVar,
         }
         #self.write_to_frame_button = None
         self.init_vars()
@@ -1148,6 +1161,15 @@ class Preferences(FrameSettings):
         create_checkbutton(self.frame, "Show logprobs as probs", "prob", self.vars)
         self.build_pin_button("prob")
 
+        create_checkbutton(self.frame, "Cancel queued generations left behind", "cancel_abandoned_generations", self.vars)
+        self.build_pin_button("cancel_abandoned_generations")
+
+        create_checkbutton(self.frame, "Prefetch continuations", "prefetch", self.vars)
+        self.build_pin_button("prefetch")
+
+        create_slider(self.frame, "Prefetch token budget", self.vars["prefetch_tokens"], (0, 20000), resolution=100)
+        self.build_pin_button("prefetch_tokens")
+
         self.build_write_to_frame_button()
         # self.write_to_frame_button = tk.Button(self.frame, text="Write to frame", command=self.write_to_frame)
         # self.write_to_frame_button.grid(row=self.frame.grid_size()[1], column=1, pady=3)
@@ -1180,6 +1202,7 @@ def full_generation_settings_init(self):
             'template': tk.StringVar,
             #'post_template': tk.StringVar,
             'preset': tk.StringVar,
+            'echo': tk.BooleanVar,
         }
     for key in additional_vars.keys():
         self.vars[key] = additional_vars[key](value=self.orig_params[key])
@@ -1279,6 +1302,10 @@ def generation_settings_templates_body(self, build_pins=False):
     if build_pins:
         self.build_pin_button('preset')
 
+    create_checkbutton(self.frame, "Score prompt", "echo", self.vars)
+    if build_pins:
+        self.build_pin_button('echo')
+
     row = self.frame.grid_size()[1]
     create_button(self.frame, "Load template", self.load_template, column=0, width=12)
     create_button(self.frame, "Save preset", self.save_preset, column=0)
@@ -25,14 +25,16 @@ from components.dialogs import *
 from model import TreeModel
 from util.util import clip_num, metadata, diff, split_indices, diff_linesToWords
 from util.util_tree import ancestry_in_range, depth, height, flatten_tree, stochastic_transition, node_ancestry, subtree_list, \
-    node_index, nearest_common_ancestor, filtered_children
-from util.gpt_util import logprobs_to_probs, parse_logit_bias
+    node_index, nearest_common_ancestor, filtered_children, walk_subtree
+from util.gpt_util import parse_logit_bias
+from util.logprobs import table_probs
 from util.textbox_util import distribute_textbox_changes
+from util.prompt_templates import render, json_file
+from util.token_columns import token_starts
 from util.keybindings import tkinter_keybindings
 from view.icons import Icons
 from difflib import SequenceMatcher
 from diff_match_patch import diff_match_patch
-import json
 from view.colors import edit_color, bg_color
 
 
@@ -95,8 +97,9 @@ class Controller:
         self.state.register_callback(self.state.tree_updated, self.setup_custom_key_bindings)
         self.state.register_callback(self.state.tree_updated, self.modules_tree_updated)
         # TODO autosaving takes too long for a big tree
-        self.state.register_callback(self.state.tree_updated, lambda **kwargs: self.save_tree(popup=False,
-                                                                                              autosave=True))
+        # streamed text is saved once the generation finishes
+        self.state.register_callback(self.state.tree_updated, lambda **kwargs: None if kwargs.get('stream') else
+                                     self.save_tree(popup=False, autosave=True))
 
         # Before the selection is updated, save edits
         self.state.register_callback(self.state.pre_selection_updated, self.save_edits)
@@ -675,6 +678,22 @@ class Controller:
             print(str(e))
         self.state.generate_continuations(node=node, **kwargs)
 
+    # expands the subtree under node max_depth levels deep with the current generation settings
+    @metadata(name="Generate tree")
+    def generate_tree(self, node=None, max_depth=2, **kwargs):
+        node = node if node else self.state.selected_node
+        settings = self.state.generation_settings
+        return self.state.generate_tree(node=node, max_depth=max_depth,
+                                        branching_factor=settings['num_continuations'],
+                                        interval=settings['response_length'],
+                                        temperature=settings['temperature'], **kwargs)
+
+    # generates children for every leaf under node, batching the requests
+    @metadata(name="Expand leaves")
+    def expand_leaves(self, node=None):
+        node = node if node else self.state.selected_node
+        leaves = [leaf for leaf, _ in walk_subtree(node) if not leaf['children']]
+        return self.state.generate_batch(leaves)
 
     @metadata(name="Retry")
     def retry(self, node=None):
@@ -792,6 +811,14 @@ class Controller:
             _, selected_ancestor = self.index_to_ancestor(index)
             self.nav_select(node_id=selected_ancestor["id"])
 
+    # restores a revision from the node's revision history (default: the text before the last edit)
+    @metadata(name="Restore revision", keys=[], display_key="")
+    def restore_revision(self, index=-1, node=None):
+        node = node if node else self.state.selected_node
+        if not node.get('history'):
+            return
+        self.state.restore_revision(node, index)
+
     @metadata(name="Split node", keys=[], display_key="")
     def split_node(self, index, change_selection=True, node=None):
         node = node if node else self.state.selected_node
@@ -913,11 +940,10 @@ class Controller:
 
 
     def generate_template(self, inputs, template_file):
-        # open template file json
-        with open(template_file, 'r') as f:
-            template_dict = json.load(f)
-        template = template_dict['template']
-        prompt = eval(f'f"""{template}"""')
+        # template file json (cached)
+        template_dict = json_file(template_file)
+        prompt = render(template_dict['template'], inputs=inputs)
+        return prompt
         
 
     def refresh_textbox(self, **kwargs):
@@ -1018,6 +1044,7 @@ class Controller:
             changed_ancestry = distribute_textbox_changes(new_text, ancestry)
             for ancestor in changed_ancestry:
                 self.state.tree_node_dict[ancestor['id']]['text'] = ancestor['text']
+                self.state.invalidate_hashes(self.state.tree_node_dict[ancestor['id']])
             self.update_nav_tree(edit=[ancestor['id'] for ancestor in changed_ancestry])
 
     def select_endpoints_range(self, start_endpoint, end_endpoint):
@@ -1262,15 +1289,14 @@ class Controller:
                 self.change_token.meta["counterfactual_index"] = 0
                 self.change_token.meta["prev_token"] = None
                 model_response, prompt, completion = self.state.get_request_info(selected_node)
-                token_offsets = [token_data['position']['start'] for token_data in completion['tokens']]
+                token_offsets = token_starts(completion['tokens'])
                 token_index = bisect.bisect_left(token_offsets, offset) - 1
                 token_data = completion['tokens'][token_index]
                 counterfactuals = token_data['counterfactuals']
                 start = token_data['position']['start']
                 end = token_data['position']['end']
                 if self.state.preferences['prob']:
-                    counterfactuals = {k: logprobs_to_probs(v) for k, v in
-                                       sorted(counterfactuals.items(), key=lambda item: item[1], reverse=True)}
+                    counterfactuals = table_probs(counterfactuals)
 
                 self.print_to_debug(counterfactuals)
                 self.display.textbox.tag_add("selected",
@@ -1292,7 +1318,7 @@ class Controller:
         token_data = completion['tokens'][token_index]
 
         if not self.change_token.meta['temp_token_offsets']:
-            token_offsets = [token_data['position']['start'] for token_data in completion['tokens']]
+            token_offsets = token_starts(completion['tokens'])
             self.change_token.meta['temp_token_offsets'] = token_offsets
         else:
             token_offsets = self.change_token.meta['temp_token_offsets']
@@ -1607,6 +1633,7 @@ class Controller:
         if not 'meta' in node:
             node['meta'] = {}
         node['meta']['source'] = source
+        self.state.invalidate_hashes(node)
         if refresh:
             self.refresh_textbox()
             self.update_nav_tree()
@@ -1672,6 +1699,37 @@ class Controller:
             return
         self.state.open_tree(filename)
 
+    @metadata(name="Open archive")
+    def open_archive(self):
+        options = {
+            'initialdir': os.getcwd() + '/data',
+            'parent': self.root, 'title': "Open a tree read-only",
+            'filetypes': [('tree archives', '.loomarc'), ('json files', '.json')]
+        }
+        filename = filedialog.askopenfilename(**options)
+        if not filename:
+            return
+        self.state.open_archive(filename)
+
+    # lists the branches where a tree file (e.g. a backup) differs from the current tree
+    @metadata(name="Diff with tree file")
+    def diff_tree(self):
+        options = {
+            'initialdir': os.getcwd() + '/data',
+            'parent': self.root, 'title': "Compare with a json tree",
+            'filetypes': [('json files', '.json')]
+        }
+        filename = filedialog.askopenfilename(**options)
+        if not filename:
+            return
+        changes = self.state.diff_tree_files(filename)
+        for change in changes:
+            node = self.state.node(change['id'])
+            print(change['change'], change['id'], repr(node['text'][:50]) if node else '')
+        counts = {kind: sum(1 for change in changes if change['change'] == kind) for kind in ('changed', 'added', 'removed')}
+        messagebox.showinfo(title="Tree diff", message=f"{counts['changed']} changed, {counts['added']} added, "
+                                                       f"{counts['removed']} removed (relative to the current tree)")
+
     # TODO repeated code
     @metadata(name="Import JSON as subtree", keys=["<Control-Shift-KeyPress-O>"], display_key="ctrl+shift+o")
     def import_tree(self):
@@ -1706,6 +1764,10 @@ class Controller:
     def save_tree(self, popup=True, autosave=False, filename=None, subtree=None):
         if autosave and not self.state.preferences['autosave']:
             return
+        if self.state.read_only:
+            if popup:
+                messagebox.showerror(title="Read-only", message="Archived trees are read-only")
+            return
         #try:
         # if not autosave and not self.state.preferences['save_counterfactuals']:
         #     self.state.delete_counterfactuals()
@@ -2036,6 +2098,34 @@ class Controller:
     def toggle_minimap(self, toggle='either'):
         self.toggle_module("side_pane", "minimap")
 
+    # requests in flight and queued per provider, and recent queue wait times
+    @metadata(name="Generation queue", display_key="")
+    def show_generation_queue(self):
+        stats = self.state.generation_queue_stats()
+        lines = [f"{provider}: {info['active']}/{info['limit']} active, pending {info['pending']}"
+                 for provider, info in stats['providers'].items()]
+        lines += [f"{priority} wait: mean {info['mean']:.2f}s, max {info['max']:.2f}s ({info['count']} requests)"
+                  for priority, info in stats['waits'].items()]
+        lines.append(f"cancelled before starting: {stats['cancelled']}")
+        coalescing = stats['coalescing']
+        lines.append(f"coalesced: {coalescing['joined']} of {coalescing['calls']} requests joined one in flight")
+        lines += [f"{key} rate: {info['requests_per_minute']} requests/min, {info['tokens_per_minute']} tokens/min"
+                  for key, info in stats['rate_limits'].items()]
+        self.print_to_debug('\n'.join(lines))
+
+    # per model request counts, latency percentiles, tokens and errors of recent generations
+    @metadata(name="Generation metrics", display_key="")
+    def show_generation_metrics(self):
+        self.open_module("bottom_pane", "generation metrics")
+        self.display.modules['generation metrics'].refresh()
+
+    @metadata(name="Export generation metrics", display_key="")
+    def export_generation_metrics(self):
+        filename = filedialog.asksaveasfilename(title="Export generation metrics", defaultextension=".csv",
+                                                filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if filename:
+            self.state.export_generation_metrics(filename)
+
     def print_to_debug(self, message):
         if message:
             self.open_module("bottom_pane", "debug")
@@ -1,12 +1,22 @@
+import asyncio
+import bisect
 import os
 import time
 import traceback
 from pprint import pprint
 
 from celery import Celery
-import openai
-from util.util import retry, timestamp
+from util.util import timestamp
+from util.gen_engine import get_engine
+from util.rate_limit import limited_request, estimate_tokens
+from util.scheduler import INTERACTIVE
+from util.response_cache import cached, is_deterministic
+from util.single_flight import request_key
+from util.telemetry import queued, start_request, track_request, finish_request
+from util.openai_client import OPENAI_API_BASE, GOOSEAI_API_BASE, provider_client, default_client
+from util.providers import Provider, register_provider, get_provider
 from util.gpt_util import parse_logit_bias, parse_stop
+from util.token_columns import TokenColumns, json_default
 import requests
 import codecs
 import json
@@ -47,80 +57,198 @@ import json
 
 #ai21_api_key = os.environ.get("AI21_API_KEY", None)
 
-client = openai.Client()
+AI21_API_BASE = "https://api.ai21.com/studio/v1"
 
 
+# api base and credentials for a model, from kwargs or the environment
+def provider_settings(model_info, **kwargs):
+    return get_provider(model_info['type']).settings(model_info, **kwargs)
+
+
+def generation_kwargs(settings):
+    return {'length': settings['response_length'],
+            'num_continuations': settings['num_continuations'],
+            'temperature': settings['temperature'],
+            'logprobs': settings['logprobs'],
+            'top_p': settings['top_p'],
+            'echo': settings.get('echo', True),
+            'model': settings['model'],
+            'stop': parse_stop(settings["stop"]) if settings["stop"] else None,
+            'logit_bias': parse_logit_bias(settings["logit_bias"]) if settings["logit_bias"] else None}
+
+
+# Generates on the generation engine's event loop (see util/gen_engine.py)
+# returns a concurrent.futures.Future of (response, error)
+# if given, callback(response, error) is called on the engine's callback thread, unless the request was cancelled
+# priority and cancelled() are passed to the scheduler (see util/scheduler.py)
+# if given, on_text(index, text) is called on the engine's loop with each completion's partial text as it streams
+# a request identical to one in flight joins it if coalesce, by default if the request is deterministic (see
+# util/single_flight.py); it's then only cancelled if every caller is, and keeps the first caller's priority
+def gen_async(prompt, settings, config, callback=None, priority=INTERACTIVE, cancelled=None, on_text=None, **kwargs):
+    def done(future):
+        if not future.cancelled():
+            callback(*future.result())
+    return get_engine().submit(agen(prompt, settings, config, priority=priority, cancelled=cancelled,
+                                    on_text=on_text, **kwargs),
+                               callback=done if callback else None)
+
+
+# blocking
 def gen(prompt, settings, config, **kwargs):
-    if settings["stop"]:
-        stop = parse_stop(settings["stop"])
-    else:
-        stop = None
-    if settings["logit_bias"]:
-        logit_bias = parse_logit_bias(settings["logit_bias"])
-    else:
-        logit_bias = None
-    #if config['OPENAI_API_KEY']:
-    model_info = config['models'][settings['model']]
-    # print('model info:', model_info)
-    client.api_base = model_info['api_base'] if model_info['api_base'] else "https://api.openai.com/v1"
-    ai21_api_key = kwargs.get('AI21_API_KEY', None)
-    ai21_api_key = ai21_api_key if ai21_api_key else os.environ.get("AI21_API_KEY", None)
-    if model_info['type'] == 'gooseai':
-        # openai.api_base = openai.api_base if openai.api_base else "https://api.goose.ai/v1"
-        gooseai_api_key = kwargs.get('GOOSEAI_API_KEY', None)
-        client.api_key = gooseai_api_key if gooseai_api_key else os.environ.get("GOOSEAI_API_KEY", None)
-    elif model_info['type'] in ('openai', 'openai-custom', 'openai-chat'):
-        # openai.api_base =  openai.api_base if openai.api_base else "https://api.openai.com/v1"
-        openai_api_key = kwargs.get('OPENAI_API_KEY', None)
-        client.api_key = openai_api_key if openai_api_key else os.environ.get("OPENAI_API_KEY", None)
-        openai_organization = kwargs.get('OPENAI_ORGANIZATION', None)
-        client.organization = openai_organization if openai_organization else os.environ.get("OPENAI_ORGANIZATION", None)
-
-    # print('openai api base: ' + openai.api_base)
-
-    # print('openai api key: ' + openai.api_key)
-
-    # if config['AI21_API_KEY']:
-        #TODO 
-        # ai21_api_key = config['AI21_API_KEY']
+    return gen_async(prompt, settings, config, **kwargs).result()
+
+
+async def agen(prompt, settings, config, priority=INTERACTIVE, cancelled=None, on_text=None, coalesce=None,
+               **kwargs):
     try:
-        response, error = generate(prompt=prompt,
-                                length=settings['response_length'],
-                                num_continuations=settings['num_continuations'],
-                                temperature=settings['temperature'],
-                                logprobs=settings['logprobs'],
-                                top_p=settings['top_p'],
-                                model=settings['model'],
-                                stop=stop,
-                                logit_bias=logit_bias,
-                                config=config,
-                                ai21_api_key=ai21_api_key,
-                                )
-        return response, error
+        model_info = config['models'][settings['model']]
+        provider = provider_settings(model_info, **kwargs)
     except Exception as e:
         print(e)
         return None, e
-
-
+    engine = get_engine()
+    family = provider_family(provider['type'])
+    if family in config.get('concurrency', {}):
+        engine.scheduler.set_limit(family, config['concurrency'][family])
+    request_kwargs = generation_kwargs(settings)
+    submitted = time.monotonic()
+
+    def run(cancelled, on_text):
+        return engine.scheduler.run(
+            lambda: agenerate(prompt=prompt, config=config, provider=provider, on_text=on_text,
+                              metrics=queued(submitted, priority), **request_kwargs),
+            provider=(family, provider['api_base']), priority=priority, cancelled=cancelled)
+
+    if coalesce is None:
+        coalesce = is_deterministic({'temperature': request_kwargs['temperature'],
+                                     'max_tokens': request_kwargs['length']})
+    if not coalesce:
+        return await run(cancelled, on_text)
+    key = request_key(provider['type'], provider['api_base'], prompt, request_kwargs)
+    return await engine.flights.run(key, run, cancelled, on_text)
+
+
+# Generates for several prompts with the same settings, sending them in multi-prompt requests of up to the
+# provider's batch size (see Provider.max_batch)
+# returns a concurrent.futures.Future of [(response, error)], one per prompt
+# if given, callback(index, response, error) is called on the engine's callback thread for each prompt
+# cancelled(index) is true if prompt index is no longer needed; a request is dropped if it is for all its prompts
+def gen_batch_async(prompts, settings, config, callback=None, priority=INTERACTIVE, cancelled=None, **kwargs):
+    def done(future):
+        if not future.cancelled():
+            for index, (response, error) in enumerate(future.result()):
+                if error != 'cancelled':
+                    callback(index, response, error)
+    return get_engine().submit(agen_batch(prompts, settings, config, priority=priority, cancelled=cancelled,
+                                          **kwargs),
+                               callback=done if callback else None)
+
+
+async def agen_batch(prompts, settings, config, priority=INTERACTIVE, cancelled=None, **kwargs):
+    try:
+        model_info = config['models'][settings['model']]
+        provider = provider_settings(model_info, **kwargs)
+        batch_size = max(1, get_provider(provider['type']).max_batch(provider))
+    except Exception as e:
+        print(e)
+        return [(None, e)] * len(prompts)
+    scheduler = get_engine().scheduler
+    family = provider_family(provider['type'])
+    if family in config.get('concurrency', {}):
+        scheduler.set_limit(family, config['concurrency'][family])
+    submitted = time.monotonic()
+
+    async def run(indices):
+        try:
+            return await scheduler.run(
+                lambda: agenerate_batch([prompts[i] for i in indices], config=config, provider=provider,
+                                        metrics=queued(submitted, priority), **generation_kwargs(settings)),
+                provider=(family, provider['api_base']), priority=priority,
+                cancelled=(lambda: all(cancelled(i) for i in indices)) if cancelled else None)
+        except asyncio.CancelledError:
+            return [(None, 'cancelled')] * len(indices)
+
+    batches = [list(range(i, min(i + batch_size, len(prompts)))) for i in range(0, len(prompts), batch_size)]
+    results = await asyncio.gather(*(run(indices) for indices in batches))
+    return [result for batch in results for result in batch]
+
+
+# providers of the same family share concurrency limits
+def provider_family(model_type):
+    return get_provider(model_type).family or model_type
+
+
+# sends the request with the model type's provider (see util/providers.py)
+# requests are rate limited per provider and model, and retried if the error is retryable (see util/rate_limit.py)
+# metrics are recorded in the engine's telemetry, with the fields in metrics (see util/telemetry.py)
+async def agenerate(config, provider, on_text=None, metrics=None, **kwargs):
+    metrics = start_request(kwargs.get('model'), provider['type'], **(metrics if metrics else {}))
+    response = None
+    with track_request(metrics):
+        try:
+            model_type = config['models'][kwargs['model']]['type']
+            backend = get_provider(model_type)
+            family = backend.family or model_type
+            limiter = get_engine().rate_limiter
+            if family in config.get('rate_limits', {}):
+                limiter.set_limits(family, config['rate_limits'][family])
+            key = (family, provider['api_base'], kwargs['model'])
+            tokens = estimate_tokens(kwargs['prompt'], kwargs['length'], kwargs['num_continuations'])
+            request = backend.build_request(provider=provider, **kwargs)
+            response = await limited_request(lambda: backend.send(request, provider, on_text=on_text), limiter, key,
+                                             tokens, metrics=metrics)
+            result = backend.parse(response, kwargs['prompt'], kwargs['model'], echo=kwargs.get('echo', True)), None
+        except Exception as e:
+            result = None, e
+    record_request(config, metrics, [kwargs.get('prompt')], [result[0]], result[1], response)
+    return result
+
+
+# one multi-prompt request; returns [(response, error)], one per prompt
+async def agenerate_batch(prompts, config, provider, metrics=None, **kwargs):
+    if len(prompts) == 1:
+        return [await agenerate(config, provider, prompt=prompts[0], metrics=metrics, **kwargs)]
+    metrics = start_request(kwargs.get('model'), provider['type'], prompts=len(prompts),
+                            **(metrics if metrics else {}))
+    response = None
+    with track_request(metrics):
+        try:
+            model_type = config['models'][kwargs['model']]['type']
+            backend = get_provider(model_type)
+            family = backend.family or model_type
+            limiter = get_engine().rate_limiter
+            if family in config.get('rate_limits', {}):
+                limiter.set_limits(family, config['rate_limits'][family])
+            key = (family, provider['api_base'], kwargs['model'])
+            tokens = sum(estimate_tokens(prompt, kwargs['length'], kwargs['num_continuations']) for prompt in prompts)
+            request = backend.build_batch_request(prompts, provider=provider, **kwargs)
+            response = await limited_request(lambda: backend.send(request, provider), limiter, key, tokens,
+                                             metrics=metrics)
+            results = [(response, None) for response in backend.parse_batch(response, prompts, kwargs['model'],
+                                                                            echo=kwargs.get('echo', True))]
+        except Exception as e:
+            results = [(None, e)] * len(prompts)
+    record_request(config, metrics, prompts, [result for result, _ in results], results[0][1], response)
+    return results
+
+
+# adds a finished request's metrics to the engine's telemetry
+# response is the provider's response, which may report the tokens used
+def record_request(config, metrics, prompts, responses, error, response=None):
+    model_info = config.get('models', {}).get(metrics['model'], {})
+    usage = response.get('usage') if isinstance(response, dict) else None
+    record = finish_request(metrics, prompts, responses, error, usage, model_info.get('token_price'))
+    record['timestamp'] = timestamp()
+    get_engine().telemetry.record(record)
+
+
+# blocking, bypassing the scheduler
 def generate(config, **kwargs):
-    #pprint(kwargs)
-    model_type = config['models'][kwargs['model']]['type']
-    if model_type == 'ai21':
-        response, error = ai21_generate(api_key=kwargs['ai21_api_key'], **kwargs)#config['AI21_API_KEY'], **kwargs)
-        #save_response_json(response.json(), 'examples/AI21_response.json')
-        if not error:
-            formatted_response = format_ai21_response(response.json(), model=kwargs['model'])
-            #save_response_json(formatted_response, 'examples/AI21_formatted_response.json')
-            return formatted_response, error
-        else:
-            return response, error
-    elif model_type in ('openai', 'openai-custom', 'gooseai', 'openai-chat'):
-        # TODO OpenAI errors
-        response, error = openAI_generate(model_type, **kwargs)
-        #save_response_json(response, 'examples/openAI_response.json')
-        formatted_response = format_openAI_response(response, kwargs['prompt'], echo=True)
-        #save_response_json(formatted_response, 'examples/openAI_formatted_response.json')
-        return formatted_response, error
+    try:
+        provider = provider_settings(config['models'][kwargs['model']], **kwargs)
+    except Exception as e:
+        return None, e
+    return get_engine().submit(agenerate(config, provider, **kwargs)).result()
 
 
 def completions_text(response):
@@ -129,7 +257,7 @@ def completions_text(response):
 
 def save_response_json(response, filename):
     with open(filename, 'w') as f:
-        json.dump(response, f)
+        json.dump(response, f, default=json_default)
 
 #################################
 #   Janus
@@ -169,47 +297,29 @@ def fix_openAI_token(token):
     # byte_token = decoded.encode('raw_unicode_escape')
     # return byte_token.decode('utf-8')
 
-def openAI_token_position(token, text_offset):
-    return {'start': text_offset,
-            'end': text_offset + len(token)}
-
-
-def format_openAI_token_dict(completion, token, i):
-    token_dict = {'generatedToken': {'token': token,
-                                     'logprob': completion['logprobs']['token_logprobs'][i]},
-                  'position': openAI_token_position(token, completion['logprobs']['text_offset'][i])}
-    if completion['logprobs'].get('top_logprobs', None) is not None and completion['logprobs']['top_logprobs']:
-        openai_counterfactuals = completion['logprobs']['top_logprobs'][i]
-        if openai_counterfactuals:
-            sorted_counterfactuals = {k: v for k, v in
-                                      sorted(openai_counterfactuals.items(), key=lambda item: item[1], reverse=True)}
-            token_dict['counterfactuals'] = sorted_counterfactuals
-    else:
-        token_dict['counterfactuals'] = None
-    return token_dict
 
+# tokens start:end of a choice's logprobs as TokenColumns (see util/token_columns.py)
+def openAI_token_columns(completion, start=0, end=None):
+    logprobs = completion['logprobs']
+    top_logprobs = logprobs.get('top_logprobs', None)
+    return TokenColumns(logprobs['tokens'][start:end],
+                        logprobs['text_offset'][start:end],
+                        logprobs['token_logprobs'][start:end],
+                        top_logprobs[start:end] if top_logprobs else None)
 
-def format_openAI_completion(completion, prompt, prompt_end_index):
-    completion_dict = {'text': completion['text'][len(prompt):],
+
+# without echo, the choice's text is only the completion, but text offsets still count the prompt
+def format_openAI_completion(completion, prompt, prompt_end_index, echo=True):
+    completion_dict = {'text': completion['text'][len(prompt):] if echo else completion['text'],
                        'finishReason': completion['finish_reason'],
-                       'tokens': []}
-    for i, token in enumerate(completion['logprobs']['tokens'][prompt_end_index:]):
-        j = i + prompt_end_index
-        token_dict = format_openAI_token_dict(completion, token, j)
-        completion_dict['tokens'].append(token_dict)
+                       'tokens': openAI_token_columns(completion, prompt_end_index)}
     return completion_dict
 
 
 def format_openAI_prompt(completion, prompt):
-    prompt_dict = {'text': prompt, 'tokens': []}
-    # loop over tokens until offset >= prompt length
-    for i, token in enumerate(completion['logprobs']['tokens']):
-        if completion['logprobs']['text_offset'][i] >= len(prompt):
-            prompt_end_index = i
-            break
-        token_dict = format_openAI_token_dict(completion, token, i)
-        prompt_dict['tokens'].append(token_dict)
-
+    # prompt tokens are those starting before the end of the prompt
+    prompt_end_index = bisect.bisect_left(completion['logprobs']['text_offset'], len(prompt))
+    prompt_dict = {'text': prompt, 'tokens': openAI_token_columns(completion, 0, prompt_end_index)}
     return prompt_dict, prompt_end_index
 
 
@@ -221,8 +331,8 @@ def format_openAI_response(response, prompt, echo=True):
         prompt_end_index = 0
         #prompt = ''
 
-    response_dict = {'completions': [format_openAI_completion(completion, prompt, prompt_end_index) for completion in
-                                     response['choices']],
+    response_dict = {'completions': [format_openAI_completion(completion, prompt, prompt_end_index, echo)
+                                     for completion in response['choices']],
                      'prompt': prompt_dict,
                      'id': response['id'],
                      'model': response['model'],
@@ -230,47 +340,214 @@ def format_openAI_response(response, prompt, echo=True):
     return response_dict
 
 
-@retry(n_tries=3, delay=1, backoff=2, on_failure=lambda *args, **kwargs: ("", None))
+# deterministic requests are served from the response cache unless bypass_cache (see util/response_cache.py)
+# requests are rate limited and retryable errors retried as on the engine; returns (None, error) if they fail
+# provider is as returned by provider_settings, by default the OpenAI api with credentials from the environment
 def openAI_generate(model_type, prompt, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1, stop=None,
-                    model='davinci', logit_bias=None, **kwargs):
+                    model='davinci', logit_bias=None, bypass_cache=False, provider=None, echo=True, **kwargs):
     if not logit_bias:
         logit_bias = {}
     params = {
         'temperature': temperature,
         'max_tokens': length,
         'top_p': top_p,
-        'echo': True,
+        'echo': echo,
         'logprobs': logprobs,
         'logit_bias': logit_bias,
         'n': num_continuations,
         'stop': stop,
         #**kwargs
+        'model': model,
     }
-    if model_type == 'openai-custom':
-        params['model'] = model
-    else:
-        params['engine'] = model
-
 
+    client = provider_client(provider) if provider else default_client()
     if model_type == 'openai-chat':
+        # chat completions don't echo or return logprobs
+        del params['echo'], params['logprobs']
         params['messages'] = [{ 'role': "assistant", 'content': prompt }] 
-        response = client.ChatCompletion.create(
-            **params
-        )
+        create = client.chat_completion
     else:
         params['prompt'] = prompt
-        response = client.Completion.create(
-            **params
-        )
-    
+        create = client.completion
+
+    api_base = client.api_base
+    key = (provider_family(model_type), api_base, model)
+    tokens = estimate_tokens(prompt, length, num_continuations)
+    engine = get_engine()
+
+    # the blocking call runs in the engine loop's executor, retried like the engine's own requests
+    def request():
+        send = lambda: engine.loop.run_in_executor(None, lambda: create(**params))
+        return engine.submit(limited_request(send, engine.rate_limiter, key, tokens)).result()
+
+    try:
+        response = cached(request, model, prompt, dict(params, api_base=api_base), bypass=bypass_cache)
+    except Exception as e:
+        print(e)
+        return None, e
     return response, None
 
 
-def search(query, documents, engine="curie"):
-    return client.Engine(engine).search(
-        documents=documents,
-        query=query
-    )
+def openAI_params(model_type, prompt, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1,
+                  stop=None, model='davinci', logit_bias=None, echo=True, **kwargs):
+    params = {
+        'temperature': temperature,
+        'max_tokens': length,
+        'top_p': top_p,
+        'echo': echo,
+        'logprobs': logprobs,
+        'logit_bias': logit_bias if logit_bias else {},
+        'n': num_continuations,
+        'stop': stop,
+    }
+    if model_type == 'openai-chat':
+        # chat completions don't echo or return logprobs
+        del params['echo'], params['logprobs']
+        params['messages'] = [{'role': "assistant", 'content': prompt}]
+    else:
+        params['prompt'] = prompt
+    return params
+
+
+# a chat choice as a completion choice, with the prompt (if echoed) and the reply as one token each
+def chat_to_completion_choice(choice, prompt, echo=True):
+    content = choice['message']['content'] or ''
+    if not echo:
+        return {'text': content,
+                'finish_reason': choice.get('finish_reason'),
+                'index': choice.get('index', 0),
+                'logprobs': {'tokens': [content],
+                             'token_logprobs': [None],
+                             'text_offset': [len(prompt)],
+                             'top_logprobs': None}}
+    return {'text': prompt + content,
+            'finish_reason': choice.get('finish_reason'),
+            'index': choice.get('index', 0),
+            'logprobs': {'tokens': [prompt, content],
+                         'token_logprobs': [None, None],
+                         'text_offset': [0, len(prompt)],
+                         'top_logprobs': None}}
+
+
+# assembles a streamed response into the same response a non-streamed request would get
+async def openAI_astream(model_type, prompt, provider_key, url, params, headers, on_text, echo=True):
+    response = {'id': None, 'model': None, 'choices': []}
+    choices = {}
+    async for event in get_engine().post_stream(provider_key, url, params, headers=headers):
+        response['id'] = response['id'] or event.get('id')
+        response['model'] = response['model'] or event.get('model')
+        for chunk in event.get('choices', []):
+            index = chunk.get('index', 0)
+            if model_type == 'openai-chat':
+                choice = choices.setdefault(index, {'index': index, 'message': {'content': ''}, 'finish_reason': None})
+                choice['message']['content'] += chunk.get('delta', {}).get('content') or ''
+                text = choice['message']['content']
+            else:
+                choice = choices.setdefault(index, {'index': index, 'text': '', 'finish_reason': None,
+                                                    'logprobs': {'tokens': [], 'token_logprobs': [],
+                                                                 'text_offset': [], 'top_logprobs': []}})
+                choice['text'] += chunk.get('text', '')
+                if chunk.get('logprobs'):
+                    for key, values in choice['logprobs'].items():
+                        values.extend(chunk['logprobs'].get(key) or [])
+                # if echoed, the prompt comes first
+                text = choice['text'][len(prompt):] if echo else choice['text']
+            if chunk.get('finish_reason'):
+                choice['finish_reason'] = chunk['finish_reason']
+            if text:
+                on_text(index, text)
+    response['choices'] = [choices[i] for i in sorted(choices)]
+    if model_type == 'openai-chat':
+        response['choices'] = [chat_to_completion_choice(choice, prompt, echo) for choice in response['choices']]
+    else:
+        for choice in response['choices']:
+            if not choice['logprobs']['top_logprobs']:
+                choice['logprobs']['top_logprobs'] = None
+    return response
+
+
+# most prompts in one completions request
+OPENAI_MAX_BATCH = 20
+
+
+# same requests as openAI_generate, made through the engine's connection pool for the api base
+# chat responses are returned in the shape of completion responses
+# if on_text is given the response is streamed, calling on_text(index, text) with the text generated so far
+# for each choice as it arrives
+class OpenAIProvider(Provider):
+    family = 'openai'
+
+    def settings(self, model_info, **kwargs):
+        provider = super().settings(model_info, **kwargs)
+        provider['api_base'] = provider['api_base'] if provider['api_base'] else OPENAI_API_BASE
+        provider['api_key'] = kwargs.get('OPENAI_API_KEY', None) or os.environ.get("OPENAI_API_KEY", None)
+        provider['organization'] = kwargs.get('OPENAI_ORGANIZATION', None) or os.environ.get("OPENAI_ORGANIZATION", None)
+        return provider
+
+    def build_request(self, prompt, provider, model='davinci', **kwargs):
+        model_type = provider['type']
+        params = openAI_params(model_type, prompt, model=model, **kwargs)
+        api_base = provider['api_base'].rstrip('/')
+        endpoint = 'chat/completions' if model_type == 'openai-chat' else 'completions'
+        if model_type in ('openai-custom', 'openai-chat'):
+            params['model'] = model
+            url = f"{api_base}/{endpoint}"
+        else:
+            url = f"{api_base}/engines/{model}/{endpoint}"
+        headers = {"Authorization": f"Bearer {provider['api_key']}"}
+        if provider['organization']:
+            headers["OpenAI-Organization"] = provider['organization']
+        return {'pool': (model_type, api_base), 'url': url, 'body': params, 'headers': headers, 'prompt': prompt,
+                'echo': kwargs.get('echo', True)}
+
+    async def send(self, request, provider, on_text=None):
+        model_type = provider['type']
+        if on_text:
+            return await openAI_astream(model_type, request['prompt'], request['pool'], request['url'],
+                                        dict(request['body'], stream=True), request['headers'], on_text,
+                                        echo=request['echo'])
+        response = await get_engine().post_json(request['pool'], request['url'], request['body'],
+                                                headers=request['headers'])
+        if model_type == 'openai-chat':
+            response['choices'] = [chat_to_completion_choice(choice, request['prompt'], request['echo'])
+                                   for choice in response['choices']]
+        return response
+
+    def parse(self, response, prompt, model, echo=True):
+        return format_openAI_response(response, prompt, echo=echo)
+
+    # the completions endpoint takes a list of prompts; chat doesn't
+    def max_batch(self, provider):
+        return 1 if provider['type'] == 'openai-chat' else OPENAI_MAX_BATCH
+
+    def build_batch_request(self, prompts, provider, **kwargs):
+        request = self.build_request(prompts[0], provider, **kwargs)
+        request['body']['prompt'] = list(prompts)
+        return request
+
+    # choice index is prompt index * n + completion index
+    def parse_batch(self, response, prompts, model, echo=True):
+        choices = sorted(response['choices'], key=lambda choice: choice['index'])
+        n = len(choices) // len(prompts)
+        return [format_openAI_response({'id': f"{response['id']}-{i}", 'model': response['model'],
+                                        'choices': choices[i * n:(i + 1) * n]}, prompt, echo=echo)
+                for i, prompt in enumerate(prompts)]
+
+
+class GooseAIProvider(OpenAIProvider):
+    family = None
+
+    def settings(self, model_info, **kwargs):
+        provider = Provider.settings(self, model_info, **kwargs)
+        provider['api_base'] = provider['api_base'] if provider['api_base'] else GOOSEAI_API_BASE
+        provider['api_key'] = kwargs.get('GOOSEAI_API_KEY', None) or os.environ.get("GOOSEAI_API_KEY", None)
+        return provider
+
+
+register_provider('openai', OpenAIProvider())
+register_provider('openai-custom', OpenAIProvider())
+register_provider('openai-chat', OpenAIProvider())
+register_provider('gooseai', GooseAIProvider())
 
 
 #################################
@@ -281,24 +558,24 @@ def search(query, documents, engine="curie"):
 def fix_ai21_tokens(token):
     return token.replace("▁", " ").replace("<|newline|>", "\n")
 
-def ai21_token_position(textRange, text_offset):
-    return {'start': textRange['start'] + text_offset,
-            'end': textRange['end'] + text_offset}
-    
-def format_ai21_token_data(token, prompt_offset=0):
-    token_dict = {'generatedToken': {'token': fix_ai21_tokens(token['generatedToken']['token']),
-                                     'logprob': token['generatedToken']['logprob']},
-                  'position': ai21_token_position(token['textRange'], prompt_offset)}
-    if token['topTokens']:
-        token_dict['counterfactuals'] = {fix_ai21_tokens(c['token']): c['logprob'] for c in token['topTokens']}
-    else: 
-        token_dict['counterfactuals'] = None
-    return token_dict
+
+def ai21_counterfactuals(top_tokens):
+    return {fix_ai21_tokens(c['token']): c['logprob'] for c in top_tokens}
+
+
+# AI21 tokens as TokenColumns (see util/token_columns.py); top tokens are converted when they're looked at
+def ai21_token_columns(tokens, prompt_offset=0):
+    return TokenColumns([fix_ai21_tokens(token['generatedToken']['token']) for token in tokens],
+                        [token['textRange']['start'] + prompt_offset for token in tokens],
+                        [token['generatedToken']['logprob'] for token in tokens],
+                        [token['topTokens'] for token in tokens],
+                        ends=[token['textRange']['end'] + prompt_offset for token in tokens],
+                        counterfactuals=ai21_counterfactuals)
 
 
 def format_ai21_completion(completion, prompt_offset=0):
     completion_dict = {'text': completion['data']['text'],
-                       'tokens': [format_ai21_token_data(token, prompt_offset) for token in completion['data']['tokens']],
+                       'tokens': ai21_token_columns(completion['data']['tokens'], prompt_offset),
                        'finishReason': completion['finishReason']['reason']}
     return completion_dict
 
@@ -307,7 +584,7 @@ def format_ai21_response(response, model):
     prompt = response['prompt']['text']
     response_dict = {'completions': [format_ai21_completion(completion, prompt_offset=len(prompt)) for completion in response['completions']],
                      'prompt': {'text': prompt,
-                                'tokens': [format_ai21_token_data(token, prompt_offset=0) for token in response['prompt']['tokens']]},
+                                'tokens': ai21_token_columns(response['prompt']['tokens'], prompt_offset=0)},
                      'id': response['id'],
                      'model': model,
                      'timestamp': timestamp()}
@@ -341,5 +618,39 @@ def ai21_generate(prompt, length=150, num_continuations=1, logprobs=10, temperat
     return response, error
 
 
+# same request as ai21_generate, made through the engine's connection pool
+class AI21Provider(Provider):
+    def settings(self, model_info, **kwargs):
+        provider = super().settings(model_info, **kwargs)
+        provider['api_base'] = AI21_API_BASE
+        provider['api_key'] = kwargs.get('AI21_API_KEY', None) or os.environ.get("AI21_API_KEY", None)
+        return provider
+
+    def build_request(self, prompt, provider, length=150, num_continuations=1, logprobs=10, temperature=0.8, top_p=1,
+                      stop=None, model='j1-large', **kwargs):
+        request_json = {
+            "prompt": prompt,
+            "numResults": num_continuations,
+            "maxTokens": length,
+            "stopSequences": stop if stop else [],
+            "topKReturn": logprobs,
+            "temperature": temperature,
+            "topP": top_p,
+        }
+        return {'url': f"{provider['api_base']}/{model}/complete", 'body': request_json,
+                'headers': {"Authorization": f"Bearer {provider['api_key']}"}}
+
+    async def send(self, request, provider, on_text=None):
+        return await get_engine().post_json(('ai21', provider['api_base']), request['url'], request['body'],
+                                            headers=request['headers'])
+
+    # the prompt's tokens are always returned
+    def parse(self, response, prompt, model, echo=True):
+        return format_ai21_response(response, model=model)
+
+
+register_provider('ai21', AI21Provider())
+
+
 if __name__ == "__main__":
     pass
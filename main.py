@@ -160,7 +160,9 @@ class Application:
                 #('New Tab', 'Ctrl+N', '<Control-n>', self.create_tab),
                 ('New', None, None, lambda event=None: self.forward_command(Controller.new_tree)),
                 ('Open', 'O', None, lambda event=None: self.forward_command(Controller.open_tree)),
+                ('Open archive (read-only)', None, None, lambda event=None: self.forward_command(Controller.open_archive)),
                 ('Import subtree', 'Ctrl+Shift+O', None, lambda event=None: self.forward_command(Controller.import_tree)),
+                ('Diff with tree file', None, None, lambda event=None: self.forward_command(Controller.diff_tree)),
                 ('Save', 'S', None, lambda event=None: self.forward_command(Controller.save_tree)),
                 ('Save As...', 'Ctrl+S', '<Control-s>', lambda event=None: self.forward_command(Controller.save_tree_as)),
                 ('New tree from node...', None, None,
@@ -1,12 +1,16 @@
+import difflib
 import functools
+import hashlib
 import os
-import threading
+import sys
+import queue
 import time
 import math
 import uuid
 from asyncio import Queue
 from pprint import pprint
 import bisect
+import heapq
 import numpy as np
 from collections import defaultdict, ChainMap
 from multiprocessing.pool import ThreadPool
@@ -14,15 +18,23 @@ import codecs
 import json
 from util.frames_util import frame_merger, frame_merger_append, frame_merger_override
 from copy import deepcopy
-import jsonlines
 
-from gpt import openAI_generate, search, gen
-from util.util import json_create, timestamp, json_open, clip_num, index_clip, diff
+from gpt import openAI_generate, gen_async, gen_batch_async, provider_settings
+from util.prompt_templates import render, template_file, json_file
+from util.token_columns import restore_columns, hash_default, as_columns, concat_columns, TokenColumns
+from util.gen_engine import get_engine, sweep
+from util.scheduler import INTERACTIVE, BACKGROUND
+from util.util import json_create, timestamp, json_open, clip_num, index_clip
 from util.util_tree import fix_miro_tree, flatten_tree, node_ancestry, in_ancestry, get_inherited_attribute, \
     subtree_list, generate_conditional_tree, filtered_children, \
-    new_node, add_immutable_root, make_simple_tree, fix_tree, ancestry_in_range, ancestry_plaintext, ancestor_text_indices, \
-    node_index, ancestor_text_list, tree_subset
-from util.gpt_util import conditional_logprob, tokenize_ada, prompt_probs, logprobs_to_probs, parse_logit_bias, parse_stop
+    new_node, add_immutable_root, fix_tree, ancestry_in_range, ancestry_plaintext, ancestor_text_indices, \
+    node_index, ancestor_text_list, remap_subtree_ids, subtree_weights
+from util.archive import TreeArchive, is_archive, archive_filename, build_archive_from_json
+from util.history_util import append_revision, revision_text, compact_history
+from util.tree_hash import subtree_hash, invalidate, clear_hashes, without_hashes, tree_diff, digest
+from util.export_util import export_root, open_export, jsonl_records, flat_records, simple_node_fields, \
+    copy_node_fields, write_jsonl, write_flat, write_nested, write_tree, path_text_records, prefix_path_records
+from util.gpt_util import conditional_logprob, tokenize_ada, prompts_probs, parse_logit_bias, parse_stop
 from util.multiverse_util import greedy_word_multiverse
 from util.node_conditions import conditions, condition_lambda
 
@@ -66,6 +78,16 @@ DEFAULT_PREFERENCES = {
 
     # generation data
     'prob': True,
+    # show text in new nodes as it's generated
+    'stream_generations': True,
+    # drop queued generations once the selection leaves the node they were generated from (see
+    # TreeModel.generation_abandoned)
+    'cancel_abandoned_generations': True,
+    # generate continuations of the leaves likely to be read next in the background (see TreeModel.update_prefetch)
+    'prefetch': False,
+    'prefetch_nodes': 3,
+    # most tokens prefetches can hold between them
+    'prefetch_tokens': 2000,
     # darkmode
 }
 
@@ -112,6 +134,8 @@ DEFAULT_GENERATION_SETTINGS = {
     'global_context': '',
     'logit_bias': '',
     'template': 'Default',
+    # score the prompt (see TreeModel.scored_prefix)
+    'echo': True,
 }
 
 
@@ -205,6 +229,15 @@ DEFAULT_MODEL_CONFIG = {
             'type': 'gooseai',
             'api_base': None,
             },
+        # offline, for testing (see util/providers.py)
+        'mock': {
+            'model': 'mock',
+            'type': 'mock',
+            'api_base': None,
+            'latency': 0.5,
+            'tokens_per_second': 50,
+            'logprobs': True,
+            },
     },
     # 'api_base': None,
     # 'api_key': os.environ.get("API_KEY", ''),
@@ -307,12 +340,28 @@ EMPTY_TREE = {
 }
 
 
+# how often the Tk loop checks on requests made by generate_tree
+TREE_GENERATION_POLL_MS = 50
+# how often streamed text is written into generating nodes
+STREAM_POLL_MS = 50
+# most nodes looked at when predicting where a walk ends
+PREFETCH_SEARCH_LIMIT = 1000
+# characters of a path scored per request when measuring optimization, and how many of them are context
+# from the previous window (about 1500 and 500 tokens)
+PATH_SCORE_WINDOW = 6000
+PATH_SCORE_CONTEXT = 2000
+# characters scored past the end of a window, so its last tokens aren't cut off by the end of the prompt
+PATH_SCORE_MARGIN = 100
+
+
 class TreeModel:
 
     def __init__(self, root):
         self.app = root
         self.app.bind("<<TreeUpdated>>", lambda _: self.tree_updated())
         self.app.bind("<<NewNodes>>", lambda _: self.edit_new_nodes())
+        self.app.bind("<<Prefetched>>", lambda _: self.reveal_arrived_prefetches())
+        self.app.bind("<<GenerationCancelled>>", lambda _: self.remove_cancelled_placeholders())
 
         # All variables initialized below
         self.tree_filename = None
@@ -328,12 +377,29 @@ class TreeModel:
         self.canonical = None
         #self.tags = None
         self.model_responses = None
+        # TreeArchive if a read-only archive is open, in which case tree_node_dict is a view over it
+        self.archive = None
+        # {filename: (hash, mtime)} of the last save or export of each file, see written_unchanged
+        self.written_hashes = {}
 
         self.selected_node_id = None
 
         self.callbacks = defaultdict(list)
         self.conditions = defaultdict(list)
         self.new_nodes = []
+        # ids of the nodes each finished generation went into, one entry per <<NewNodes>>, see edit_new_nodes
+        self.generated_nodes = queue.Queue()
+        # (node_id, partial text) from streaming generations, written into nodes on the Tk loop
+        self.stream_updates = queue.Queue()
+        # futures of generations that are streaming into nodes
+        self.streams = set()
+        self.stream_polling = False
+        # {node_id: prefetch}, see prefetch
+        self.prefetched = {}
+        # placeholder nodes of generations cancelled before they started, see remove_cancelled_placeholders
+        self.cancelled_placeholders = queue.Queue()
+        # {hash of the path's text through a node: its tokens' scores}, see path_optimization
+        self.path_scores = {}
         self.OPENAI_API_KEY = None
         self.OPENAI_ORGANIZATION = None
         self.AI21_API_KEY = None
@@ -464,6 +530,7 @@ class TreeModel:
 
     def set_frame(self, frame_parent, frame):
         frame_parent['frame'] = deepcopy(frame)
+        self.invalidate_hashes(frame_parent)
 
     # def overwrite_frame(self, frame, new_frame):
     #     frame = deepcopy(new_frame)
@@ -520,6 +587,7 @@ class TreeModel:
         if 'frame' not in node:
             node['frame'] = {}
         self.set_path(node['frame'], value, path)
+        self.invalidate_hashes(node)
 
     def clear_user_frame(self):
         self.set_user_frame({})
@@ -542,12 +610,16 @@ class TreeModel:
     def tree_updated(self, rebuild_dict=True, **kwargs):
         if self.tree_raw_data and rebuild_dict:
             self.rebuild_tree()
+        self.update_hashes(**kwargs)
 
     # def tree_updated_silent(self):
     #     self.rebuild_tree()
 
     @event
     def rebuild_tree(self):
+        # archived trees can't change
+        if self.archive:
+            return
         add_immutable_root(self.tree_raw_data)
         self.tree_node_dict = {d["id"]: d for d in flatten_tree(self.tree_raw_data["root"])}
         fix_miro_tree(self.nodes)
@@ -556,12 +628,25 @@ class TreeModel:
     @event
     def edit_new_nodes(self):
         print('new nodes:', self.new_nodes)
+        try:
+            node_ids = self.generated_nodes.get_nowait()
+        except queue.Empty:
+            return
+        # generations finish in any order, so the event's own nodes are edited rather than the oldest entry's
+        self.forget_new_nodes(node_ids)
         self.tree_updated()
         time.sleep(0.5)
-        for node_id in self.new_nodes[0]:
+        # nodes deleted while they were generating are skipped
+        node_ids = [node_id for node_id in node_ids if self.node(node_id)]
+        for node_id in node_ids:
             self.node(node_id)['mutable'] = True
-        self.tree_updated(edit=self.new_nodes[0])
-        del self.new_nodes[0]
+        self.tree_updated(edit=node_ids)
+
+    # drops node_ids from the generations waiting for <<NewNodes>> (see edit_new_nodes), and any left empty
+    def forget_new_nodes(self, node_ids):
+        node_ids = set(node_ids)
+        entries = ([node_id for node_id in entry if node_id not in node_ids] for entry in self.new_nodes)
+        self.new_nodes = [entry for entry in entries if entry]
 
     @event
     def pre_selection_updated(self, **kwargs):
@@ -731,8 +816,13 @@ class TreeModel:
                 ancestor["open"] = True
             # Always open the root
             self.tree_raw_data["root"]["open"] = True
+            if node_id in self.prefetched:
+                self.reveal_prefetched(self.selected_node)
             if fire_callbacks:
                 self.selection_updated(**kwargs)
+            self.update_prefetch()
+            # queued requests can depend on what is selected
+            sweep()
             return self.selected_node
 
     #TODO move out of model
@@ -891,6 +981,7 @@ class TreeModel:
             new_child["open"] = True
 
         self.rebuild_tree()
+        self.invalidate_hashes(parent)
         return new_child
 
         # if refresh_nav:
@@ -926,6 +1017,7 @@ class TreeModel:
         new_parent["open"] = True
 
         self.rebuild_tree()
+        self.invalidate_hashes(new_parent)
         return new_parent
 
     def merge_with_parent(self, node):
@@ -945,6 +1037,7 @@ class TreeModel:
             c["parent_id"] = parent["id"]
         
         self.rebuild_tree()
+        self.invalidate_hashes(parent)
 
         # if node == self.selected_node:
         #     self.select_node(parent["id"])
@@ -981,12 +1074,14 @@ class TreeModel:
         if in_ancestry(node, new_parent, self.tree_node_dict):
             print('error: node is ancestor of new parent')
             return
-        old_siblings = self.parent(node)["children"]
-        old_siblings.remove(node)
+        old_parent = self.parent(node)
+        self.invalidate_hashes(old_parent)
+        old_parent["children"].remove(node)
         node["parent_id"] = new_parent_id
         new_parent["children"].append(node)
         # TODO does this cause bugs
         self.rebuild_tree()
+        self.invalidate_hashes(new_parent)
 
     # adds node to ghostchildren of new ghostparent
     def add_parent(self, node=None, new_ghostparent=None):
@@ -1003,6 +1098,7 @@ class TreeModel:
         new_index = (old_index + interval) % len(siblings)
         siblings[old_index], siblings[new_index] = siblings[new_index], siblings[old_index]
         self.rebuild_tree()
+        self.invalidate_hashes(self.parent(node))
         # if refresh_nav:
         #     self.tree_updated(add=[n['id'] for n in subtree_list(self.parent(node))])
         # else:
@@ -1022,6 +1118,9 @@ class TreeModel:
             siblings.extend(node["children"])
 
         self.rebuild_tree()
+        self.invalidate_hashes(parent)
+        # queued generations for deleted placeholders
+        sweep()
 
 
 
@@ -1058,18 +1157,36 @@ class TreeModel:
             if save_revision_history:
                 if 'history' not in node:
                     node['history'] = []
-                node['history'].append({
-                    'timestamp': timestamp(),
-                    'text': old_text,
-                })
+                append_revision(node['history'], old_text, timestamp())
                 
             if refresh_nav:
                 self.tree_updated(edit=[node['id']])
             else:
                 self.rebuild_tree()
+                self.invalidate_hashes(node)
                 #pass
 
 
+    # text of a past revision of the node, reconstructed from the delta chain in node['history']
+    def revision_text(self, node, index):
+        return revision_text(node['history'], index)
+
+    def revision_timestamps(self, node):
+        return [entry.get('timestamp') for entry in node.get('history', [])]
+
+    # restores a past revision, saving the current text as a new revision
+    def restore_revision(self, node, index, refresh_nav=True):
+        text = self.revision_text(node, index)
+        self.update_text(node, text, save_revision_history=True, refresh_nav=refresh_nav)
+
+    def compact_revision_histories(self):
+        for node in self.tree_node_dict.values():
+            if 'history' in node:
+                history = compact_history(node['history'])
+                if history is not node['history']:
+                    node['history'] = history
+                    self.invalidate_hashes(node)
+
     def update_note(self, node, text, index=0):
         assert node["id"] in self.tree_node_dict, text
 
@@ -1079,6 +1196,7 @@ class TreeModel:
             node["notes"] = ['']
         if node["notes"][index] != text:
             node["notes"][index] = text
+            self.invalidate_hashes(node)
             edited = True
 
         # if edited:
@@ -1119,6 +1237,7 @@ class TreeModel:
             new_parent['chapter_id'] = node['chapter_id']
             node.pop('chapter_id')
         self.rebuild_tree()
+        self.invalidate_hashes(node)
         # if refresh_nav:
         #     self.tree_updated(add=[n['id'] for n in subtree_list(new_parent)])
         # else:
@@ -1127,11 +1246,13 @@ class TreeModel:
 
     def sever_from_parent(self, node):
         parent = self.parent(node)
+        self.invalidate_hashes(parent)
         parent['children'].remove(node)
         node['parent_id'] = None
         return parent
 
     def sever_children(self, node):
+        self.invalidate_hashes(node)
         children = node['children'].copy()
         for child in children:
             child['parent_id'] = None
@@ -1142,6 +1263,7 @@ class TreeModel:
     def adopt_parent(self, node, parent):
         node['parent_id'] = parent['id']
         parent['children'].append(node)
+        self.invalidate_hashes(parent)
 
     def adopt_children(self, node, children):
         for child in children:
@@ -1279,7 +1401,7 @@ class TreeModel:
             return ''
         if self.is_template(node) and not raw:
             try:
-                return eval(f'f"""{node["text"]}"""')
+                return render(node['text'], self=self, node=node)
             except Exception as e:
                 print(e)
                 return node['text']
@@ -1330,6 +1452,7 @@ class TreeModel:
     def delete_chapter(self, chapter, update_tree=True):
         self.chapters.pop(chapter["id"])
         self.node(chapter["root_id"]).pop("chapter_id")
+        self.invalidate_hashes(self.node(chapter["root_id"]))
         if update_tree:
             self.tree_updated()
 
@@ -1431,6 +1554,7 @@ class TreeModel:
             root_node['summaries'] = []
 
         root_node['summaries'].append(new_summary['id'])
+        self.invalidate_hashes(root_node)
 
     def delete_summary(self, summary):
         self.summaries.pop(summary['id'])
@@ -1494,10 +1618,12 @@ class TreeModel:
             node['tags'] = []
         if tag not in node['tags']:
             node['tags'].append(tag)
+            self.invalidate_hashes(node)
 
     def untag_node(self, node, tag):
         if 'tags' in node and tag in node['tags']:
             node['tags'].remove(tag)
+            self.invalidate_hashes(node)
 
     def toggle_tag(self, node, tag):
         if self.has_tag_attribute(node, tag):
@@ -1640,6 +1766,72 @@ class TreeModel:
         del node['text_attributes'][attribute]
         self.tree_updated()
 
+    #################################
+    #   Hashes
+    #################################
+
+    # Merkle hashes of subtrees (see util/tree_hash.py), cached on the nodes
+    # Updates reported through tree_updated with add/edit/delete ids invalidate those nodes' ancestries;
+    # any other tree update could have changed anything, so every cached hash is dropped
+
+    def update_hashes(self, add=None, edit=None, delete=None, **kwargs):
+        if self.archive or not self.tree_raw_data:
+            return
+        if add is None and edit is None and delete is None:
+            clear_hashes(self.tree_raw_data['root'])
+            return
+        for node_id in (add or []) + (edit or []) + (delete or []):
+            if node_id in self.tree_node_dict:
+                self.invalidate_hashes(self.tree_node_dict[node_id])
+
+    def invalidate_hashes(self, node):
+        if self.archive or not node:
+            return
+        invalidate(node, self.tree_node_dict)
+
+    # fresh recomputes the cached hashes from the nodes' content instead of trusting them (see diff_trees' verify)
+    def subtree_hash(self, node=None, fresh=False):
+        node = node if node else self.root()
+        if fresh and not self.archive:
+            clear_hashes(node)
+        return subtree_hash(node)
+
+    # hash of a whole tree: the root's subtree hash and everything stored outside the root
+    def tree_hash(self, tree=None, fresh=False):
+        tree = tree if tree else self.tree_raw_data
+        tree_globals = {k: v for k, v in tree.items() if k != 'root'}
+        return digest(self.subtree_hash(tree['root'], fresh),
+                      json.dumps(tree_globals, sort_keys=True, default=hash_default))
+
+    # True if filename was last written by this tree with content hash content_hash and hasn't been touched since
+    def written_unchanged(self, filename, content_hash):
+        filename = os.path.abspath(filename)
+        return filename in self.written_hashes and os.path.isfile(filename) \
+            and self.written_hashes[filename] == (content_hash, os.path.getmtime(filename))
+
+    def record_written(self, filename, content_hash):
+        filename = os.path.abspath(filename)
+        self.written_hashes[filename] = (content_hash, os.path.getmtime(filename))
+
+    # Differences between two trees (default: the current tree and tree_b), see tree_diff
+    # Cached hashes are trusted, so only the branches that differ are visited. verify recomputes them first,
+    # in case a tree was changed without invalidating them
+    def diff_trees(self, tree_b, tree_a=None, verify=False):
+        tree_a = tree_a if tree_a else self.tree_raw_data
+        if verify:
+            self.subtree_hash(tree_a['root'], fresh=True)
+            self.subtree_hash(tree_b['root'], fresh=True)
+        return tree_diff(tree_a['root'], tree_b['root'])
+
+    # files saved by older versions can have hashes in them, which aren't trusted
+    def diff_tree_files(self, filename_b, filename_a=None, verify=False):
+        tree_a = json_open(filename_a) if filename_a else None
+        tree_b = json_open(filename_b)
+        for tree in (tree_a, tree_b):
+            if tree:
+                clear_hashes(tree['root'])
+        return self.diff_trees(tree_b, tree_a, verify)
+
 
     #################################
     #   I/O
@@ -1666,7 +1858,7 @@ class TreeModel:
 
         if 'model_responses' not in self.tree_raw_data:
             self.tree_raw_data['model_responses'] = {}
-        self.model_responses = self.tree_raw_data['model_responses']
+        self.model_responses = restore_columns(self.tree_raw_data['model_responses'])
 
         # if 'tags' not in self.tree_raw_data:
         #     self.tree_raw_data['tags'] = DEFAULT_TAGS
@@ -1755,6 +1947,9 @@ class TreeModel:
         return new_tree
 
     def load_tree_data(self, data, init_global=True):
+        self.close_archive()
+        self.prefetched = {}
+        self.path_scores = {}
         if "root" not in data:
             # json file with a root node
             self.tree_raw_data = deepcopy(EMPTY_TREE)
@@ -1780,48 +1975,124 @@ class TreeModel:
 
     # Open a new tree json
     def open_tree(self, filename):
+        if is_archive(filename):
+            return self.open_archive(filename)
         self.tree_filename = os.path.abspath(filename)
         self.load_tree_data(json_open(self.tree_filename))
         self.io_update()
 
+    # Open a tree read-only from a memory mapped archive (see util/archive.py)
+    # A json file is preprocessed into an archive next to it first, unless an up to date one exists
+    # Nodes are served from the mapping instead of being loaded into dicts
+    def open_archive(self, filename):
+        if not is_archive(filename):
+            json_filename = filename
+            filename = archive_filename(json_filename)
+            if not os.path.isfile(filename) or os.path.getmtime(filename) < os.path.getmtime(json_filename):
+                print('building archive', filename)
+                build_archive_from_json(json_filename, filename)
+        self.close_archive()
+        self.archive = TreeArchive(filename)
+        self.tree_filename = os.path.abspath(filename)
+        self.tree_raw_data = self.archive.tree_data()
+        self.tree_node_dict = self.archive.node_dict()
+        self._init_global_objects()
+        self.tree_updated(rebuild=True, write=False)
+        root = self.root()
+        self.select_node(self.tree_raw_data.get("selected_node_id", root['children'][0]['id'] if root['children'] else root['id']))
+        self.io_update()
+
+    def close_archive(self):
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+
+    @property
+    def read_only(self):
+        return self.archive is not None
+
     def open_empty_tree(self):
         self.tree_filename = None
         self.load_tree_data(deepcopy(EMPTY_TREE))
         self.io_update()
 
-    # Open a new tree json
-    # TODO if you try to import things that already exist in tree this causes problems
-    # because of duplicate IDs
-    # TODO does metadata of subtree overwrite parent tree?
+    # Import a json tree as a subtree of the selected node
+    # Colliding ids are remapped, and chapters, tags, summaries and model responses are merged in
+    # Only the imported subtree is flattened; the node dict is updated in place
     def import_tree(self, filename):
         tree_json = json_open(filename)
         if 'root' in tree_json:
             new_subtree_root = tree_json['root']
-            if not new_subtree_root['mutable']:
-                new_subtree_root['mutable'] = True
-            self.add_subtree(self.selected_node, new_subtree_root)
-            # self.selected_node['children'].append(new_subtree_root)
-            # new_subtree_root['parent_id'] = self.selected_node_id
-            if 'chapters' in tree_json:
-                #self.import_chapters(new_subtree_root, tree_json['chapters'])
-                self.chapters.update(tree_json['chapters'])
-            if 'tags' in tree_json:
-                self.tags.update(tree_json['tags'])
-            self.load_tree_data(self.tree_raw_data)
-            self.tree_updated()
-            self.io_update()
+            new_subtree_root['mutable'] = True
+        elif 'id' in tree_json or 'text' in tree_json:
+            new_subtree_root = tree_json
+            tree_json = {}
         else:
-            if 'id' in tree_json:
-                self.add_subtree(self.selected_node, tree_json)
-                self.load_tree_data(self.tree_raw_data)
-                self.tree_updated()
-                self.io_update()
-            else:
-                print('improperly formatted tree')
+            print('improperly formatted tree')
+            return
+        new_nodes = self.import_subtree(self.selected_node, new_subtree_root, tree_json)
+        self.tree_updated(rebuild_dict=False, add=[n['id'] for n in new_nodes if self.visible(n)])
+        self.io_update()
+
+    def import_subtree(self, node, subtree_root, tree_json=None):
+        tree_json = tree_json if tree_json else {}
+        new_nodes, id_map = remap_subtree_ids(subtree_root, taken=self.tree_node_dict)
+        chapter_map = self.merge_imported_objects(self.chapters, tree_json.get('chapters', {}), id_map)
+        summary_map = self.merge_imported_objects(self.summaries, tree_json.get('summaries', {}), id_map)
+        response_map = self.merge_imported_objects(self.model_responses,
+                                                   restore_columns(tree_json.get('model_responses', {})))
+        for response_id in tree_json.get('model_responses', {}):
+            prompt = self.model_responses[response_map.get(response_id, response_id)].get('prompt')
+            # responses from older trees may not have their prompt
+            if not prompt:
+                continue
+            prefix = prompt.get('prefix')
+            if prefix:
+                prefix['id'] = response_map.get(prefix['id'], prefix['id'])
+        for tag, attributes in tree_json.get('tags', {}).items():
+            if tag not in self.tags:
+                self.tags[tag] = attributes
+
+        for imported in new_nodes:
+            if 'chapter_id' in imported:
+                imported['chapter_id'] = chapter_map.get(imported['chapter_id'], imported['chapter_id'])
+            if 'summaries' in imported:
+                imported['summaries'] = [summary_map.get(s, s) for s in imported['summaries']]
+            if 'generation' in imported and 'id' in imported['generation']:
+                imported['generation']['id'] = response_map.get(imported['generation']['id'],
+                                                                imported['generation']['id'])
+            imported["open"] = imported.get("open", False)
+            self.tree_node_dict[imported['id']] = imported
+
+        self.add_subtree(node, subtree_root)
+        return new_nodes
+
+    # Adds imported {id: object} entries to existing, giving new ids to entries that collide with a different object
+    # root_id and end_id fields are rewritten with node_id_map
+    # Returns {old_id: new_id} for remapped entries
+    def merge_imported_objects(self, existing, imported, node_id_map=None):
+        id_map = {}
+        for old_id, obj in imported.items():
+            for field in ('root_id', 'end_id'):
+                if node_id_map and field in obj:
+                    obj[field] = node_id_map.get(obj[field], obj[field])
+            new_id = old_id
+            if old_id in existing:
+                if existing[old_id] == obj:
+                    continue
+                new_id = str(uuid.uuid1())
+                id_map[old_id] = new_id
+                if 'id' in obj:
+                    obj['id'] = new_id
+            existing[new_id] = obj
+        return id_map
 
     def add_subtree(self, node, subtree_root):
         node['children'].append(subtree_root)
         subtree_root['parent_id'] = node['id']
+        # hashes saved in older files aren't trusted
+        clear_hashes(subtree_root)
+        self.invalidate_hashes(node)
 
     # open new tree with node as root
     def open_node_as_root(self, node=None, new_filename=None, save=True, rebuild_global=False):
@@ -1887,6 +2158,16 @@ class TreeModel:
         subtree = subtree if subtree else self.tree_raw_data
         if not save_filename:
             return False
+        if self.read_only:
+            print('tree is a read-only archive')
+            return False
+        if subtree is self.tree_raw_data:
+            self.compact_revision_histories()
+        # nothing has changed since this file was saved, so there's nothing to write or back up
+        content_hash = self.tree_hash(subtree)
+        if self.written_unchanged(save_filename, content_hash):
+            print('tree unchanged since last save')
+            return True
         print('saving tree')
 
         # Fancy platform independent os.path
@@ -1902,62 +2183,63 @@ class TreeModel:
 
         # print('chapters:', subtree['chapters'])
         # Save tree
-        json_create(save_filename, subtree)
+        json_create(save_filename, {**subtree, 'root': without_hashes(subtree['root'])})
+        self.record_written(save_filename, content_hash)
         self.io_update()
         return True
 
-    def export_subtree(self, root, filename, filter=None, copy_attributes=None):
-        filtered_tree = tree_subset(root, filter=filter, copy_attributes=copy_attributes)
-        filtered_tree = {'root': filtered_tree}
-        if 'tags' in copy_attributes:
-            filtered_tree['tags'] = self.tags
-        if 'chapter_id' in copy_attributes:
-            filtered_tree['chapters'] = self.chapters
+    def export_subtree(self, root, filename, filter=None, copy_attributes=None, compress=None):
+        extras = {}
+        if copy_attributes and 'tags' in copy_attributes:
+            extras['tags'] = self.tags
+        if copy_attributes and 'chapter_id' in copy_attributes:
+            extras['chapters'] = self.chapters
         # TODO copy globals
-        json_create(filename, filtered_tree)
+        # unfiltered exports of an unchanged subtree are skipped
+        content_hash = digest('subtree', str(copy_attributes), str(compress),
+                              self.subtree_hash(root),
+                              json.dumps(extras, sort_keys=True, default=str)) if filter is None else None
+        if content_hash and self.written_unchanged(filename, content_hash):
+            return
+        with open_export(filename, compress) as f:
+            write_tree(f, root, copy_node_fields(copy_attributes), filter=filter, extras=extras)
+        if content_hash:
+            self.record_written(filename, content_hash)
         self.io_update()
 
-    def save_simple_tree(self, save_filename, subtree=None):
-        subtree = subtree if subtree else self.tree_raw_data
-        simple_tree = make_simple_tree(subtree)
-        json_create(save_filename, simple_tree)
+    def save_simple_tree(self, save_filename, subtree=None, filter=None, compress=None):
+        subtree = export_root(subtree if subtree else self.tree_raw_data)
+        content_hash = digest('simple', str(compress), self.subtree_hash(subtree)) if filter is None else None
+        if content_hash and self.written_unchanged(save_filename, content_hash):
+            return
+        with open_export(save_filename, compress) as f:
+            write_nested(f, subtree, simple_node_fields, filter=filter)
+        if content_hash:
+            self.record_written(save_filename, content_hash)
         self.io_update()
 
-    def save_jsonl(self, save_filename=None, subtree=None):
-        subtree = subtree if subtree else self.tree_raw_data
-        flat_tree = self.nodes
+    def save_jsonl(self, save_filename=None, subtree=None, filter=None, compress=None):
+        subtree = export_root(subtree if subtree else self.tree_raw_data)
         save_filename = save_filename if save_filename else os.path.splitext(os.path.basename(self.tree_filename))[0]+ '.jsonl'
         filename = os.path.join(os.getcwd() + '/data/exports', save_filename)
-        with jsonlines.open(filename, mode='w') as writer:
-            for line in flat_tree:
-                line_dict = {'id': line['id']}
-                if 'text' in line:
-                    line_dict['text'] = line['text']
-                if 'parent_id' in line:
-                    line_dict['parent_id'] = line['parent_id']
-                writer.write(line_dict)
+        content_hash = digest('jsonl', str(compress), self.subtree_hash(subtree)) if filter is None else None
+        if content_hash and self.written_unchanged(filename, content_hash):
+            return
+        with open_export(filename, compress) as f:
+            write_jsonl(f, jsonl_records(subtree, filter))
+        if content_hash:
+            self.record_written(filename, content_hash)
         self.io_update()
 
-    def flat_export(self, subtree=None):
-        subtree = subtree if subtree else self.tree_raw_data
-        flat_tree = self.nodes
-        export_body = ''
-        for line in flat_tree:
-            export_body += '\t{'
-            export_body += f'id: {repr(line["id"])}'
-            if 'text' in line:
-                export_body += f', text: {repr(line["text"])}'
-            if 'parent_id' in line:
-                export_body += f', parentId: {repr(line["parent_id"])}'
-            if 'children' in line and len(line['children']) > 0:
-                export_body += f', hasChildren: true'
-            if 'tags' in line and len(line['tags']) > 0:
-                export_body += f', tags: {repr(line["tags"])}'
-            else: 
-                export_body += f', tags: []'
-            export_body += '},\n'
-        export_string = f'[\n{export_body}]'
-        print(export_string)
+    # writes to stdout if no filename is given
+    def flat_export(self, filename=None, subtree=None, filter=None, compress=None):
+        subtree = export_root(subtree if subtree else self.tree_raw_data)
+        if not filename:
+            write_flat(sys.stdout, flat_records(subtree, filter))
+            return
+        with open_export(filename, compress) as f:
+            write_flat(f, flat_records(subtree, filter))
+        self.io_update()
 
     def export_history(self, node, filename):
         history = self.ancestry_text(node)
@@ -1965,23 +2247,67 @@ class TreeModel:
         f.write(history)
         f.close()
 
+    # Exports root-to-endpoint trajectories in one pass over the subtree
+    # Endpoints are leaves, or nodes explicitly tagged with tag (e.g. 'canonical')
+    # mode 'text': one {id, text} line per path
+    # mode 'prefix': node table + path index, each shared prefix node written once (see prefix_path_records)
+    # sample: probability of keeping each path, max_paths: stop after this many paths
+    def export_paths(self, filename, root=None, tag=None, mode='text', filter=None, max_paths=None, sample=None,
+                     seed=None, compress=None):
+        root = root if root else self.root()
+        endpoint = (lambda node: self.has_tag_attribute(node, tag)) if tag else None
+        path_kwargs = {'text_callback': self.text, 'filter': filter, 'endpoint': endpoint,
+                       'max_paths': max_paths, 'sample': sample, 'seed': seed}
+        if mode == 'text':
+            records = path_text_records(root, **path_kwargs)
+        elif mode == 'prefix':
+            records = prefix_path_records(root, **path_kwargs)
+        else:
+            print('invalid path export mode')
+            return
+        with open_export(filename, compress) as f:
+            count = write_jsonl(f, records)
+        self.io_update()
+        return count
+
     #################################
     #   Generation
     #################################
 
-    def post_generation(self, error, nodes, results):
-        if not error:
+    # {'providers': {provider: {active, limit, pending}}, 'waits': {priority: {mean, max, count}}, 'cancelled',
+    #  'rate_limits': {key: rates}, 'coalescing': {in_flight, calls, joined}}
+    def generation_queue_stats(self):
+        return get_engine().queue_stats()
+
+    # {model: aggregated metrics of its requests} (see util/telemetry.py)
+    def generation_metrics(self):
+        return get_engine().telemetry.summary()
+
+    def recent_generation_metrics(self):
+        return get_engine().telemetry.recent()
+
+    def clear_generation_metrics(self):
+        get_engine().telemetry.clear()
+
+    # CSV of the recent requests if filename ends with .csv, else JSON of the summary and requests
+    def export_generation_metrics(self, filename):
+        get_engine().telemetry.export(filename)
+
+    # prefix is the prompt's scored prefix, if any (see scored_prefix)
+    def post_generation(self, error, nodes, results, prefix=None):
+        if not error and results:
             #TODO adaptive branching
-            self.model_responses[results['id']] = results
+            self.store_response(results, prefix)
             self.set_generated_nodes(nodes, results)
         else:
-            self.delete_failed_nodes(nodes, error)
+            self.delete_failed_nodes(nodes, error if error else 'no response')
             return
 
         for result in results['completions']:
             print("Generated continuation:\n", result['text'], "\nerror", error)
 
         # DO NOT CALL FROM THREAD: self.tree_updated()
+        self.generated_nodes.put([node['id'] for node in nodes])
         self.app.event_generate("<<NewNodes>>", when="tail")
 
     def default_post_template(self, completion):
@@ -1990,11 +2316,8 @@ class TreeModel:
         return start_text + completion['text'] + restart_text
 
     def custom_post_template(self, completion, filename):
-        text = completion['text']
-        with open(f'./config/post_templates/{filename}.txt', 'r') as f:
-            prompt = f.read()
-        eval_prompt = eval(f'f"""{prompt}"""')
-        return eval_prompt
+        template = template_file(f'./config/post_templates/{filename}.txt')
+        return template.render(text=completion['text'], completion=completion)
 
     def set_generated_nodes(self, nodes, results):
         for i, node in enumerate(nodes):
@@ -2005,23 +2328,243 @@ class TreeModel:
             self.node_creation_metadata(node, source='AI')
             node["generation"] = {'id': results['id'],
                                   'index': i}
+            self.invalidate_hashes(node)
             # TODO save history
 
     def delete_failed_nodes(self, nodes, error):
         print(f"ERROR {error}. Deleting failures")
         for node in nodes:
             parent = self.parent(node)
+            self.invalidate_hashes(parent)
             parent["children"].remove(node)
         self.tree_updated(delete=[node['id'] for node in nodes])
 
-    def default_generate(self, prompt, nodes):
-        results, error = gen(prompt, self.generation_settings, self.model_config,
-            OPENAI_API_KEY=self.OPENAI_API_KEY,
-            OPENAI_ORGANIZATION=self.OPENAI_ORGANIZATION,
-            AI21_API_KEY=self.AI21_API_KEY,
-            GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,)
-        self.post_generation(error, nodes, results)
+    # returns immediately; post_generation is called from the generation engine's callback thread
+    # the request is dropped if it's abandoned before it starts (see generation_abandoned)
+    # with the stream_generations preference, partial texts are queued for drain_stream_updates as they arrive
+    def default_generate(self, prompt, nodes, priority=INTERACTIVE):
+        on_text = None
+        if self.preferences.get('stream_generations', False):
+            on_text = lambda index, text: self.stream_updates.put((nodes[index]['id'], text)) \
+                if index < len(nodes) else None
+        settings, prefix = self.echo_settings(self.parent(nodes[0]), prompt, self.generation_settings)
+        future = gen_async(prompt, settings, self.model_config,
+                           callback=lambda results, error: self.post_generation(error, nodes, results, prefix),
+                           priority=priority,
+                           on_text=on_text,
+                           cancelled=self.generation_abandoned(nodes, priority),
+                           OPENAI_API_KEY=self.OPENAI_API_KEY,
+                           OPENAI_ORGANIZATION=self.OPENAI_ORGANIZATION,
+                           AI21_API_KEY=self.AI21_API_KEY,
+                           GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,)
+        future.add_done_callback(lambda f: self.generation_cancelled(nodes) if f.cancelled() else None)
+        if on_text:
+            self.watch_stream(future)
+        return future
+
+    # cancelled() predicate of a generation into nodes: true once none of them are in the tree, or, for interactive
+    # generations with the cancel_abandoned_generations preference, once neither they nor the node they were
+    # generated from is selected (checked when the selection changes, see select_node)
+    def generation_abandoned(self, nodes, priority):
+        node_ids = {node['id'] for node in nodes}
+        parent_id = nodes[0].get('parent_id')
+        on_navigate = priority == INTERACTIVE and self.preferences.get('cancel_abandoned_generations', True)
+
+        def abandoned():
+            if not any(node_id in self.tree_node_dict for node_id in node_ids):
+                return True
+            return on_navigate and self.selected_node_id != parent_id and self.selected_node_id not in node_ids
+        return abandoned
+
+    # called from the generation engine's loop
+    def generation_cancelled(self, nodes):
+        self.cancelled_placeholders.put(nodes)
+        # DO NOT CALL FROM THREAD: self.tree_updated()
+        self.app.event_generate("<<GenerationCancelled>>", when="tail")
+
+    # on the Tk loop: removes the placeholders left by generations cancelled before they started
+    def remove_cancelled_placeholders(self):
+        removed = []
+        while True:
+            try:
+                nodes = self.cancelled_placeholders.get_nowait()
+            except queue.Empty:
+                break
+            # no <<NewNodes>> comes for a cancelled generation
+            self.forget_new_nodes(node['id'] for node in nodes)
+            for node in nodes:
+                if node['id'] not in self.tree_node_dict or 'generation' in node:
+                    continue
+                parent = self.parent(node)
+                self.invalidate_hashes(parent)
+                parent['children'].remove(node)
+                removed.append(node['id'])
+        if removed:
+            self.tree_updated(delete=removed)
+
+    def watch_stream(self, future):
+        self.streams.add(future)
+        if not self.stream_polling:
+            self.stream_polling = True
+            self.app.after(STREAM_POLL_MS, self.drain_stream_updates)
+
+    # Writes the latest partial text of each streaming node, batching everything that arrived since the last drain
+    # into one tree update. Nodes whose generation has finished (see set_generated_nodes) are left alone
+    def drain_stream_updates(self):
+        texts = {}
+        while True:
+            try:
+                node_id, text = self.stream_updates.get_nowait()
+            except queue.Empty:
+                break
+            texts[node_id] = text
+        start_text = codecs.decode(self.generation_settings['start'], "unicode-escape")
+        edited = []
+        for node_id, text in texts.items():
+            node = self.node(node_id)
+            if node and 'generation' not in node:
+                node['text'] = start_text + text
+                edited.append(node_id)
+        if edited:
+            self.tree_updated(rebuild_dict=False, edit=edited, write=False, stream=True)
+        self.streams = {future for future in self.streams if not future.done()}
+        if self.streams or not self.stream_updates.empty():
+            self.app.after(STREAM_POLL_MS, self.drain_stream_updates)
+        else:
+            self.stream_polling = False
+
 
+    #################################
+    #   Prefetching
+    #################################
+
+    # If preferences['prefetch'], selecting a node starts generating continuations in the background for the
+    # leaves that are likely to be read next (see prefetch_candidates). The completions are kept out of the tree
+    # until their node is selected or generated from, and are then added as its children at once. Prefetches
+    # (done or in flight) can take at most preferences['prefetch_tokens'] tokens between them, and are dropped
+    # once their node is no longer likely to be reached.
+
+    # up to count leaves the reader may reach next from node, most likely first: the next node in reading order,
+    # the next sibling, then the leaves a walk from node (weighted as preferences['walk']) is most likely to end at
+    def prefetch_candidates(self, node, count):
+        candidates = []
+        if self.visible(node):
+            candidates.append(self.node(self.next_id(node, 1, filter=self.visible)))
+        if self.has_parent(node):
+            candidates.append(self.sibling(node, 1, filter=self.visible))
+        mode = self.preferences.get('walk', 'descendents')
+        # (-probability of the walk reaching node, sequence, node)
+        frontier = [(-1.0, 0, node)]
+        sequence = 1
+        while frontier and sequence < PREFETCH_SEARCH_LIMIT and len(candidates) < count + 2:
+            probability, _, current = heapq.heappop(frontier)
+            if not filtered_children(current, self.visible):
+                candidates.append(current)
+                continue
+            for child, weight in zip(current['children'], subtree_weights(current, mode, self.visible)):
+                if weight > 0:
+                    heapq.heappush(frontier, (probability * weight, sequence, child))
+                    sequence += 1
+        leaves = []
+        for candidate in candidates:
+            if candidate and candidate is not node and not candidate['children'] and self.is_mutable(candidate) \
+                    and candidate not in leaves:
+                leaves.append(candidate)
+        return leaves[:count]
+
+    # drops prefetches for nodes that are no longer likely to be reached and starts new ones within the budget
+    def update_prefetch(self):
+        node = self.selected_node
+        if not self.preferences.get('prefetch', False) or not node:
+            # prefetches a generation is waiting on are kept
+            self.prefetched = {node_id: prefetch for node_id, prefetch in self.prefetched.items()
+                               if prefetch.get('wanted')}
+            return
+        candidates = self.prefetch_candidates(node, self.preferences.get('prefetch_nodes', 3))
+        keep = {candidate['id'] for candidate in candidates} | {node['id']}
+        self.prefetched = {node_id: prefetch for node_id, prefetch in self.prefetched.items()
+                           if node_id in keep or prefetch.get('wanted')}
+        held = sum(prefetch['tokens'] for prefetch in self.prefetched.values())
+        tokens = self.generation_settings['num_continuations'] * self.generation_settings['response_length']
+        for candidate in candidates:
+            if candidate['id'] in self.prefetched:
+                continue
+            if held + tokens > self.preferences.get('prefetch_tokens', 2000):
+                break
+            self.prefetch(candidate)
+            held += tokens
+
+    # starts generating node's continuations at background priority; if the prefetch is dropped before the request
+    # starts, so is the request
+    def prefetch(self, node):
+        node_id = node['id']
+        prompt = self.prompt(node)
+        settings, prefix = self.echo_settings(node, prompt, self.generation_settings)
+        prefetch = {'prompt': prompt, 'settings': self.generation_settings, 'prefix': prefix,
+                    'tokens': settings['num_continuations'] * settings['response_length']}
+        self.prefetched[node_id] = prefetch
+
+        def done(results, error):
+            prefetch['results'] = (results, error)
+            if self.prefetched.get(node_id) is prefetch \
+                    and (node_id == self.selected_node_id or prefetch.get('wanted')):
+                # DO NOT CALL FROM THREAD: self.tree_updated()
+                self.app.event_generate("<<Prefetched>>", when="tail")
+
+        gen_async(prompt, settings, self.model_config,
+                  callback=done,
+                  priority=BACKGROUND,
+                  cancelled=lambda: self.prefetched.get(node_id) is not prefetch or node_id not in self.tree_node_dict,
+                  OPENAI_API_KEY=self.OPENAI_API_KEY,
+                  OPENAI_ORGANIZATION=self.OPENAI_ORGANIZATION,
+                  AI21_API_KEY=self.AI21_API_KEY,
+                  GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,)
+
+    # True if prefetch was made with the current generation settings and node's current prompt
+    def prefetch_matches(self, node, prefetch):
+        return prefetch['settings'] == self.generation_settings and self.prompt(node) == prefetch['prompt']
+
+    # adds node's prefetched completions as its children and returns them
+    # returns None if they haven't arrived yet (the prefetch is kept), or can't be used: the request failed, or the
+    # node, its prompt or the generation settings changed since
+    def reveal_prefetched(self, node):
+        prefetch = self.prefetched.get(node['id'])
+        if not prefetch or 'results' not in prefetch:
+            return None
+        del self.prefetched[node['id']]
+        results, error = prefetch['results']
+        if error or not results or node['children'] or not self.prefetch_matches(node, prefetch):
+            return None
+        self.store_response(results, prefetch['prefix'])
+        children = []
+        for _ in results['completions']:
+            child = new_node()
+            child['open'] = True
+            child['parent_id'] = node['id']
+            node['children'].append(child)
+            children.append(child)
+        node['open'] = True
+        self.set_generated_nodes(children, results)
+        self.invalidate_hashes(node)
+        self.tree_updated(add=[child['id'] for child in children])
+        return children
+
+    # on the Tk loop, once prefetches of the selected node or of nodes generated from arrive
+    def reveal_arrived_prefetches(self):
+        for node_id, prefetch in list(self.prefetched.items()):
+            if 'results' not in prefetch or not (node_id == self.selected_node_id or prefetch.get('wanted')):
+                continue
+            node = self.node(node_id)
+            if not node:
+                del self.prefetched[node_id]
+                continue
+            children = self.reveal_prefetched(node)
+            if children and prefetch.get('select'):
+                self.select_node(children[0]['id'])
+            elif not children and prefetch.get('wanted'):
+                # a generation was waiting on it, so generate as if there had been no prefetch
+                self.generate_continuations(node, update_selection=prefetch.get('select'))
+        self.update_prefetch()
 
     # if self.generation_settings['adaptive']:
     #     for i, result in enumerate(results.choices):
@@ -2047,9 +2590,8 @@ class TreeModel:
     def custom_prompt(self, node, filename):
         input = self.ancestry_text(node)
         input = input[-self.generation_settings['prompt_length']:]
-        with open(f'./config/prompts/{filename}.txt', 'r') as f:
-            prompt = f.read()
-        eval_prompt = eval(f'f"""{prompt}"""')
+        template = template_file(f'./config/prompts/{filename}.txt')
+        eval_prompt = template.render(input=input, node=node, self=self)
         eval_prompt = eval_prompt[-6000:]
         return eval_prompt
 
@@ -2076,10 +2618,9 @@ class TreeModel:
         passages = []
         summaries = []
 
-        # load summaries json
-        with open(f'./config/fewshots/summaries.json', 'r') as f:
-            sum_json = json.load(f)
-        
+        # load summaries json (cached)
+        sum_json = json_file('./config/fewshots/summaries.json')
+
         for entry in sum_json:
             # add to passages and summaries
             passages.append(entry['passage'])
@@ -2151,19 +2692,26 @@ class TreeModel:
         # TODO memory and chat prepending - abstract this
         # TODO different behavior if not in submit box
         appended_text = self.pre_modifications(appended_text)
-        prompt = self.default_prompt(prompt_length=4000) + appended_text
+        prompt = self.default_prompt(self.selected_node, prompt_length=4000) + appended_text
         # print('prompt: ', prompt)
-        results, error = openAI_generate(prompt=prompt,
+        results, error = openAI_generate('openai',
+                                         prompt=prompt,
                                          length=1,  # TODO 3 or so
                                          num_continuations=1,
                                          temperature=0,
                                          logprobs=100,
                                          top_p=self.generation_settings['top_p'],
-                                         engine=engine
+                                         model=engine,
+                                         provider=provider_settings({'type': 'openai'},
+                                                                    OPENAI_API_KEY=self.OPENAI_API_KEY,
+                                                                    OPENAI_ORGANIZATION=self.OPENAI_ORGANIZATION)
                                          # TODO stop
                                          )
+        if error:
+            print(error)
+            return []
 
-        counterfactuals = results.choices[0]['logprobs']['top_logprobs'][0]
+        counterfactuals = results['choices'][0]['logprobs']['top_logprobs'][-1]
         sorted_counterfactuals = list(sorted(counterfactuals.items(), key=lambda item: item[1], reverse=True))
         return sorted_counterfactuals
 
@@ -2171,6 +2719,19 @@ class TreeModel:
         node = node if node else self.selected_node
         if not node:
             return
+        if node['id'] in self.prefetched:
+            children = self.reveal_prefetched(node)
+            if children:
+                if update_selection:
+                    self.select_node(children[0]["id"])
+                return
+            prefetch = self.prefetched.get(node['id'])
+            if prefetch and self.prefetch_matches(node, prefetch):
+                # still generating; its children are added when it's done (or generated then, if it fails)
+                prefetch.update(wanted=True, select=update_selection)
+                return
+            # made for a different prompt or settings
+            self.prefetched.pop(node['id'], None)
 
         children = []
         #grandchildren = []
@@ -2190,7 +2751,7 @@ class TreeModel:
         #self.reveal_nodes(children + grandchildren)
         prompt = self.prompt(node=node)
 
-        threading.Thread(target=self.default_generate, args=(prompt, children)).start()
+        self.default_generate(prompt, children)
 
         # After asking for the generation, set loading text
         for child in children:
@@ -2202,49 +2763,186 @@ class TreeModel:
         if update_selection:
             self.select_node(children[0]["id"])
 
+    # Generates children for each of nodes with as few requests as possible. Nodes are grouped by generation
+    # settings (settings(node) if given, else the tree's) and each group is sent as multi-prompt requests of up
+    # to the provider's batch size (see gpt.gen_batch_async). Each prompt's completions go to its own node's
+    # placeholder children, through post_generation. Returns the placeholders, {node id: children}
+    def generate_batch(self, nodes, settings=None, priority=BACKGROUND, placeholder="\n\n** Generating **"):
+        groups = {}
+        for node in nodes:
+            node_settings = settings(node) if settings else self.generation_settings
+            key = json.dumps(node_settings, sort_keys=True, default=str)
+            groups.setdefault(key, (node_settings, []))[1].append(node)
+
+        placeholders = {}
+        for node_settings, group in groups.values():
+            for node in group:
+                children = []
+                for _ in range(node_settings['num_continuations']):
+                    child = new_node(text=placeholder, mutable=False)
+                    child['open'] = True
+                    child['parent_id'] = node['id']
+                    node['children'].append(child)
+                    children.append(child)
+                self.invalidate_hashes(node)
+                placeholders[node['id']] = children
+        new_nodes = [child['id'] for children in placeholders.values() for child in children]
+        if not new_nodes:
+            return placeholders
+        # each prompt's completions come with their own <<NewNodes>>
+        self.new_nodes.extend([child['id'] for child in children] for children in placeholders.values() if children)
+        self.tree_updated(add=new_nodes)
+
+        # the prompts of a request are all echoed or not, so scored prefixes only save storage
+        for node_settings, group in groups.values():
+            child_lists = [placeholders[node['id']] for node in group]
+            prompts = [self.prompt(node=node) for node in group]
+            prefixes = [self.scored_prefix(node, prompt, node_settings['model'])
+                        if node_settings.get('echo', True) else None for node, prompt in zip(group, prompts)]
+            gen_batch_async(prompts, node_settings, self.model_config,
+                            callback=lambda index, results, error, child_lists=child_lists, prefixes=prefixes:
+                                self.post_generation(error, child_lists[index], results, prefixes[index]),
+                            priority=priority,
+                            cancelled=lambda index, child_lists=child_lists:
+                                not any(child['id'] in self.tree_node_dict for child in child_lists[index]),
+                            OPENAI_API_KEY=self.OPENAI_API_KEY,
+                            OPENAI_ORGANIZATION=self.OPENAI_ORGANIZATION,
+                            AI21_API_KEY=self.AI21_API_KEY,
+                            GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,)
+        return placeholders
+
     def generate_tree_init(self, node=None, max_depth=2, branching_factor=2, interval=50, stop_condition=None,
-                           temperature=1, engine='ada'):
+                           temperature=1, engine=None):
         node = node if node else self.selected_node
-        self.generate_tree(node, max_depth, branching_factor, interval, stop_condition, temperature, engine)
-        new_nodes = []
-        # while len(self.new_nodes) > 0:
-        #     print(self.new_nodes)
-        #     self.tree_updated(add=self.new_nodes[0])
-        #     #new_nodes += self.new_nodes[0]
-        #     del self.new_nodes[0]
-        # #self.tree_updated(add=new_nodes)
-
+        return self.generate_tree(node, max_depth, branching_factor, interval, stop_condition, temperature, engine)
+
+    # Expands the tree under node, generating branching_factor children for each frontier node
+    # The frontier is expanded level by level, or best first if score(node) is given (highest first), with up to
+    # max_concurrent nodes being expanded at once at background priority; the scheduler's provider limits also apply.
+    # The nodes taken from the frontier together are sent as multi-prompt requests (see gpt.gen_batch_async), one
+    # prompt per node. Nodes aren't expanded past max_depth or if stop_condition(node) is true, and no prompt is
+    # sent that could take the expansion over max_requests prompts or max_tokens generated tokens.
+    # Runs on the Tk loop and returns immediately with the expansion's state; see cancel_tree_generation
     def generate_tree(self, node=None, max_depth=3, branching_factor=2, interval=50, stop_condition=None,
-                      temperature=1, engine='ada'):
+                      temperature=1, engine=None, score=None, max_concurrent=16, max_requests=None, max_tokens=None,
+                      on_done=None):
         node = node if node else self.selected_node
-        print('generating children for node', node['id'])
-        if max_depth == 0 or (stop_condition and stop_condition(node)):
+        settings = {**self.generation_settings,
+                    'response_length': interval,
+                    'num_continuations': branching_factor,
+                    'temperature': temperature,
+                    'logprobs': 0}
+        if engine:
+            settings['model'] = engine
+        expansion = {'settings': settings, 'max_depth': max_depth, 'stop_condition': stop_condition,
+                     'score': score, 'max_concurrent': max_concurrent, 'max_requests': max_requests,
+                     'max_tokens': max_tokens, 'on_done': on_done,
+                     # heap of (key, sequence, node_id, depth)
+                     'frontier': [], 'sequence': 0,
+                     # [(future, [(node_id, depth)], scored prefixes)], one entry per gen_batch_async
+                     'in_flight': [],
+                     'requests': 0, 'tokens': 0, 'new_nodes': [], 'cancelled': False, 'done': False}
+        self.add_to_frontier(expansion, node, 0)
+        self.expand_frontier(expansion)
+        self.app.after(TREE_GENERATION_POLL_MS, lambda: self.poll_tree_generation(expansion))
+        return expansion
+
+    def cancel_tree_generation(self, expansion):
+        expansion['cancelled'] = True
+        sweep()
+
+    def add_to_frontier(self, expansion, node, depth):
+        key = -expansion['score'](node) if expansion['score'] else depth
+        heapq.heappush(expansion['frontier'], (key, expansion['sequence'], node['id'], depth))
+        expansion['sequence'] += 1
+
+    # tokens a request could generate
+    def tree_request_tokens(self, expansion):
+        return expansion['settings']['num_continuations'] * expansion['settings']['response_length']
+
+    # sends every frontier node the concurrency and budgets allow in one gen_batch_async
+    def expand_frontier(self, expansion):
+        frontier = expansion['frontier']
+        in_flight = sum(len(batch) for _, batch, _ in expansion['in_flight'])
+        batch = []
+        while frontier and not expansion['cancelled'] and in_flight + len(batch) < expansion['max_concurrent']:
+            if expansion['max_requests'] is not None and expansion['requests'] + len(batch) >= expansion['max_requests']:
+                break
+            reserved = (in_flight + len(batch) + 1) * self.tree_request_tokens(expansion)
+            if expansion['max_tokens'] is not None and expansion['tokens'] + reserved > expansion['max_tokens']:
+                break
+            _, _, node_id, depth = heapq.heappop(frontier)
+            node = self.node(node_id)
+            if not node or depth >= expansion['max_depth'] \
+                    or (expansion['stop_condition'] and expansion['stop_condition'](node)):
+                continue
+            batch.append((node_id, depth))
+        if not batch:
             return
-        prompt = self.default_prompt(quiet=False, node=node)
-        results, error = openAI_generate(prompt=prompt,
-                                         length=interval,
-                                         num_continuations=branching_factor,
-                                         temperature=temperature,
-                                         logprobs=0,
-                                         top_p=self.generation_settings['top_p'],
-                                         engine=engine
-                                         )
-        # create child nodes
+
+        settings = expansion['settings']
+        node_ids = [node_id for node_id, _ in batch]
+        nodes = [self.node(node_id) for node_id in node_ids]
+        prompts = [self.default_prompt(node) for node in nodes]
+        # the prompts of a request are all echoed or not, so scored prefixes only save storage
+        prefixes = [self.scored_prefix(node, prompt, settings['model']) if settings.get('echo', True) else None
+                    for node, prompt in zip(nodes, prompts)]
+        future = gen_batch_async(prompts, settings, self.model_config,
+                                 priority=BACKGROUND,
+                                 cancelled=lambda index: expansion['cancelled']
+                                     or node_ids[index] not in self.tree_node_dict,
+                                 OPENAI_API_KEY=self.OPENAI_API_KEY,
+                                 OPENAI_ORGANIZATION=self.OPENAI_ORGANIZATION,
+                                 AI21_API_KEY=self.AI21_API_KEY,
+                                 GOOSEAI_API_KEY=self.GOOSEAI_API_KEY,)
+        expansion['in_flight'].append((future, batch, prefixes))
+        expansion['requests'] += len(batch)
+
+    def poll_tree_generation(self, expansion):
+        still_in_flight = []
+        for request in expansion['in_flight']:
+            future, batch, prefixes = request
+            if not future.done():
+                still_in_flight.append(request)
+            elif not future.cancelled():
+                for (node_id, depth), prefix, (results, error) in zip(batch, prefixes, future.result()):
+                    # dropped before it was sent
+                    if error != 'cancelled':
+                        self.add_generated_children(expansion, node_id, depth, results, error, prefix)
+        expansion['in_flight'] = still_in_flight
+        self.expand_frontier(expansion)
+        if expansion['in_flight']:
+            self.app.after(TREE_GENERATION_POLL_MS, lambda: self.poll_tree_generation(expansion))
+        else:
+            expansion['done'] = True
+            print(f"tree generation finished: {expansion['requests']} prompts, {expansion['tokens']} tokens, "
+                  f"{len(expansion['new_nodes'])} new nodes")
+            if expansion['on_done']:
+                expansion['on_done'](expansion)
+
+    # prefix is the prompt's scored prefix, if any (see scored_prefix)
+    def add_generated_children(self, expansion, node_id, depth, results, error, prefix=None):
+        node = self.node(node_id)
+        if error or not results:
+            print(f'tree generation failed for node {node_id}: {error}')
+            return
+        expansion['tokens'] += sum(len(completion['tokens']) if completion.get('tokens') is not None
+                                   else len(completion['text']) // 4 for completion in results['completions'])
+        if not node:
+            return
+        self.store_response(results, prefix)
         children = []
-        for i in range(branching_factor):
-            child = self.create_child(node, update_selection=False, expand=True, refresh_nav=False)
+        for _ in results['completions']:
+            child = new_node()
+            child['open'] = True
+            child['parent_id'] = node['id']
+            node['children'].append(child)
             children.append(child)
-        # set child nodes
-        self.generated_nodes_metadata(children, results, prompt)
+        self.set_generated_nodes(children, results)
         self.tree_updated(add=[child['id'] for child in children])
-        # for each child node, branch again
+        expansion['new_nodes'].extend(child['id'] for child in children)
         for child in children:
-            # self.new_nodes.append(child['id'])
-            self.generate_tree(node=child, max_depth=max_depth - 1, branching_factor=branching_factor,
-                               interval=interval,
-                               stop_condition=stop_condition, temperature=temperature, engine=engine)
-
-        # TODO multi threading
+            self.add_to_frontier(expansion, child, depth + 1)
 
     def generate_adaptive_tree(self, node=None, max_depth=3, branching_factor=2, max_interval=100, algorithm='min',
                                min_interval=None, stop_condition=None):
@@ -2252,20 +2950,6 @@ class TreeModel:
 
         # TODO range
 
-    def semantic_search_memory(self, node, document_limit=100, max_length=1000):
-        documents = []
-
-        # join nodes that are too small
-        for ancestor in self.ancestry(node)[:-1]:
-            text = ancestor['text']
-            while len(text) > max_length:
-                documents.append(text[:max_length])
-                text = text[max_length:]
-            documents.append(text)
-        # documents.reverse()
-        query = node['text']
-        return search(query, documents)
-
     # modifications made to text submitted using input box
     # TODO split into pre and post user input modifications
     def submit_modifications(self, text):
@@ -2300,164 +2984,140 @@ class TreeModel:
         story = self.default_prompt(node=node, memory=False)
         return conditional_logprob(prompt=story + context_breaker, target=target, engine=engine)
 
+    # Optimization bits
+    #
+    # A node's text was chosen with some optimization power: selection (an AI node chosen from its competing
+    # siblings, log2(number of AI siblings) bits) and intervention (human written text, and the text edited into
+    # mixed nodes: the negative log2 probability of those tokens under the model).
+    # The whole path is scored at once (see score_path) and each node's tokens are sliced out of the result. Scores
+    # are cached per node and text of the path up to the end of the node, so measuring again only scores the nodes
+    # after the first one whose text (or whose ancestors' text) changed.
+
+    # prints the total bits of optimization of the path from root to node
     def measure_path_optimization(self, root, node):
-        #node = node if node else self.selected_node
-        #root = root if root else self.tree_raw_data["root"]
-        nodes_list = self.ancestry(node=node, root=root)
-
-        selection_bits = 0
-        intervention_bits = 0
-        total_tokens = 0
-        for n in nodes_list:
-            optimization_info = self.measure_node_optimization(node=n, quiet=True, final_node=node)
-            intervention_bits += optimization_info['intervention_bits']
-            selection_bits += optimization_info['selection_bits']
-            total_tokens += optimization_info['num_tokens']
+        infos = self.path_optimization(root, node)
+        intervention_bits = sum(info['intervention_bits'] for info in infos)
+        selection_bits = sum(info['selection_bits'] for info in infos)
+        total_tokens = sum(info['num_tokens'] for info in infos)
 
         print('intervention bits: {:.2f}'.format(intervention_bits))
         print('selection bits: {:.2f}'.format(selection_bits))
         total_bits = intervention_bits + selection_bits
         print('total bits: {:.2f}'.format(total_bits))
-        print(f'bits per token: {total_bits:.2f}/{total_tokens} =', '{:.2f}'.format(total_bits / total_tokens))
-
-    def measure_node_optimization(self, node=None, quiet=False, final_node=None):
-        node = node if node else self.selected_node
-        if 'meta' not in node:
-            print('error: no meta attribute')
-            return
-        has_intervention_optimization = False
-        has_selection_optimization = False
-        if node["meta"]["source"] == "AI":
-            # selection optimization
-            has_selection_optimization = True
-        elif node["meta"]["source"] == "mixed":
-            # selection and intervention optimization
-            has_selection_optimization = True
-            has_intervention_optimization = True
-        else:
-            # human-written node, intervention optimization only
-            has_intervention_optimization = True
-
-        node_tokens = None
-
-        if has_intervention_optimization:
-            tokens_logprobs, node_tokens = self.changed_tokens_logprobs(node)
-            if not quiet:
-                print('\nOPTIMIZATION FROM TOKENS INJECTED')
-                for token in tokens_logprobs:
-                    print(f"'{token['token']}'")
-                    print('logprob:', token['logprob'])
-                    prob = logprobs_to_probs(token['logprob'])
-                    print('prob:', prob)
-                    optimization_power = 1 / prob
-                    print('optimization power:', optimization_power)
-
-            intervention_logprob = sum(token['logprob'] for token in tokens_logprobs)
-            intervention_prob = logprobs_to_probs(intervention_logprob)
-            intervention_optimization_power = 1 / intervention_prob
-            intervention_bits = math.log2(intervention_optimization_power)
-
-            if not quiet:
-                print('\ntotal intervention logprob:', intervention_logprob)
-                print('total intervention optimization power:', intervention_optimization_power)
-                print(f'bits of intervention optimization: (log_2({intervention_optimization_power})) =',
-                      intervention_bits)
-                print(f'intervention bits per token: {intervention_bits}/{len(node_tokens)} =',
-                      intervention_bits / len(node_tokens))
-        else:
-            intervention_optimization_power = 1
-            intervention_bits = 0
-
-        if has_selection_optimization:
-            selection_optimization_power, selection_bits, node_tokens = self.selection_optimization(node=node,
-                                                                                                    final_node=final_node)
-            if not quiet:
-                print('\ntotal selection optimization power:', selection_optimization_power)
-                print(f'bits of selection optimization: (log_2({selection_optimization_power})) =',
-                      selection_bits)
-                print(f'selection bits per token: {selection_bits:.2f}/{len(node_tokens)} =',
-                      selection_bits / len(node_tokens))
-
-        else:
-            selection_optimization_power = 1
-            selection_bits = 0
-
-        if not node_tokens:
-            print('error, no node tokens')
-            return
-
-        optimization_info = {'intervention_power': intervention_optimization_power,
-                             'intervention_bits': intervention_bits,
-                             'selection_power': selection_optimization_power,
-                             'selection_bits': selection_bits,
-                             'num_tokens': len(node_tokens)}
+        print(f'bits per token: {total_bits:.2f}/{total_tokens} =', '{:.2f}'.format(total_bits / max(total_tokens, 1)))
 
-        return optimization_info
-
-        # TODO selection optimization
-
-    # TODO removed tokens
-    # TODO deprecated
-    def changed_tokens_logprobs(self, node=None):
+    def measure_node_optimization(self, node=None, quiet=False):
         node = node if node else self.selected_node
-        if 'meta' in node and 'source' in node['meta']:
-            if node["meta"]["source"] == "AI":
-                return [], None
-            if node["meta"]["source"] == "mixed":
-                try:
-                    original_tokens = node['meta']['diffs'][0]['diff']['old']
-                    current_tokens = node['meta']['diffs'][-1]['diff']['new']
-                except KeyError:
-                    return [], None
-                total_diff = diff(original_tokens, current_tokens)
-                # uses original prompt
-                prompt = node["meta"]["generation"]["prompt"] + node['text']
-                engine = node["meta"]["generation"]["model"].split(':')[0]
-                logprobs, tokens, positions = prompt_probs(prompt, engine)
-                corrected_positions = [p - len(node["meta"]["generation"]["prompt"]) for p in positions]
-                start = positions.index(len(node["meta"]["generation"]["prompt"]))
-                changed_indices = []
-                for word in total_diff['added']:
-                    start_index = word['indices'][0]
-                    token_index = corrected_positions.index(start_index)
-                    token_logprob = logprobs[token_index]
-                    token = tokens[token_index]
-                    changed_indices.append({'token': token, 'logprob': token_logprob, 'indices': word['indices']})
-                return changed_indices, tokens[start:]
-            elif node["meta"]["source"] == "prompt":
-                prompt = self.default_prompt(node=node, quiet=True, mode='default')
-                engine = self.generation_settings['model']
-                logprobs, tokens, positions = prompt_probs(prompt, engine)
-                start_index = positions.index(len(prompt) - len(node['text']))
-                index = start_index
-                changed_indices = []
-                for logprob in logprobs[start_index:]:
-                    changed_indices.append({'token': tokens[index], 'logprob': logprob})
-                    index += 1
-                return changed_indices, tokens[start_index:]
+        info = self.path_optimization(None, node)[-1]
+        if not quiet:
+            num_tokens = max(info['num_tokens'], 1)
+            print(f'bits of intervention optimization: {info["intervention_bits"]:.2f}')
+            print(f'intervention bits per token: {info["intervention_bits"]:.2f}/{num_tokens} =',
+                  '{:.2f}'.format(info['intervention_bits'] / num_tokens))
+            print(f'bits of selection optimization: (log_2({info["selection_power"]})) =', info['selection_bits'])
+            print(f'selection bits per token: {info["selection_bits"]:.2f}/{num_tokens} =',
+                  '{:.2f}'.format(info['selection_bits'] / num_tokens))
+        return info
+
+    # optimization info of each node from root (the tree's root if None) to node
+    def path_optimization(self, root, node, engine=None):
+        engine = engine if engine else self.generation_settings['model']
+        nodes = self.ancestry(node=node, root=root)
+        texts = [self.text(n) for n in nodes]
+        ends = np.cumsum([len(text) for text in texts], dtype=np.int64)
+        starts = ends - [len(text) for text in texts]
+
+        hasher = hashlib.sha256(engine.encode('utf-8'))
+        keys = []
+        for text in texts:
+            hasher.update(text.encode('utf-8'))
+            keys.append(hasher.copy().hexdigest())
+        missing = [i for i, key in enumerate(keys) if key not in self.path_scores]
+        if missing:
+            first = missing[0]
+            token_starts, token_ends, logprobs = self.score_path(''.join(texts), int(starts[first]), engine)
+            token_nodes = np.searchsorted(ends, token_starts, side='right')
+            for i in range(first, len(nodes)):
+                in_node = token_nodes == i
+                self.path_scores[keys[i]] = (token_starts[in_node] - starts[i], token_ends[in_node] - starts[i],
+                                             logprobs[in_node])
+
+        # tokens of every node, with the index of their node
+        scores = [self.path_scores[key] for key in keys]
+        token_nodes = np.repeat(np.arange(len(nodes)), [len(score[0]) for score in scores])
+        logprobs = np.concatenate([score[2] for score in scores]) if scores else np.array([])
+        intervened = np.concatenate([self.intervened_tokens(n, text, *score[:2])
+                                     for n, text, score in zip(nodes, texts, scores)]) if scores else np.array([])
+        num_tokens = np.bincount(token_nodes, minlength=len(nodes))
+        intervention_logprobs = np.bincount(token_nodes, weights=np.where(intervened, np.nan_to_num(logprobs), 0),
+                                            minlength=len(nodes))
+        intervention_bits = 0 - intervention_logprobs / math.log(2)
+        with np.errstate(over='ignore'):
+            intervention_power = np.exp2(intervention_bits)
+
+        infos = []
+        for i, n in enumerate(nodes):
+            selection_power = self.competing_siblings(n) if self.node_source(n) in ('AI', 'mixed') else 1
+            infos.append({'intervention_power': float(intervention_power[i]),
+                          'intervention_bits': float(intervention_bits[i]),
+                          'selection_power': selection_power,
+                          'selection_bits': math.log2(selection_power),
+                          'num_tokens': int(num_tokens[i])})
+        return infos
+
+    # (starts, ends, logprobs) of the tokens of text starting from start on, scored with engine
+    # text is scored in windows of at most PATH_SCORE_WINDOW characters: up to PATH_SCORE_CONTEXT characters of the
+    # text before the window as context, the window, and PATH_SCORE_MARGIN characters after it. A window keeps the
+    # tokens starting in it, which the margin keeps whole. The windows are scored together as batched requests
+    # (see gpt_util.prompts_probs)
+    # the first token's logprob is nan
+    def score_path(self, text, start, engine):
+        step = PATH_SCORE_WINDOW - PATH_SCORE_CONTEXT - PATH_SCORE_MARGIN
+        window_starts = list(range(start, len(text), step))
+        prompt_starts = [max(0, window_start - PATH_SCORE_CONTEXT) for window_start in window_starts]
+        prompts = [text[prompt_start:window_start + step + PATH_SCORE_MARGIN]
+                   for prompt_start, window_start in zip(prompt_starts, window_starts)]
+        token_starts, token_ends, token_logprobs = [], [], []
+        for (logprobs, tokens, positions), prompt_start, window_start in zip(prompts_probs(prompts, engine),
+                                                                               prompt_starts, window_starts):
+            positions = np.asarray(positions, dtype=np.int64) + prompt_start
+            # the window's tokens; those before it are context, those after it the next window's
+            keep = (positions >= window_start) & (positions < window_start + step)
+            token_starts.append(positions[keep])
+            token_ends.append(positions[keep] + np.array([len(token) for token in tokens], dtype=np.int64)[keep])
+            token_logprobs.append(np.array([np.nan if logprob is None else logprob for logprob in logprobs],
+                                           dtype=np.float64)[keep])
+        if not window_starts:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        return np.concatenate(token_starts), np.concatenate(token_ends), np.concatenate(token_logprobs)
+
+    def node_source(self, node):
+        return node.get('meta', {}).get('source', 'prompt')
+
+    # which of node's tokens (offsets in text) were written by a human: none for AI nodes, all for human nodes
+    # and, for mixed nodes, those overlapping text inserted or replaced since the node was generated
+    def intervened_tokens(self, node, text, starts, ends):
+        source = self.node_source(node)
+        if source == 'AI':
+            return np.zeros(len(starts), dtype=bool)
+        original = self.get_request_info(node)[2] if source == 'mixed' and 'generation' in node else None
+        if not original:
+            return np.ones(len(starts), dtype=bool)
+        # changed[i + 1] is 1 if character i was edited in, so its cumulative sum counts edited characters
+        changed = np.zeros(len(text) + 1, dtype=np.int64)
+        for tag, _, _, j1, j2 in difflib.SequenceMatcher(None, original['text'], text, autojunk=False).get_opcodes():
+            if tag in ('insert', 'replace'):
+                changed[j1 + 1:j2 + 1] = 1
+        edited = np.cumsum(changed)
+        return edited[np.clip(ends, 0, len(text))] > edited[np.clip(starts, 0, len(text))]
 
     # TODO count all AI siblings of current node regardless of order?
-    def selection_optimization(self, node, final_node=None):
-        final_node = final_node if final_node else self.selected_node
-        siblings = self.parent(node)["children"]
-        competing_siblings = 0
-        # this should include the node itself
-        for sibling in siblings:
-            if not ('meta' in sibling and 'source' in sibling['meta'] and sibling['meta']['source'] == 'prompt'):
-                competing_siblings += 1
-            # if 'meta' in sibling and 'source' in sibling['meta'] and sibling['meta']['source'] != 'prompt':
-            #     if created_before(sibling, final_node):
-            #         competing_siblings += 1
-
-        selection_optimization_power = competing_siblings
-        selection_bits = math.log2(selection_optimization_power)
-
-        if node["meta"]["source"] == 'AI':
-            tokens = node["meta"]["generation"]["logprobs"]["tokens"]
-        else:
-            tokens = node['meta']['diffs'][-1]['diff']['new'][0]
-
-        return selection_optimization_power, selection_bits, tokens
+    # siblings of node (including itself) that aren't human written
+    def competing_siblings(self, node):
+        parent = self.parent(node)
+        if not parent:
+            return 1
+        return max(sum(1 for sibling in parent['children'] if self.node_source(sibling) != 'prompt'), 1)
 
     def generate_greedy_multiverse(self, prompt=None, node=None, ground_truth=None, max_depth=3,
                                    unnormalized_amplitude=1, threshold=0.1, engine='ada'):
@@ -2478,14 +3138,107 @@ class TreeModel:
         return multiverse, ground_truth, prompt
 
 
+    # the response's prompt tokens include those stored with its scored prefix
     def get_request_info(self, node):
         model_response = self.model_responses.get(node['generation']['id'], False)
         if not model_response:
             return None, '', ''
+        if model_response['prompt'].get('prefix'):
+            model_response = dict(model_response,
+                                  prompt=dict(model_response['prompt'],
+                                              tokens=self.response_prompt_tokens(model_response)))
         prompt = model_response['prompt']['text']
         completion = model_response['completions'][node['generation']['index']]
         return model_response, prompt, completion
 
+    #################################
+    #   Prompt scoring
+    #################################
+
+    # With echo on, the prompt is scored: its tokens and their logprobs come back with the response. The prompt
+    # of a node's children mostly repeats the prompt of the response the node was generated in followed by the
+    # node's completion, which are already scored and stored in model_responses. Only the prompt tokens past that
+    # prefix are stored with the new response, whose prompt then has
+    #   'prefix': {'id': response id, 'index': completion index, 'length': characters the prefix covers}
+    # and response_prompt_tokens puts the whole prompt back together. If the prefix is the whole prompt, the
+    # prompt isn't echoed at all.
+
+    # (response id, completion index, prefix text) of the nearest generated node in node's ancestry (node included)
+    # whose response's prompt and completion begin prompt and are all scored, or None
+    def scored_prefix(self, node, prompt, model):
+        for ancestor in reversed(self.ancestry(node)):
+            if 'generation' not in ancestor:
+                continue
+            response = self.model_responses.get(ancestor['generation']['id'])
+            if not response or response.get('model') != model:
+                continue
+            index = ancestor['generation']['index']
+            completion = response['completions'][index]
+            text = response['prompt']['text'] + completion['text']
+            if completion.get('tokens') is not None and prompt.startswith(text) \
+                    and self.prompt_scored(response):
+                return response['id'], index, text
+        return None
+
+    # settings to generate from prompt in node with, and prompt's scored prefix; the prompt isn't echoed if the
+    # prefix is all of it
+    def echo_settings(self, node, prompt, settings):
+        if not settings.get('echo', True) or not node:
+            return settings, None
+        prefix = self.scored_prefix(node, prompt, settings['model'])
+        if prefix and prefix[2] == prompt:
+            settings = dict(settings, echo=False)
+        return settings, prefix
+
+    # adds results to model_responses, keeping only the prompt tokens past the scored prefix
+    def store_response(self, results, prefix=None):
+        prompt = results['prompt']
+        if prefix and prefix[0] in self.model_responses:
+            response_id, index, text = prefix
+            if prompt.get('tokens') is None:
+                prompt['tokens'] = TokenColumns([], [], [])
+                length = len(text)
+            else:
+                tokens = as_columns(prompt['tokens'])
+                # a token crossing the end of the prefix is kept, and the prefix ends where it starts
+                first = int(np.searchsorted(tokens.ends, len(text), side='right'))
+                length = int(tokens.starts[first]) if first < len(tokens) else len(text)
+                prompt['tokens'] = tokens.take(first)
+            prompt['prefix'] = {'id': response_id, 'index': index, 'length': length}
+        self.model_responses[results['id']] = results
+
+    # whether all of the response's prompt tokens are stored
+    def prompt_scored(self, response):
+        while response['prompt'].get('tokens') is not None:
+            prefix = response['prompt'].get('prefix')
+            if not prefix:
+                return True
+            response = self.model_responses.get(prefix['id'])
+            if not response:
+                return False
+        return False
+
+    # TokenColumns of the response's whole prompt, or None if it wasn't scored
+    # the beginning is missing if a prefix response is gone (see prompt_scored)
+    def response_prompt_tokens(self, response):
+        prompt = response['prompt']
+        if prompt.get('tokens') is None:
+            return None
+        parts = [as_columns(prompt['tokens'])]
+        # offsets are from the start of the prompt, which every prompt in the chain shares
+        length = len(prompt['text'])
+        while prompt.get('prefix'):
+            prefix = prompt['prefix']
+            response = self.model_responses.get(prefix['id'])
+            if not response or response['prompt'].get('tokens') is None:
+                break
+            length = min(length, prefix['length'])
+            prompt = response['prompt']
+            for tokens in (response['completions'][prefix['index']]['tokens'], prompt['tokens']):
+                tokens = as_columns(tokens)
+                parts.append(tokens.take(0, int(np.searchsorted(tokens.starts, length))))
+        return concat_columns(reversed(parts))
+
 
     #################################
     #   Cleaning
@@ -2512,6 +3265,7 @@ class TreeModel:
             self.tree_raw_data['chapters'] = {}
         if 'meta' in root:
             root.pop('meta')
+            self.invalidate_hashes(root)
         # if delete_chapters and 'chapter_id' in root:
         #     root.pop('chapter_id')
         for child in root['children']:
@@ -2523,6 +3277,7 @@ class TreeModel:
         if 'meta' in root and 'generation' in root['meta']:
             print('clearing generation data')
             root['meta'].pop('generation')
+            self.invalidate_hashes(root)
         for child in root['children']:
             self.clear_old_generation_metadata(child)
 
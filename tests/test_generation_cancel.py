@@ -0,0 +1,88 @@
+import queue
+import time
+import unittest
+
+from model import TreeModel
+from util.gen_engine import get_engine
+
+
+# stands in for the Tk root: events generated from the engine's threads are handled when pump() is called,
+# like the Tk loop handles them
+class App:
+    def __init__(self):
+        self.handlers = {}
+        self.events = queue.Queue()
+
+    def bind(self, sequence, handler):
+        self.handlers[sequence] = handler
+
+    def after(self, ms, func):
+        pass
+
+    def event_generate(self, sequence, **kwargs):
+        self.events.put(sequence)
+
+    def pump(self, until, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not until():
+            if time.monotonic() > deadline:
+                raise AssertionError('timed out waiting for generations')
+            try:
+                sequence = self.events.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if sequence in self.handlers:
+                self.handlers[sequence](None)
+
+
+class GenerationCancelTest(unittest.TestCase):
+    def setUp(self):
+        self.app = App()
+        self.model = TreeModel(self.app)
+        self.model.load_tree_data({'root': {'id': 'root', 'text': 'Once upon a time',
+                                            'children': [{'id': 'a', 'text': ' there was', 'children': []},
+                                                         {'id': 'b', 'text': ' there were', 'children': []}]}})
+        self.model.update_user_frame({
+            'model_config': {'models': {'mock': {'type': 'mock', 'latency': 0.3, 'tokens_per_second': 10000}}},
+            'generation_settings': {'model': 'mock', 'num_continuations': 2, 'response_length': 5},
+            'preferences': {'stream_generations': False, 'cancel_abandoned_generations': True},
+        })
+        # one request at a time, so the second generation waits in the queue
+        scheduler = get_engine().scheduler
+        self.limit = scheduler.limits.get('mock')
+        scheduler.set_limit('mock', 1)
+
+    def tearDown(self):
+        scheduler = get_engine().scheduler
+        if self.limit is None:
+            scheduler.limits.pop('mock', None)
+        else:
+            scheduler.set_limit('mock', self.limit)
+
+    def generated(self, node_id):
+        children = self.model.node(node_id)['children']
+        return bool(children) and all('generation' in child and child['mutable'] for child in children)
+
+    def test_generate_after_cancelled_generation(self):
+        model = self.model
+        model.select_node('a')
+        model.generate_continuations(model.node('a'))
+        # navigating away from a before its request starts would cancel it too
+        self.app.pump(lambda: sum(get_engine().scheduler.active.values()) == 1)
+        model.select_node('b')
+        model.generate_continuations(model.node('b'))
+        # navigating away from b abandons its generation while it's still queued behind a's
+        model.select_node('a')
+        self.app.pump(lambda: self.generated('a') and not model.node('b')['children'])
+        self.assertEqual(model.new_nodes, [])
+
+        model.select_node('b')
+        model.generate_continuations(model.node('b'))
+        self.app.pump(lambda: self.generated('b'))
+        self.assertEqual(len(model.node('b')['children']), 2)
+        self.assertEqual(len(model.node('a')['children']), 2)
+        self.assertEqual(model.new_nodes, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
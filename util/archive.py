@@ -0,0 +1,306 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import weakref
+from collections.abc import Mapping, MutableMapping
+from util.util_tree import walk_subtree, add_immutable_root
+from util.token_columns import json_default
+from util.tree_hash import HASH_ATTRIBUTE
+
+# Read-only tree archives
+#
+# A tree json is preprocessed once into a single file which is then memory mapped, so opening an
+# archive costs no parsing and pages are shared between every tab (and process) that has it open.
+#
+# Layout (little endian):
+#   header      MAGIC, then node_count, table_offset, children_offset, index_offset, heap_offset,
+#               globals_offset, globals_length, reserved (8 x uint64)
+#   node table  node_count fixed width records, in preorder (root is record 0):
+#               parent (int32, -1 for root), children_start, num_children (uint32, into children array),
+#               then (offset uint64, length uint32) into the heap for id, text and other attributes (json)
+#   children    uint32 node indices, each node's children stored contiguously
+#   id index    (blake2b-64 of id, node index) pairs sorted by hash
+#   heap        utf-8 ids, texts and attribute json
+#   globals     json of everything in the tree except root (chapters, tags, settings, ...)
+
+ARCHIVE_EXTENSION = '.loomarc'
+MAGIC = b'LOOMARC\x01'
+HEADER = struct.Struct('<8Q')
+RECORD = struct.Struct('<iIIQIQIQI')
+CHILD = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<QI')
+
+# attributes stored in the record itself rather than the attribute json
+CORE_ATTRIBUTES = ('id', 'text', 'children', 'parent_id')
+# not stored at all
+SKIPPED_ATTRIBUTES = (HASH_ATTRIBUTE,)
+
+
+def id_hash(node_id):
+    return int.from_bytes(hashlib.blake2b(node_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def archive_filename(filename):
+    return os.path.splitext(filename)[0] + ARCHIVE_EXTENSION
+
+
+def is_archive(filename):
+    return filename.endswith(ARCHIVE_EXTENSION)
+
+
+#################################
+#   Writing
+#################################
+
+def build_archive(tree, filename):
+    add_immutable_root(tree)
+    nodes = [node for node, _ in walk_subtree(tree['root'])]
+    node_indices = {id(node): i for i, node in enumerate(nodes)}
+    node_count = len(nodes)
+    num_children = sum(len(node['children']) for node in nodes)
+
+    table_offset = len(MAGIC) + HEADER.size
+    children_offset = table_offset + node_count * RECORD.size
+    index_offset = children_offset + num_children * CHILD.size
+    heap_offset = index_offset + node_count * INDEX_ENTRY.size
+
+    records = []
+    with open(filename, 'wb') as f:
+        f.seek(children_offset)
+        child_position = 0
+        for node in nodes:
+            for child in node['children']:
+                f.write(CHILD.pack(node_indices[id(child)]))
+        index = sorted((id_hash(node['id']), i) for i, node in enumerate(nodes))
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+
+        position = heap_offset
+        for i, node in enumerate(nodes):
+            spans = []
+            attributes = {k: v for k, v in node.items() if k not in CORE_ATTRIBUTES and k not in SKIPPED_ATTRIBUTES}
+            for data in (node['id'], node.get('text', ''), json.dumps(attributes) if attributes else ''):
+                data = data.encode('utf-8')
+                f.write(data)
+                spans.extend((position, len(data)))
+                position += len(data)
+            records.append((child_position, len(node['children']), *spans))
+            child_position += len(node['children'])
+
+        globals_data = json.dumps({k: v for k, v in tree.items() if k != 'root'}, default=json_default).encode('utf-8')
+        globals_offset = position
+        f.write(globals_data)
+
+        # parents are known once every node has an index
+        parents = [-1] * node_count
+        for i, node in enumerate(nodes):
+            for child in node['children']:
+                parents[node_indices[id(child)]] = i
+        f.seek(table_offset)
+        for i, record in enumerate(records):
+            f.write(RECORD.pack(parents[i], *record))
+
+        f.seek(0)
+        f.write(MAGIC)
+        f.write(HEADER.pack(node_count, table_offset, children_offset, index_offset, heap_offset,
+                            globals_offset, len(globals_data), 0))
+    return node_count
+
+
+def build_archive_from_json(json_filename, filename=None):
+    filename = filename if filename else archive_filename(json_filename)
+    with open(json_filename) as f:
+        tree = json.load(f)
+    build_archive(tree, filename)
+    return filename
+
+
+#################################
+#   Reading
+#################################
+
+class TreeArchive:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{filename} is not a tree archive')
+        self.node_count, self.table_offset, self.children_offset, self.index_offset, self.heap_offset, \
+            self.globals_offset, self.globals_length, _ = HEADER.unpack_from(self.map, len(MAGIC))
+        # session only state (open, visited, ...) set on nodes, {index: {attribute: value}}
+        self.overlay = {}
+        self._nodes = weakref.WeakValueDictionary()
+
+    def close(self):
+        if self.map is not None and not self.map.closed:
+            self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.node_count
+
+    def record(self, index):
+        return RECORD.unpack_from(self.map, self.table_offset + index * RECORD.size)
+
+    def _heap_string(self, offset, length):
+        return self.map[offset:offset + length].decode('utf-8')
+
+    def node_id(self, index):
+        record = self.record(index)
+        return self._heap_string(record[3], record[4])
+
+    def text(self, index):
+        record = self.record(index)
+        return self._heap_string(record[5], record[6])
+
+    def attributes(self, index):
+        record = self.record(index)
+        return json.loads(self._heap_string(record[7], record[8])) if record[8] else {}
+
+    def parent_index(self, index):
+        parent = self.record(index)[0]
+        return parent if parent >= 0 else None
+
+    def children_indices(self, index):
+        record = self.record(index)
+        start = self.children_offset + record[1] * CHILD.size
+        return [i for (i,) in CHILD.iter_unpack(self.map[start:start + record[2] * CHILD.size])]
+
+    def index(self, node_id):
+        # binary search over the sorted hash index, then check ids of entries with equal hashes
+        target = id_hash(node_id)
+        entry_at = lambda i: INDEX_ENTRY.unpack_from(self.map, self.index_offset + i * INDEX_ENTRY.size)
+        lo, hi = 0, self.node_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entry_at(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.node_count:
+            entry_hash, index = entry_at(lo)
+            if entry_hash != target:
+                break
+            if self.node_id(index) == node_id:
+                return index
+            lo += 1
+        return None
+
+    def node(self, index):
+        node = self._nodes.get(index)
+        if node is None:
+            node = ArchiveNode(self, index)
+            self._nodes[index] = node
+        return node
+
+    def root(self):
+        return self.node(0)
+
+    def globals(self):
+        return json.loads(self._heap_string(self.globals_offset, self.globals_length))
+
+    def tree_data(self):
+        tree = self.globals()
+        tree['root'] = self.root()
+        return tree
+
+    def node_dict(self):
+        return ArchiveNodeDict(self)
+
+
+# Read-only dict view of an archived node
+# Assignments go to the archive's session overlay and are never written to disk
+class ArchiveNode(MutableMapping):
+    __slots__ = ('archive', 'index', '_attributes', '__weakref__')
+
+    def __init__(self, archive, index):
+        self.archive = archive
+        self.index = index
+        self._attributes = None
+
+    def _other_attributes(self):
+        if self._attributes is None:
+            self._attributes = self.archive.attributes(self.index)
+            # archived nodes can't be edited
+            self._attributes['mutable'] = False
+        return self._attributes
+
+    def _overlay(self):
+        return self.archive.overlay.get(self.index, {})
+
+    def __getitem__(self, key):
+        overlay = self._overlay()
+        if key in overlay:
+            return overlay[key]
+        if key == 'id':
+            return self.archive.node_id(self.index)
+        if key == 'text':
+            return self.archive.text(self.index)
+        if key == 'children':
+            return [self.archive.node(i) for i in self.archive.children_indices(self.index)]
+        if key == 'parent_id':
+            parent = self.archive.parent_index(self.index)
+            if parent is None:
+                raise KeyError(key)
+            return self.archive.node_id(parent)
+        return self._other_attributes()[key]
+
+    def __contains__(self, key):
+        if key in ('id', 'text', 'children') or key in self._overlay():
+            return True
+        if key == 'parent_id':
+            return self.index != 0
+        return key in self._other_attributes()
+
+    def __setitem__(self, key, value):
+        self.archive.overlay.setdefault(self.index, {})[key] = value
+
+    def __delitem__(self, key):
+        del self.archive.overlay[self.index][key]
+
+    def __iter__(self):
+        keys = ['id', 'text', 'children'] + (['parent_id'] if self.index != 0 else [])
+        keys += [k for k in self._other_attributes() if k not in keys]
+        keys += [k for k in self._overlay() if k not in keys]
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return isinstance(other, ArchiveNode) and other.archive is self.archive and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.archive), self.index))
+
+    def __repr__(self):
+        return f'ArchiveNode({self.index})'
+
+
+# {node_id: node} view over an archive, standing in for tree_node_dict
+class ArchiveNodeDict(Mapping):
+    def __init__(self, archive):
+        self.archive = archive
+
+    def __getitem__(self, node_id):
+        index = self.archive.index(node_id) if isinstance(node_id, str) else None
+        if index is None:
+            raise KeyError(node_id)
+        return self.archive.node(index)
+
+    def __contains__(self, node_id):
+        return isinstance(node_id, str) and self.archive.index(node_id) is not None
+
+    def __iter__(self):
+        for i in range(len(self.archive)):
+            yield self.archive.node_id(i)
+
+    def __len__(self):
+        return len(self.archive)
+
+    def values(self):
+        return (self.archive.node(i) for i in range(len(self.archive)))
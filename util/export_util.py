@@ -0,0 +1,185 @@
+import gzip
+import json
+import random
+import jsonlines
+from util.util_tree import walk_subtree, filtered_children
+from util.token_columns import json_default
+from util.tree_hash import HASH_ATTRIBUTE
+
+# Streaming exporters. Records are produced by walking the subtree with a generator and written
+# to the file handle as they go, so exporting a huge tree never materializes a copy of it.
+
+
+# accepts either a full tree (with 'root') or a node
+def export_root(tree):
+    return tree['root'] if 'root' in tree else tree
+
+
+def open_export(filename, compress=None):
+    # gzip if requested, or if the filename says so
+    if compress is None:
+        compress = filename.endswith('.gz')
+    if compress:
+        return gzip.open(filename, 'wt', encoding='utf-8')
+    return open(filename, 'w', encoding='utf-8')
+
+
+#################################
+#   Records
+#################################
+
+# {id, text, parent_id}
+def jsonl_records(root, filter=None):
+    for node, depth in walk_subtree(root, filter):
+        record = {'id': node['id']}
+        if 'text' in node:
+            record['text'] = node['text']
+        # the export root's parent is not part of the export
+        if depth > 0 and 'parent_id' in node:
+            record['parent_id'] = node['parent_id']
+        yield record
+
+
+# {id, text, parentId, hasChildren, tags}
+def flat_records(root, filter=None):
+    for node, depth in walk_subtree(root, filter):
+        record = {'id': node['id']}
+        if 'text' in node:
+            record['text'] = node['text']
+        if depth > 0 and 'parent_id' in node:
+            record['parentId'] = node['parent_id']
+        if filtered_children(node, filter):
+            record['hasChildren'] = True
+        record['tags'] = node.get('tags') or []
+        yield record
+
+
+def simple_node_fields(node):
+    return {'text': node.get('text', '')}
+
+
+def copy_node_fields(copy_attributes=None):
+    # copies all attributes except the tree structure (and cached hashes) if copy_attributes is None
+    def _fields(node):
+        if copy_attributes is None:
+            return {k: v for k, v in node.items() if k not in ('children', 'parent_id', HASH_ATTRIBUTE)}
+        fields = {'id': node['id']}
+        for attribute in copy_attributes:
+            if attribute in node:
+                fields[attribute] = node[attribute]
+        return fields
+    return _fields
+
+
+#################################
+#   Writers
+#################################
+
+def write_jsonl(f, records):
+    writer = jsonlines.Writer(f)
+    count = 0
+    for record in records:
+        writer.write(record)
+        count += 1
+    return count
+
+
+def write_flat(f, records):
+    f.write('[')
+    count = 0
+    for record in records:
+        f.write(',\n\t' if count else '\n\t')
+        f.write(json.dumps(record))
+        count += 1
+    f.write('\n]\n')
+    return count
+
+
+def _open_nested_node(node_fields, node):
+    fields = ''.join(f'{json.dumps(k)}: {json.dumps(v)}, ' for k, v in node_fields(node).items())
+    return '{' + fields + '"children": ['
+
+
+# writes {...fields, "children": [...]} recursively, keeping one child iterator per level on an explicit stack
+def write_nested(f, root, node_fields=simple_node_fields, filter=None):
+    f.write(_open_nested_node(node_fields, root))
+    count = 1
+    # [children iterator, is first child]
+    stack = [[iter(filtered_children(root, filter)), True]]
+    while stack:
+        frame = stack[-1]
+        child = next(frame[0], None)
+        if child is None:
+            f.write(']}')
+            stack.pop()
+            continue
+        if not frame[1]:
+            f.write(', ')
+        frame[1] = False
+        f.write(_open_nested_node(node_fields, child))
+        count += 1
+        stack.append([iter(filtered_children(child, filter)), True])
+    return count
+
+
+# loom json: {"root": {...}, **extras}
+def write_tree(f, root, node_fields, filter=None, extras=None):
+    f.write('{"root": ')
+    count = write_nested(f, root, node_fields, filter)
+    for key, value in (extras or {}).items():
+        f.write(f', {json.dumps(key)}: {json.dumps(value, default=json_default)}')
+    f.write('}\n')
+    return count
+
+
+#################################
+#   Paths
+#################################
+
+# Walks the subtree once, keeping the current root-to-node path as a stack of text pieces.
+# Yields (path_nodes, path_texts) at every endpoint. Endpoints default to leaves of the filtered tree.
+# The yielded lists are the live stacks - consumers must not hold on to them.
+def _walk_paths(root, text_callback=None, filter=None, endpoint=None, max_paths=None, sample=None, seed=None):
+    rng = random.Random(seed)
+    path_nodes = []
+    path_texts = []
+    num_paths = 0
+    for node, depth in walk_subtree(root, filter):
+        del path_nodes[depth:]
+        del path_texts[depth:]
+        path_nodes.append(node)
+        path_texts.append(text_callback(node) if text_callback else node['text'])
+        is_endpoint = endpoint(node) if endpoint else not filtered_children(node, filter)
+        if not is_endpoint or (sample is not None and rng.random() >= sample):
+            continue
+        yield path_nodes, path_texts
+        num_paths += 1
+        if max_paths is not None and num_paths >= max_paths:
+            return
+
+
+# {id, text} per path, where text is the full path text
+def path_text_records(root, **kwargs):
+    for path_nodes, path_texts in _walk_paths(root, **kwargs):
+        yield {'id': path_nodes[-1]['id'], 'text': ''.join(path_texts)}
+
+
+# Prefix-sharing encoding: every node on an emitted path is written once as
+# {type: node, index, parent, id, text}, parent being the index of the previous node on the path,
+# and every path as {type: path, leaf, length}. A path is recovered by following parent indices from leaf.
+# Since the walk is depth first, only the emitted nodes on the current path need to be remembered.
+def prefix_path_records(root, **kwargs):
+    # [(node, index)] for the emitted prefix of the current path
+    emitted = []
+    next_index = 0
+    for path_nodes, path_texts in _walk_paths(root, **kwargs):
+        shared = 0
+        while shared < min(len(emitted), len(path_nodes)) and emitted[shared][0] is path_nodes[shared]:
+            shared += 1
+        del emitted[shared:]
+        for node, text in zip(path_nodes[shared:], path_texts[shared:]):
+            parent_index = emitted[-1][1] if emitted else None
+            yield {'type': 'node', 'index': next_index, 'parent': parent_index, 'id': node['id'], 'text': text}
+            emitted.append((node, next_index))
+            next_index += 1
+        yield {'type': 'path', 'leaf': emitted[-1][1], 'length': len(path_nodes)}
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from util.scheduler import GenerationScheduler, INTERACTIVE
+from util.rate_limit import RateLimiter
+from util.single_flight import SingleFlight
+from util.telemetry import Telemetry, first_byte
+
+# Generation engine
+#
+# One asyncio event loop, running on a background thread, makes every request to the model providers.
+# Each provider gets a keep-alive connection pool (an aiohttp session), so concurrent generations share
+# connections instead of each starting a thread and a TLS handshake.
+#
+# Coroutines are submitted from any thread with submit, which returns a concurrent.futures.Future.
+# Callbacks run on a separate callback thread, never on the event loop: they usually touch the UI, and the
+# UI thread may itself be waiting on the loop.
+#
+# Requests go through a GenerationScheduler (see util/scheduler.py), which caps concurrency per provider,
+# and a RateLimiter (see util/rate_limit.py), which keeps them under the provider's rate limits. Identical
+# requests made while one is in flight can share it through the engine's SingleFlight (see util/single_flight.py).
+# Metrics of every request are kept in the engine's Telemetry (see util/telemetry.py).
+
+# connections kept per provider
+POOL_SIZE = 16
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 300
+
+
+class ProviderError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f'Bad status code {status}: {message}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+class GenerationEngine:
+    def __init__(self, pool_size=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT, timeout=REQUEST_TIMEOUT):
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        # {provider: aiohttp.ClientSession}, only used from the loop
+        self.sessions = {}
+        self.scheduler = GenerationScheduler()
+        self.rate_limiter = RateLimiter()
+        self.flights = SingleFlight()
+        self.telemetry = Telemetry()
+        self.loop = asyncio.new_event_loop()
+        self.callback_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generation-callbacks')
+        self.thread = threading.Thread(target=self._run, name='generation-engine', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # runs coro on the engine's loop
+    # callback(future) is called on the callback thread once it's done
+    def submit(self, coro, callback=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback:
+            future.add_done_callback(lambda f: self.callback_executor.submit(callback, f))
+        return future
+
+    # thread safe views of the scheduler
+    def queue_stats(self):
+        return dict(self.call(self.scheduler.stats), rate_limits=self.call(self.rate_limiter.stats),
+                    coalescing=self.call(self.flights.stats))
+
+    def sweep(self):
+        self.loop.call_soon_threadsafe(self.scheduler.sweep)
+
+    # calls func on the loop and returns its result
+    def call(self, func, *args):
+        async def wrapper():
+            return func(*args)
+        return self.submit(wrapper()).result()
+
+    # Blocking: calls request() on a worker thread once the scheduler gives provider a slot and returns its result
+    # calls with the same key share one request while it's in flight. Don't call from the loop
+    def run_blocking(self, request, key, provider, priority=INTERACTIVE):
+        async def run(cancelled, on_text):
+            return await self.scheduler.run(lambda: self.loop.run_in_executor(None, request), provider,
+                                            priority=priority)
+        return self.submit(self.flights.run(key, run)).result()
+
+    def session(self, provider):
+        session = self.sessions.get(provider)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector,
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.sessions[provider] = session
+        return session
+
+    # POSTs json through the provider's pool and returns the decoded response
+    # raises ProviderError if the status isn't 200
+    async def post_json(self, provider, url, body, headers=None):
+        async with self.session(provider).post(url, json=body, headers=headers) as response:
+            first_byte()
+            if response.status != 200:
+                raise ProviderError(response.status, await response.text(), response.headers.get('Retry-After'))
+            return await response.json(content_type=None)
+
+    # POSTs json and yields each event of the server-sent event stream in response, decoded, until [DONE]
+    async def post_stream(self, provider, url, body, headers=None):
+        async with self.session(provider).post(url, json=body, headers=headers) as response:
+            first_byte()
+            if response.status != 200:
+                raise ProviderError(response.status, await response.text(), response.headers.get('Retry-After'))
+            async for line in response.content:
+                line = line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                yield json.loads(data)
+
+    async def _close_sessions(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close_sessions(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.callback_executor.shutdown(wait=False)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+# the shared engine, started on first use
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = GenerationEngine()
+        return _engine
+
+
+# drops queued requests that have been cancelled, if the engine is running
+def sweep():
+    if _engine is not None:
+        _engine.sweep()
@@ -1,86 +1,143 @@
-import openai
 import numpy as np
 import math
+import bisect
 import codecs
+from concurrent.futures import ThreadPoolExecutor
 from util.tokenizer import logit_mask
+from util.response_cache import cached
+from util.openai_client import default_client, coalesced
+from util import logprobs as lp
+
+# prompts per multi-prompt scoring request
+SCORE_BATCH = 20
 
 
 def normalize(probs):
-    return [float(i) / sum(probs) for i in probs]
+    return lp.normalize(probs).tolist()
 
 
 def logprobs_to_probs(probs):
     if isinstance(probs, list):
-        return [math.exp(x) for x in probs]
+        return np.exp(lp.as_logprobs(probs)).tolist()
     else:
         return math.exp(probs)
 
 
 def dict_logprobs_to_probs(prob_dict):
-    return {key: math.exp(prob_dict[key]) for key in prob_dict.keys()}
+    return dict(zip(prob_dict.keys(), np.exp(lp.as_logprobs(prob_dict.values())).tolist()))
 
 
 def total_logprob(response):
-    logprobs = response['logprobs']['token_logprobs']
-    logprobs = [i for i in logprobs if not math.isnan(i)]
-    return sum(logprobs)
+    logprobs = np.array(response['logprobs']['token_logprobs'], dtype=np.float64)
+    return float(np.nansum(logprobs))
+
+
+# completion request with client (by default the OpenAI api with credentials from the environment)
+# deterministic requests are served from the response cache unless bypass_cache (see util/response_cache.py)
+# others are scheduled with generations, sharing identical requests in flight (see openai_client.coalesced)
+def completion(engine, prompt, bypass_cache=False, client=None, **params):
+    client = client if client else default_client()
+    request = lambda: client.completion(model=engine, prompt=prompt, **params)
+    return cached(lambda: coalesced(request, client, engine, prompt, params), engine, prompt,
+                  dict(params, api_base=client.api_base), bypass=bypass_cache)
 
 
-def tokenize_ada(prompt):
-    response = openai.Completion.create(
+def tokenize_ada(prompt, bypass_cache=False):
+    response = completion(
         engine='ada',
         prompt=prompt,
         max_tokens=0,
         echo=True,
         n=1,
-        logprobs=0
+        logprobs=0,
+        bypass_cache=bypass_cache
     )
-    tokens = response.choices[0]["logprobs"]["tokens"]
-    positions = response.choices[0]["logprobs"]["text_offset"]
+    tokens = response['choices'][0]["logprobs"]["tokens"]
+    positions = response['choices'][0]["logprobs"]["text_offset"]
     return tokens, positions
 
 
-def prompt_probs(prompt, engine='ada'):
-    response = openai.Completion.create(
+def prompt_probs(prompt, engine='ada', bypass_cache=False):
+    response = completion(
         engine=engine,
         prompt=prompt,
         max_tokens=0,
         echo=True,
         n=1,
-        logprobs=0
+        logprobs=0,
+        bypass_cache=bypass_cache
     )
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    tokens = response.choices[0]["logprobs"]["tokens"]
-    logprobs = response.choices[0]["logprobs"]["token_logprobs"]
+    positions = response['choices'][0]["logprobs"]["text_offset"]
+    tokens = response['choices'][0]["logprobs"]["tokens"]
+    logprobs = response['choices'][0]["logprobs"]["token_logprobs"]
     return logprobs, tokens, positions
 
-# evaluates logL(prompt+target | prompt)
-def conditional_logprob(prompt, target, engine='ada'):
-    combined = prompt + target
-    response = openai.Completion.create(
-        engine=engine,
-        prompt=combined,
-        max_tokens=0,
-        echo=True,
-        n=1,
-        logprobs=0
-    )
-    positions = response.choices[0]["logprobs"]["text_offset"]
-    logprobs = response.choices[0]["logprobs"]["token_logprobs"]
-    word_index = positions.index(len(prompt))
-    total_conditional_logprob = sum(logprobs[word_index:])
-    return total_conditional_logprob
-
+# sum of an echoed choice's logprobs from the token containing offset on
+def echoed_logprob(choice, offset):
+    positions = choice["logprobs"]["text_offset"]
+    logprobs = choice["logprobs"]["token_logprobs"]
+    start = max(bisect.bisect_right(positions, offset) - 1, 0)
+    return sum(logprob for logprob in logprobs[start:] if logprob is not None)
 
 
-# TODO use threading
-# returns the conditional probabilities for each event happening after prompt
+# evaluates logL(prompt+target | prompt)
+def conditional_logprob(prompt, target, engine='ada', bypass_cache=False):
+    return conditional_logprobs([(prompt, target)], engine, bypass_cache)[0]
+
+
+# echoed choice of each of prompts
+# prompts are scored SCORE_BATCH at a time in multi-prompt requests, which are made concurrently
+# on_choice(index, choice) is called (from the requesting thread) for each prompt as its batch's response arrives
+def echo_choices(prompts, engine='ada', bypass_cache=False, on_choice=None):
+    choices = [None] * len(prompts)
+
+    def score(start):
+        response = completion(
+            engine=engine,
+            prompt=prompts[start:start + SCORE_BATCH],
+            max_tokens=0,
+            echo=True,
+            n=1,
+            logprobs=0,
+            bypass_cache=bypass_cache
+        )
+        for i, choice in enumerate(sorted(response['choices'], key=lambda choice: choice['index']), start):
+            choices[i] = choice
+            if on_choice:
+                on_choice(i, choice)
+
+    starts = range(0, len(prompts), SCORE_BATCH)
+    if len(starts) == 1:
+        score(0)
+    elif starts:
+        with ThreadPoolExecutor(max_workers=len(starts)) as executor:
+            list(executor.map(score, starts))
+    return choices
+
+
+# prompt_probs of each of prompts, scored in batches (see echo_choices)
+def prompts_probs(prompts, engine='ada', bypass_cache=False):
+    return [(choice["logprobs"]["token_logprobs"], choice["logprobs"]["tokens"], choice["logprobs"]["text_offset"])
+            for choice in echo_choices(prompts, engine, bypass_cache)]
+
+
+# evaluates logL(prompt+target | prompt) for each (prompt, target) in pairs, scored in batches (see echo_choices)
+# on_scored(index, logprob) is called (from the requesting thread) for each pair as its batch's response arrives
+def conditional_logprobs(pairs, engine='ada', bypass_cache=False, on_scored=None):
+    logprobs = [None] * len(pairs)
+
+    def scored(i, choice):
+        logprobs[i] = echoed_logprob(choice, len(pairs[i][0]))
+        if on_scored:
+            on_scored(i, logprobs[i])
+
+    echo_choices([prompt + target for prompt, target in pairs], engine, bypass_cache, on_choice=scored)
+    return logprobs
+
+
+# returns the conditional probabilities for each event happening after prompt, unnormalized and normalized
 def event_probs(prompt, events, engine='ada'):
-    probs = []
-    for event in events:
-        logprob = conditional_logprob(prompt, event, engine)
-        probs.append(logprobs_to_probs(logprob))
-
+    probs = logprobs_to_probs(conditional_logprobs([(prompt, event) for event in events], engine))
     normal_probs = normalize(probs)
     return probs, normal_probs
 
@@ -95,56 +152,55 @@ def token_probs(prompt, tokens, engine='ada'):
 # all positions if actual_token=None, else only positions where the actual token in response is actual_token
 # TODO next sequence instead of next token
 def counterfactual(response, token, actual_token=None, next_token=None, sort=True):
-    counterfactual_probs = []
-    tokens = response.choices[0]['logprobs']['tokens']
-    top_logprobs = response.choices[0]['logprobs']['top_logprobs']
-    positions = response.choices[0]['logprobs']['text_offset']
-    for i, probs in enumerate(top_logprobs):
-        if (actual_token is None and next_token is None) \
-                or actual_token == tokens[i] \
-                or (i < len(tokens) - 1 and next_token == tokens[i+1]):
-            if token in probs:
-                counterfactual_probs.append({'position': positions[i+1],
-                                             'prob': logprobs_to_probs(probs[token])})
-            else:
-                counterfactual_probs.append({'position': positions[i+1], 'prob': 0})
+    tokens = np.array(response['choices'][0]['logprobs']['tokens'], dtype=object)
+    top_logprobs = response['choices'][0]['logprobs']['top_logprobs']
+    positions = np.asarray(response['choices'][0]['logprobs']['text_offset'])
+    # positions[i + 1] is reported for position i, so the last token has none
+    count = min(len(top_logprobs), len(positions) - 1)
+    if actual_token is None and next_token is None:
+        selected = np.ones(count, dtype=bool)
+    else:
+        selected = (tokens[:count] == actual_token) | (tokens[1:count + 1] == next_token)
+    indices = np.flatnonzero(selected)
+    probs = np.exp(lp.counterfactual_logprobs([top_logprobs[i] for i in indices], [token])[:, 0])
     if sort:
-        counterfactual_probs = sorted(counterfactual_probs, key=lambda k: k['prob'])
-    return counterfactual_probs
+        order = np.argsort(probs, kind='stable')
+        indices, probs = indices[order], probs[order]
+    return [{'position': int(position), 'prob': float(prob)} for position, prob in zip(positions[indices + 1], probs)]
 
 
 # returns a list of substrings of content and
 # logL(preprompt+substring+target | preprompt+substring) for each substring
-def substring_probs(preprompt, content, target, engine='ada', quiet=0):
-    logprobs = []
-    substrings = []
+# substrings are scored in batches (see conditional_logprobs); on_substring(substring, logprob) is called as each is
+def substring_probs(preprompt, content, target, engine='ada', quiet=0, on_substring=None):
     _, positions = tokenize_ada(content)
-    for position in positions:
-        substring = content[:position]
-        prompt = preprompt + substring
-        logprob = conditional_logprob(prompt, target, engine)
-        logprobs.append(logprob)
-        substrings.append(substring)
+    substrings = [content[:position] for position in positions]
+
+    def scored(i, logprob):
         if not quiet:
-            print(substring)
-            print('logprob: ', logprob)
+            print(f'{substrings[i]}\nlogprob:  {logprob}')
+        if on_substring:
+            on_substring(substrings[i], logprob)
 
+    logprobs = conditional_logprobs([(preprompt + substring, target) for substring in substrings], engine,
+                                    on_scored=scored)
     return substrings, logprobs
 
 
 # returns a list of substrings of content
 # logL(substring+target | substring) for each substring
-def token_conditional_logprob(content, target, engine='ada'):
-    response = openai.Completion.create(
+def token_conditional_logprob(content, target, engine='ada', bypass_cache=False):
+    response = completion(
         engine=engine,
         prompt=content,
         max_tokens=0,
         echo=True,
         n=1,
-        logprobs=100
+        logprobs=100,
+        bypass_cache=bypass_cache
     )
-    tokens = response.choices[0]['logprobs']['tokens']
-    top_logprobs = response.choices[0]['logprobs']['top_logprobs']
+    tokens = response['choices'][0]['logprobs']['tokens']
+    top_logprobs = response['choices'][0]['logprobs']['top_logprobs']
     logprobs = []
     substrings = []
     substring = ''
@@ -160,24 +216,17 @@ def token_conditional_logprob(content, target, engine='ada'):
 
 
 def sort_logprobs(substrings, logprobs, n_top=None):
-    sorted_indices = np.argsort(logprobs)
-    top = []
-    if n_top is None:
-        n_top = len(sorted_indices)
-    for i in range(n_top):
-        top.append({'substring': substrings[sorted_indices[-(i + 1)]],
-                    'logprob': logprobs[sorted_indices[-(i + 1)]]})
-    return top
-
-
-def top_logprobs(preprompt, content, target, n_top=None, engine='ada', quiet=0):
-    substrings, logprobs = substring_probs(preprompt, content, target, engine, quiet)
+    return [{'substring': substrings[i], 'logprob': logprobs[i]} for i in lp.top_k(logprobs, n_top)]
+
+
+def top_logprobs(preprompt, content, target, n_top=None, engine='ada', quiet=0, on_substring=None):
+    substrings, logprobs = substring_probs(preprompt, content, target, engine, quiet, on_substring)
     return sort_logprobs(substrings, logprobs, n_top)
 
 
 def decibels(prior, evidence, target, engine='ada'):
-    prior_target_logprob = conditional_logprob(prompt=prior, target=target, engine=engine)
-    evidence_target_logprob = conditional_logprob(prompt=evidence, target=target, engine=engine)
+    prior_target_logprob, evidence_target_logprob = conditional_logprobs([(prior, target), (evidence, target)],
+                                                                         engine=engine)
     return (evidence_target_logprob - prior_target_logprob), prior_target_logprob, evidence_target_logprob
 
 
@@ -0,0 +1,69 @@
+from diff_match_patch import diff_match_patch
+
+# Revision history of a node's text, stored in node['history'] as a chain of deltas
+#
+# entries: [{'timestamp': string, 'text': string}                keyframe, full text of the revision
+#           {'timestamp': string, 'delta': string}, ...]         diff_match_patch delta from the previous revision
+#
+# Every KEYFRAME_INTERVAL-th entry is a keyframe, so reconstructing a revision applies at most
+# KEYFRAME_INTERVAL - 1 deltas. Histories saved before deltas existed have a keyframe in every entry;
+# compact_history converts them.
+
+KEYFRAME_INTERVAL = 10
+
+dmp = diff_match_patch()
+
+
+def is_keyframe(entry):
+    return 'text' in entry
+
+
+def make_delta(old_text, new_text):
+    diffs = dmp.diff_main(old_text, new_text)
+    dmp.diff_cleanupEfficiency(diffs)
+    return dmp.diff_toDelta(diffs)
+
+
+def apply_delta(text, delta):
+    return dmp.diff_text2(dmp.diff_fromDelta(text, delta))
+
+
+# text of revision index, applying deltas forward from the nearest keyframe
+def revision_text(history, index):
+    if index < 0:
+        index += len(history)
+    start = index
+    while not is_keyframe(history[start]):
+        start -= 1
+    text = history[start]['text']
+    for entry in history[start + 1:index + 1]:
+        text = apply_delta(text, entry['delta'])
+    return text
+
+
+def revision_texts(history):
+    texts = []
+    for entry in history:
+        texts.append(entry['text'] if is_keyframe(entry) else apply_delta(texts[-1], entry['delta']))
+    return texts
+
+
+def append_revision(history, text, timestamp):
+    if len(history) % KEYFRAME_INTERVAL == 0:
+        history.append({'timestamp': timestamp, 'text': text})
+    else:
+        history.append({'timestamp': timestamp, 'delta': make_delta(revision_text(history, -1), text)})
+
+
+def is_compact(history):
+    return all(is_keyframe(entry) == (i % KEYFRAME_INTERVAL == 0) for i, entry in enumerate(history))
+
+
+# rewrites a history (e.g. one made of full texts) so only every KEYFRAME_INTERVAL-th entry is a keyframe
+def compact_history(history):
+    if is_compact(history):
+        return history
+    compacted = []
+    for entry, text in zip(history, revision_texts(history)):
+        append_revision(compacted, text, entry.get('timestamp'))
+    return compacted
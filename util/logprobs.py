@@ -0,0 +1,71 @@
+import numpy as np
+
+# Vectorized logprob math
+#
+# Top logprob tables (up to 100 {token: logprob} entries per position) are turned into arrays once and
+# exponentiated, normalized, ranked and searched with NumPy instead of element by element in Python.
+# Missing logprobs (a token not in a position's table, or the first echoed token's None) are -inf, i.e. probability 0.
+
+
+def as_logprobs(logprobs):
+    return np.array([-np.inf if logprob is None else logprob for logprob in logprobs], dtype=np.float64)
+
+
+# log(sum(exp(logprobs))) along axis, without overflow or underflow
+def logsumexp(logprobs, axis=None):
+    logprobs = np.asarray(logprobs, dtype=np.float64)
+    if logprobs.size == 0:
+        return -np.inf
+    peak = np.max(logprobs, axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0)
+    with np.errstate(divide='ignore'):
+        result = np.log(np.sum(np.exp(logprobs - peak), axis=axis, keepdims=True)) + peak
+    return result.item() if axis is None else np.squeeze(result, axis=axis)
+
+
+# logprobs renormalized to probabilities that sum to 1 along axis
+def softmax(logprobs, axis=-1):
+    logprobs = np.asarray(logprobs, dtype=np.float64)
+    if logprobs.size == 0:
+        return logprobs
+    return np.exp(logprobs - np.expand_dims(logsumexp(logprobs, axis=axis), axis))
+
+
+# probabilities scaled to sum to 1
+def normalize(probs):
+    probs = np.asarray(probs, dtype=np.float64)
+    return probs / probs.sum()
+
+
+# indices of the k largest values, largest first (all of them if k is None)
+def top_k(values, k=None):
+    values = np.asarray(values, dtype=np.float64)
+    if k is None or k >= len(values):
+        return np.argsort(-values, kind='stable')
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-values, k - 1)[:k]
+    return top[np.argsort(-values[top], kind='stable')]
+
+
+# {token: prob} of a {token: logprob} table, most likely first (only the k most likely if k), optionally
+# renormalized to sum to 1
+def table_probs(table, k=None, renormalize=False):
+    if not table:
+        return {}
+    tokens = list(table.keys())
+    logprobs = as_logprobs(table.values())
+    probs = softmax(logprobs) if renormalize else np.exp(logprobs)
+    return {tokens[i]: float(probs[i]) for i in top_k(logprobs, k)}
+
+
+# logprobs of tokens at each position of top_logprobs (a list of {token: logprob} or None), as a
+# (positions, tokens) array, -inf where a token isn't in a position's table
+def counterfactual_logprobs(top_logprobs, tokens):
+    columns = {token: i for i, token in enumerate(tokens)}
+    table = np.full((len(top_logprobs), len(tokens)), -np.inf)
+    for position, top in enumerate(top_logprobs):
+        if top:
+            for token in columns.keys() & top.keys():
+                table[position, columns[token]] = top[token]
+    return table
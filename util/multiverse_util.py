@@ -1,27 +1,18 @@
-import openai
 import numpy as np
 from util.tokenizer import tokenize, token_to_word
-from util.gpt_util import logprobs_to_probs
-import os
+from util.logprobs import table_probs
+from util.response_cache import cached
+from util.openai_client import default_client, coalesced
 
 
 def generate(prompt, engine, goose=False):
-    if goose:
-        openai.api_base = "https://api.goose.ai/v1"
-        openai.api_key = os.environ.get("GOOSEAI_API_KEY", None)
-    else:
-        openai.api_base = "https://api.openai.com/v1"
-        openai.api_key = os.environ.get("OPENAI_API_KEY", None)
-        openai.organization = os.environ.get("OPENAI_ORGANIZATION", None)
-    #print('calling engine', engine, 'at endpoint', openai.api_base)
+    client = default_client(goose)
+    #print('calling engine', engine, 'at endpoint', client.api_base)
     #print('prompt:', prompt)
-    response = openai.Completion.create(prompt=prompt,
-                                        max_tokens=1,
-                                        n=1,
-                                        temperature=0,
-                                        logprobs=100,
-                                        model=engine)
-    return response
+    params = {'max_tokens': 1, 'n': 1, 'temperature': 0, 'logprobs': 100}
+    request = lambda: client.completion(prompt=prompt, model=engine, **params)
+    return cached(lambda: coalesced(request, client, engine, prompt, params), engine, prompt,
+                  dict(params, api_base=client.api_base))
 
 # TODO multiple "ground truth" trajectories
 def greedy_word_multiverse(prompt, ground_truth='', max_depth=3,  unnormalized_amplitude=1, unnormalized_threshold=0.1, engine='ada', goose=False):
@@ -32,8 +23,8 @@ def greedy_word_multiverse(prompt, ground_truth='', max_depth=3,  unnormalized_a
         return {}, ground_truth
     print('generating...')
     response = generate(prompt, engine, goose)
-    logprobs = response.choices[0]["logprobs"]["top_logprobs"][0]
-    probs = {k: logprobs_to_probs(v) for k, v in sorted(logprobs.items(), key=lambda item: item[1], reverse=True)}
+    logprobs = response["choices"][0]["logprobs"]["top_logprobs"][0]
+    probs = table_probs(logprobs)
     multiverse = {token: {'normalized_prob': prob, 'unnormalized_prob': prob * unnormalized_amplitude, 'children': {}} for token, prob in probs.items()}
     ground_truth_token = ground_truth[0] if ground_truth else 'NO GROUND TRUTH'
     done_ground_truth = False
@@ -0,0 +1,68 @@
+import functools
+import os
+
+import openai
+
+from util.gen_engine import get_engine
+from util.scheduler import INTERACTIVE
+from util.single_flight import request_key
+
+# Per provider clients for OpenAI compatible APIs
+#
+# Each ProviderClient wraps its own openai.OpenAI client, which carries the provider's api key, base url and
+# organization, so concurrent generations against different providers (or two custom api bases) can't send
+# requests to the wrong endpoint with the wrong key. Clients are created once per (api_base, api_key,
+# organization) and reused, keeping their connection pools.
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+GOOSEAI_API_BASE = "https://api.goose.ai/v1"
+
+
+class ProviderClient:
+    def __init__(self, api_base, api_key=None, organization=None):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.organization = organization
+
+    # made on first use, so a missing api key is reported by the request rather than when the client is looked up
+    # retries are left to the callers, which retry through the generation engine's rate limiter
+    @functools.cached_property
+    def client(self):
+        return openai.OpenAI(api_key=self.api_key, base_url=self.api_base, organization=self.organization,
+                             max_retries=0)
+
+    # clients of the same family share scheduler slots (see gpt.provider_family)
+    def family(self):
+        return 'gooseai' if self.api_base == GOOSEAI_API_BASE else 'openai'
+
+    # responses are returned as plain dicts
+    def completion(self, **params):
+        return self.client.completions.create(**params).model_dump()
+
+    def chat_completion(self, **params):
+        return self.client.chat.completions.create(**params).model_dump()
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(api_base=OPENAI_API_BASE, api_key=None, organization=None):
+    return ProviderClient(api_base if api_base else OPENAI_API_BASE, api_key, organization)
+
+
+# client for a provider dict (see gpt.provider_settings)
+def provider_client(provider):
+    return get_client(provider['api_base'], provider['api_key'], provider['organization'])
+
+
+# Blocking: request() made through the generation engine, once the scheduler has a slot for the client's
+# provider. Identical requests (same api base, model, prompt and params) made while one is in flight share it
+def coalesced(request, client, model, prompt, params, priority=INTERACTIVE):
+    key = request_key('completion', client.api_base, model, prompt, params)
+    return get_engine().run_blocking(request, key, (client.family(), client.api_base), priority)
+
+
+# client configured from the environment
+def default_client(goose=False):
+    if goose:
+        return get_client(GOOSEAI_API_BASE, os.environ.get("GOOSEAI_API_KEY", None))
+    return get_client(OPENAI_API_BASE, os.environ.get("OPENAI_API_KEY", None),
+                      os.environ.get("OPENAI_ORGANIZATION", None))
@@ -0,0 +1,215 @@
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+# Prompt templates
+#
+# Templates use f-string syntax, but fields may only look values up, never call or compute anything:
+#   {input}, {node['prose_so_far']}, {inputs["input"]}, {self.generation_settings[model]}, {text!r:>10}
+# A template is compiled once into a list of literal strings and field lookups; rendering it is string
+# assembly. Names starting with an underscore can't be looked up. {{ and }} are literal braces, and
+# backslash escapes (\n, \t, ...) are interpreted, as they were when templates were eval'd as f-strings.
+#
+# Template and few-shot files are loaded once and cached. A watcher thread polls the modification times of
+# the loaded files, so edits to them are picked up without checking the disk on every prompt.
+
+# seconds between checks for changed files
+WATCH_INTERVAL = 2
+
+FIELD = re.compile(r'\{([^{}]*)\}|\{\{|\}\}|\{|\}')
+NAME = re.compile(r'[A-Za-z][A-Za-z0-9_]*')
+LOOKUP = re.compile(r'\.([A-Za-z][A-Za-z0-9_]*)|\[\s*(?:\'([^\']*)\'|"([^"]*)"|(-?\d+)|([^\]\'"]+?))\s*\]')
+ESCAPE = re.compile(r'\\(\n|\\|\'|"|n|t|r)')
+ESCAPES = {'\n': '', '\\': '\\', "'": "'", '"': '"', 'n': '\n', 't': '\t', 'r': '\r'}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class Field:
+    __slots__ = ('expression', 'name', 'lookups', 'conversion', 'spec')
+
+    def __init__(self, expression):
+        self.expression = expression
+        field, self.conversion, self.spec = split_field(expression)
+        match = NAME.match(field)
+        if not match or match.group().startswith('_'):
+            raise TemplateError(f'Invalid template field {{{expression}}}')
+        self.name = match.group()
+        # [(is attribute, key)]
+        self.lookups = []
+        position = match.end()
+        while position < len(field):
+            lookup = LOOKUP.match(field, position)
+            if not lookup:
+                raise TemplateError(f'Invalid template field {{{expression}}}')
+            attribute, single, double, index, bare = lookup.groups()
+            if attribute is not None:
+                if attribute.startswith('_'):
+                    raise TemplateError(f'Invalid template field {{{expression}}}')
+                self.lookups.append((True, attribute))
+            elif index is not None:
+                self.lookups.append((False, int(index)))
+            else:
+                key = next(k for k in (single, double, bare) if k is not None)
+                self.lookups.append((False, key))
+            position = lookup.end()
+
+    def render(self, context):
+        if self.name not in context:
+            raise KeyError(self.name)
+        value = context[self.name]
+        for is_attribute, key in self.lookups:
+            value = getattr(value, key) if is_attribute else value[key]
+        if self.conversion == 'r':
+            value = repr(value)
+        elif self.conversion == 'a':
+            value = ascii(value)
+        elif self.conversion == 's':
+            value = str(value)
+        return format(value, self.spec) if self.spec else str(value)
+
+
+# field, conversion, format spec
+def split_field(expression):
+    field, spec = expression, ''
+    # a colon inside brackets is part of the key
+    depth = 0
+    for i, char in enumerate(expression):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ':' and depth == 0:
+            field, spec = expression[:i], expression[i + 1:]
+            break
+    conversion = None
+    if len(field) > 2 and field[-2] == '!':
+        field, conversion = field[:-2], field[-1]
+        if conversion not in 'rsa':
+            raise TemplateError(f'Invalid conversion in template field {{{expression}}}')
+    return field.strip(), conversion, spec
+
+
+class Template:
+    def __init__(self, source):
+        self.source = source
+        # literal strings and Fields
+        self.parts = []
+        literal = ''
+        for match in split_literals(source):
+            if isinstance(match, str):
+                literal += match
+                continue
+            if literal:
+                self.parts.append(literal)
+                literal = ''
+            self.parts.append(match)
+        if literal:
+            self.parts.append(literal)
+
+    # raises KeyError if a field's name isn't in context, or a lookup fails
+    def render(self, /, **context):
+        return ''.join(part if isinstance(part, str) else part.render(context) for part in self.parts)
+
+
+def split_literals(source):
+    position = 0
+    for match in FIELD.finditer(source):
+        yield unescape(source[position:match.start()])
+        token = match.group()
+        if token in ('{{', '}}'):
+            yield token[0]
+        elif match.group(1) is None:
+            raise TemplateError(f'Single {token} in template')
+        else:
+            yield Field(match.group(1))
+        position = match.end()
+    yield unescape(source[position:])
+
+
+def unescape(text):
+    return ESCAPE.sub(lambda match: ESCAPES[match.group(1)], text) if '\\' in text else text
+
+
+# compiled templates are cached by source, so templates stored in settings or nodes are compiled once too
+@functools.lru_cache(maxsize=512)
+def compile_template(source):
+    return Template(source)
+
+
+def render(source, /, **context):
+    return compile_template(source).render(**context)
+
+
+class FileCache:
+    def __init__(self, interval=WATCH_INTERVAL):
+        self.interval = interval
+        # {(path, kind): (mtime, value)}
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def get(self, path, kind, load):
+        key = (os.path.abspath(path), kind)
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry[1]
+        mtime = os.path.getmtime(path)
+        value = load(path)
+        with self.lock:
+            self.entries[key] = (mtime, value)
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.watch, name='template-watcher', daemon=True)
+                self.watcher.start()
+        return value
+
+    # drops entries whose files changed or were removed
+    def check(self):
+        with self.lock:
+            entries = list(self.entries.items())
+        for key, (mtime, _) in entries:
+            try:
+                changed = os.path.getmtime(key[0]) != mtime
+            except OSError:
+                changed = True
+            if changed:
+                with self.lock:
+                    if self.entries.get(key, (None,))[0] == mtime:
+                        del self.entries[key]
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+_files = FileCache()
+
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# compiled template in the file at path
+def template_file(path):
+    return _files.get(path, 'template', lambda p: Template(read_file(p)))
+
+
+# parsed json file at path; shared, so don't modify it
+def json_file(path):
+    return _files.get(path, 'json', read_json)
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import random
+import re
+import uuid
+
+from util.util import timestamp
+from util.token_columns import TokenColumns
+from util.telemetry import first_byte
+
+# Model providers
+#
+# A provider turns the generation kwargs into a request, sends it and parses the provider's response into
+# the common response dict (see gpt.py). Providers are registered per model type (the 'type' of a model in
+# model_config['models']); gpt.agenerate looks them up with get_provider, so adding a backend only takes
+# registering a Provider for a new type.
+
+PROVIDERS = {}
+
+
+def register_provider(model_type, provider):
+    PROVIDERS[model_type] = provider
+
+
+def get_provider(model_type):
+    if model_type not in PROVIDERS:
+        raise ValueError(f'Unsupported model type {model_type}')
+    return PROVIDERS[model_type]
+
+
+class Provider:
+    # providers of the same family share concurrency and rate limits; the model type if None
+    family = None
+
+    # api base and credentials for a model, from kwargs or the environment
+    def settings(self, model_info, **kwargs):
+        return {'type': model_info['type'],
+                'api_base': model_info.get('api_base'),
+                'api_key': None,
+                'organization': None}
+
+    # returns the request to send, a dict the provider's send understands
+    def build_request(self, prompt, provider, model, **kwargs):
+        raise NotImplementedError
+
+    # sends the request and returns the provider's response
+    # if on_text is given, on_text(index, text) may be called with each completion's text so far as it streams
+    async def send(self, request, provider, on_text=None):
+        raise NotImplementedError
+
+    # the provider's response as a response dict
+    # if echo is false the prompt wasn't scored, and the response's prompt tokens are None
+    def parse(self, response, prompt, model, echo=True):
+        raise NotImplementedError
+
+    # most prompts one request can have; providers that take several override the batch methods below
+    def max_batch(self, provider):
+        return 1
+
+    # a request for several prompts with the same settings, sent with send
+    def build_batch_request(self, prompts, provider, model, **kwargs):
+        raise NotImplementedError
+
+    # the response to a batch request as a list of response dicts, one per prompt
+    def parse_batch(self, response, prompts, model, echo=True):
+        raise NotImplementedError
+
+
+#################################
+#   Mock
+#################################
+
+# Deterministic local backend for load testing the generation pipeline without a network. The next token
+# distribution is a function of the model and the preceding text, and completions sample from it with a
+# generator seeded by the request, so the same prompt and settings always produce the same response.
+# Options are read from the model's entry in model_config['models']:
+#   'latency': seconds before the first token
+#   'tokens_per_second': rate tokens are generated (and streamed) at
+#   'logprobs': whether tokens have logprobs and counterfactuals
+
+MOCK_LATENCY = 0.5
+MOCK_TOKENS_PER_SECOND = 50
+MOCK_MAX_BATCH = 20
+# characters of context the next token distribution depends on
+MOCK_CONTEXT = 64
+MOCK_VOCABULARY = (' the', ' of', ' and', ' a', ' to', ' in', ' was', ' it', ' that', ' he', ' she', ' they',
+                   ' tree', ' branch', ' leaf', ' root', ' loom', ' thread', ' story', ' world', ' dream', ' light',
+                   ' said', ' saw', ' knew', ' went', ' old', ' new', ' strange', ' quiet', '.', ',', '\n')
+
+
+def mock_random(*parts):
+    return random.Random(hashlib.sha256(json.dumps(parts).encode('utf-8')).digest())
+
+
+# logprobs of the vocabulary's tokens after text, most likely first
+def mock_distribution(model, text):
+    rng = mock_random('next', model, text[-MOCK_CONTEXT:])
+    tokens = rng.sample(MOCK_VOCABULARY, len(MOCK_VOCABULARY))
+    weights = sorted((rng.random() ** 2 for _ in tokens), reverse=True)
+    total = sum(weights)
+    return {token: math.log(weight / total) for token, weight in zip(tokens, weights)}
+
+
+# top logprobs of k tokens of a distribution
+def mock_top(distribution, k):
+    return dict(itertools.islice(distribution.items(), max(k, 1)))
+
+
+def mock_sample(rng, counterfactuals, temperature):
+    if temperature == 0:
+        return next(iter(counterfactuals.items()))
+    tokens = list(counterfactuals)
+    weights = [math.exp(logprob / temperature) for logprob in counterfactuals.values()]
+    token = rng.choices(tokens, weights)[0]
+    return token, counterfactuals[token]
+
+
+class MockProvider(Provider):
+    def settings(self, model_info, **kwargs):
+        return dict(super().settings(model_info, **kwargs),
+                    latency=model_info.get('latency', MOCK_LATENCY),
+                    tokens_per_second=model_info.get('tokens_per_second', MOCK_TOKENS_PER_SECOND),
+                    logprobs=model_info.get('logprobs', True))
+
+    def build_request(self, prompt, provider, model, length=150, num_continuations=1, logprobs=10, temperature=0.8,
+                      top_p=1, stop=None, echo=True, **kwargs):
+        return {'prompt': prompt, 'model': model, 'length': length, 'n': num_continuations,
+                'logprobs': logprobs if provider['logprobs'] else 0, 'temperature': temperature, 'top_p': top_p,
+                'stop': stop if stop else [], 'echo': echo}
+
+    def prompt_tokens(self, request):
+        prompt = request['prompt']
+        tokens, starts, logprobs, top_logprobs = [], [], [], []
+        for match in re.finditer(r'\s*\S+|\s+', prompt):
+            tokens.append(match.group())
+            starts.append(match.start())
+            if not request['logprobs'] or len(tokens) == 1:
+                logprobs.append(None)
+                top_logprobs.append(None)
+                continue
+            distribution = mock_distribution(request['model'], prompt[:match.start()])
+            # tokens outside the vocabulary are less likely than any in it
+            logprobs.append(distribution.get(match.group(), min(distribution.values()) - 1))
+            top_logprobs.append(mock_top(distribution, request['logprobs']))
+        return TokenColumns(tokens, starts, logprobs, top_logprobs)
+
+    async def send_one(self, request, provider, on_text=None):
+        await asyncio.sleep(provider['latency'])
+        first_byte()
+        prompt = request['prompt']
+        settings = (request['model'], request['temperature'], request['top_p'], request['logprobs'])
+        rngs = [mock_random('sample', prompt, i, *settings) for i in range(request['n'])]
+        completions = [{'text': '', 'finishReason': 'length'} for _ in range(request['n'])]
+        # [(tokens, starts, logprobs, top logprobs)] per completion
+        columns = [([], [], [], []) for _ in range(request['n'])]
+        for _ in range(request['length']):
+            await asyncio.sleep(1 / provider['tokens_per_second'])
+            for i, (rng, completion, (tokens, starts, logprobs, top_logprobs)) in \
+                    enumerate(zip(rngs, completions, columns)):
+                if completion['finishReason'] == 'stop':
+                    continue
+                distribution = mock_distribution(request['model'], prompt + completion['text'])
+                token, logprob = mock_sample(rng, distribution, request['temperature'])
+                # like the real apis, the stop sequence isn't returned
+                if any((completion['text'] + token).endswith(stop) for stop in request['stop']):
+                    completion['finishReason'] = 'stop'
+                    continue
+                tokens.append(token)
+                starts.append(len(prompt) + len(completion['text']))
+                logprobs.append(logprob if request['logprobs'] else None)
+                top_logprobs.append(mock_top(distribution, request['logprobs']) if request['logprobs'] else None)
+                completion['text'] += token
+                if on_text:
+                    on_text(i, completion['text'])
+            if all(completion['finishReason'] == 'stop' for completion in completions):
+                break
+        for completion, column in zip(completions, columns):
+            completion['tokens'] = TokenColumns(*column)
+        return {'completions': completions,
+                'prompt': {'text': prompt, 'tokens': self.prompt_tokens(request) if request['echo'] else None},
+                'id': str(uuid.uuid4())}
+
+    def parse(self, response, prompt, model, echo=True):
+        return dict(response, model=model, timestamp=timestamp())
+
+    def max_batch(self, provider):
+        return MOCK_MAX_BATCH
+
+    def build_batch_request(self, prompts, provider, model, **kwargs):
+        return dict(self.build_request(prompts[0], provider, model, **kwargs), prompts=list(prompts))
+
+    # the prompts of a batch are generated in parallel; if the request has prompts, on_text isn't called
+    async def send(self, request, provider, on_text=None):
+        if request.get('prompts'):
+            return await asyncio.gather(*(self.send_one(dict(request, prompt=prompt), provider)
+                                          for prompt in request['prompts']))
+        return await self.send_one(request, provider, on_text)
+
+    def parse_batch(self, response, prompts, model, echo=True):
+        return [self.parse(prompt_response, prompt, model, echo) for prompt_response, prompt in zip(response, prompts)]
+
+
+register_provider('mock', MockProvider())
@@ -0,0 +1,193 @@
+import asyncio
+import random
+import time
+
+from util.telemetry import sending
+
+# Client side rate limiting
+#
+# Each (provider family, api base, model) has two token buckets, one for requests per minute and one for
+# (estimated) tokens per minute, so requests are held back before the provider would answer with a 429.
+# The buckets run on the generation engine's loop.
+#
+# The sustained rate adapts: a 429 cuts it (and pauses the key for Retry-After if the provider sent one),
+# and every success raises it back towards the configured limit, so bulk jobs settle just under what the
+# provider allows instead of alternating between bursts and failures.
+
+# per family; model_config['rate_limits'][family] overrides
+DEFAULT_RATE_LIMITS = {
+    'openai': {'requests_per_minute': 3000, 'tokens_per_minute': 250000},
+    'gooseai': {'requests_per_minute': 600, 'tokens_per_minute': 100000},
+    'ai21': {'requests_per_minute': 300, 'tokens_per_minute': 100000},
+    # local, see util/providers.py
+    'mock': {'requests_per_minute': 10 ** 6, 'tokens_per_minute': 10 ** 9},
+}
+FALLBACK_RATE_LIMITS = {'requests_per_minute': 600, 'tokens_per_minute': 100000}
+
+# multiplicative decrease on 429, additive increase (fraction of the limit) on success
+THROTTLE_FACTOR = 0.7
+RECOVERY_STEP = 0.02
+MIN_RATE_FRACTION = 0.05
+
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+# exceptions from the openai library that are worth retrying
+RETRYABLE_ERRORS = ('APIConnectionError', 'APITimeoutError', 'RateLimitError', 'InternalServerError')
+
+MAX_TRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+
+def error_status(error):
+    return getattr(error, 'status', None) or getattr(error, 'status_code', None)
+
+
+def retry_after(error):
+    seconds = getattr(error, 'retry_after', None)
+    if seconds is None:
+        headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None) or {}
+        seconds = headers.get('Retry-After') or headers.get('retry-after')
+    try:
+        return float(seconds) if seconds is not None else None
+    except ValueError:
+        return None
+
+
+def is_retryable(error):
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)) \
+        or type(error).__name__ in RETRYABLE_ERRORS \
+        or any(cls.__name__ in ('ClientConnectionError', 'ClientPayloadError') for cls in type(error).__mro__)
+
+
+# seconds to wait before try number attempt (from 1), Retry-After if the provider sent one
+def backoff_delay(error, attempt):
+    delay = retry_after(error)
+    if delay is not None:
+        return delay
+    # full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def estimate_tokens(prompt, max_tokens=0, n=1):
+    return len(prompt) // 4 + max_tokens * n
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.limit = per_minute
+        self.rate = per_minute
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    # seconds until amount is available, taking it if it is
+    def take(self, amount):
+        self.refill()
+        # requests larger than the whole bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            self.level -= amount
+            return 0
+        return (amount - self.level) * 60 / self.rate
+
+    def throttle(self):
+        self.rate = max(self.limit * MIN_RATE_FRACTION, self.rate * THROTTLE_FACTOR)
+        self.level = min(self.level, 0)
+
+    def recover(self):
+        self.rate = min(self.limit, self.rate + self.limit * RECOVERY_STEP)
+
+
+class RateLimiter:
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_RATE_LIMITS, **(limits if limits else {}))
+        # {key: (requests bucket, tokens bucket)}
+        self.buckets = {}
+        # {key: time.monotonic() before which nothing is sent}
+        self.paused_until = {}
+
+    def set_limits(self, family, limits):
+        if self.limits.get(family) == limits:
+            return
+        self.limits[family] = limits
+        for key in [key for key in self.buckets if key[0] == family]:
+            del self.buckets[key]
+
+    # key is (family, api_base, model)
+    def _buckets(self, key):
+        if key not in self.buckets:
+            limits = self.limits.get(key[0], FALLBACK_RATE_LIMITS)
+            self.buckets[key] = (TokenBucket(limits['requests_per_minute']), TokenBucket(limits['tokens_per_minute']))
+        return self.buckets[key]
+
+    # waits until a request of tokens tokens can be sent
+    async def acquire(self, key, tokens):
+        requests_bucket, tokens_bucket = self._buckets(key)
+        while True:
+            pause = self.paused_until.get(key, 0) - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            wait = requests_bucket.take(1)
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            wait = tokens_bucket.take(tokens)
+            if wait:
+                # give the request back while waiting for tokens
+                requests_bucket.level += 1
+                await asyncio.sleep(wait)
+                continue
+            return
+
+    def succeeded(self, key):
+        for bucket in self._buckets(key):
+            bucket.recover()
+
+    def rate_limited(self, key, delay=None):
+        for bucket in self._buckets(key):
+            bucket.throttle()
+        if delay:
+            self.paused_until[key] = max(self.paused_until.get(key, 0), time.monotonic() + delay)
+
+    def stats(self):
+        return {' '.join(str(k) for k in key if k): {'requests_per_minute': round(requests.rate),
+                                                     'tokens_per_minute': round(tokens.rate)}
+                for key, (requests, tokens) in self.buckets.items()}
+
+
+# Calls request() (a coroutine function) through the limiter, retrying retryable errors with jittered
+# exponential backoff (or Retry-After). Other errors, and the last retryable one, are raised
+# if given, the request's metrics (see util/telemetry.py) get its time waiting on the limiter and its retries
+async def limited_request(request, limiter, key, tokens, max_tries=MAX_TRIES, metrics=None):
+    attempt = 0
+    while True:
+        waiting = time.monotonic()
+        await limiter.acquire(key, tokens)
+        if metrics is not None:
+            metrics['rate_wait'] += time.monotonic() - waiting
+            sending(metrics)
+        try:
+            response = await request()
+        except Exception as e:
+            attempt += 1
+            if not is_retryable(e) or attempt >= max_tries:
+                raise
+            if metrics is not None:
+                metrics['retries'] += 1
+            if error_status(e) == 429:
+                limiter.rate_limited(key, retry_after(e))
+            delay = backoff_delay(e, attempt)
+            print(f"Failed with exception: {str(e)}, Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+            continue
+        limiter.succeeded(key)
+        return response
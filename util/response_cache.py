@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Persistent cache of deterministic model responses
+#
+# Temperature 0 and max_tokens 0 (scoring) requests always return the same response for the same model,
+# prompt and parameters, so their responses are kept in a SQLite database keyed by a hash of all three.
+# The database is bounded to max_bytes of responses; the least recently used are evicted first.
+#
+# Set enabled = False (or pass bypass=True to cached) to always make the request.
+
+DEFAULT_PATH = os.path.join(os.getcwd(), 'data', 'cache', 'responses.sqlite')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+enabled = True
+
+
+def is_deterministic(params):
+    return params.get('temperature', 1) == 0 or params.get('max_tokens', 1) == 0
+
+
+def cache_key(model, prompt, params):
+    data = json.dumps({'model': model, 'prompt': prompt, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                            (key, data, len(data), time.time()))
+            self.total_bytes += len(data) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # evict down to 90% so a full cache isn't evicting on every put
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM responses')
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'responses': count, 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# the shared cache, opened on first use
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+
+# Returns request() (which must return something json serializable), from the cache if this request
+# has been made before. Only deterministic requests are cached.
+def cached(request, model, prompt, params, bypass=False):
+    if bypass or not enabled or not is_deterministic(params):
+        return request()
+    cache = get_cache()
+    key = cache_key(model, prompt, params)
+    response = cache.get(key)
+    if response is None:
+        response = request()
+        cache.put(key, response)
+    return response
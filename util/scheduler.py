@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict, deque
+
+# Generation scheduler
+#
+# Runs on the generation engine's event loop (see util/gen_engine.py) and bounds how many requests each
+# provider has in flight. Requests waiting for a slot are started in priority order, then in order of
+# submission, so interactive generation isn't stuck behind a batch job.
+#
+# A request can be given a cancelled() predicate (e.g. "its placeholder nodes were deleted"). It's checked
+# whenever the request would be started, and by sweep; requests it's true for never reach the provider.
+
+INTERACTIVE = 0
+INLINE = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', INLINE: 'inline', BACKGROUND: 'background'}
+
+DEFAULT_LIMIT = 4
+# requests in flight per provider family
+PROVIDER_LIMITS = {
+    'openai': 4,
+    'gooseai': 4,
+    'ai21': 2,
+}
+# how many recent wait times are kept for stats
+WAIT_HISTORY = 200
+
+
+class Pending:
+    __slots__ = ('waiter', 'cancelled', 'priority', 'submitted')
+
+    def __init__(self, waiter, cancelled, priority):
+        self.waiter = waiter
+        self.cancelled = cancelled
+        self.priority = priority
+        self.submitted = time.monotonic()
+
+
+class GenerationScheduler:
+    def __init__(self, limits=None):
+        self.limits = dict(PROVIDER_LIMITS, **(limits if limits else {}))
+        # everything below is only touched from the event loop
+        # {provider: number of requests in flight}
+        self.active = defaultdict(int)
+        # {provider: heap of (priority, sequence, Pending)}
+        self.queues = defaultdict(list)
+        self.sequence = itertools.count()
+        # {priority: recent wait times in seconds}
+        self.waits = defaultdict(lambda: deque(maxlen=WAIT_HISTORY))
+        self.cancelled_count = 0
+
+    # provider is a (family, api_base) tuple; limits are per family
+    def limit(self, provider):
+        return self.limits.get(provider[0], DEFAULT_LIMIT)
+
+    def set_limit(self, family, limit):
+        self.limits[family] = limit
+
+    # awaits coro_factory() once the provider has a free slot
+    # raises asyncio.CancelledError if cancelled() is true when it would start
+    async def run(self, coro_factory, provider, priority=INTERACTIVE, cancelled=None):
+        pending = Pending(asyncio.get_running_loop().create_future(), cancelled, priority)
+        heapq.heappush(self.queues[provider], (priority, next(self.sequence), pending))
+        self._dispatch(provider)
+        try:
+            await pending.waiter
+        except asyncio.CancelledError:
+            # the slot may have been handed over just as the request was cancelled
+            if pending.waiter.done() and not pending.waiter.cancelled():
+                self._release(provider)
+            raise
+        try:
+            return await coro_factory()
+        finally:
+            self._release(provider)
+
+    def _release(self, provider):
+        self.active[provider] -= 1
+        self._dispatch(provider)
+
+    def _dispatch(self, provider):
+        queue = self.queues[provider]
+        while queue and self.active[provider] < self.limit(provider):
+            _, _, pending = heapq.heappop(queue)
+            if pending.waiter.done():
+                continue
+            if pending.cancelled and pending.cancelled():
+                self.cancelled_count += 1
+                pending.waiter.cancel()
+                continue
+            self.waits[pending.priority].append(time.monotonic() - pending.submitted)
+            self.active[provider] += 1
+            pending.waiter.set_result(None)
+
+    # cancels every waiting request whose cancelled() is now true
+    def sweep(self):
+        for provider, queue in self.queues.items():
+            for _, _, pending in queue:
+                if not pending.waiter.done() and pending.cancelled and pending.cancelled():
+                    self.cancelled_count += 1
+                    pending.waiter.cancel()
+            queue[:] = [entry for entry in queue if not entry[2].waiter.done()]
+            heapq.heapify(queue)
+
+    def stats(self):
+        providers = {}
+        for provider in set(self.queues) | set(self.active):
+            pending = defaultdict(int)
+            for priority, _, entry in self.queues[provider]:
+                if not entry.waiter.done():
+                    pending[PRIORITY_NAMES.get(priority, priority)] += 1
+            providers[' '.join(str(p) for p in provider if p)] = {'active': self.active[provider],
+                                                                   'limit': self.limit(provider),
+                                                                   'pending': dict(pending)}
+        waits = {}
+        for priority, recent in self.waits.items():
+            if recent:
+                waits[PRIORITY_NAMES.get(priority, priority)] = {'mean': sum(recent) / len(recent),
+                                                                 'max': max(recent),
+                                                                 'count': len(recent)}
+        return {'providers': providers, 'waits': waits, 'cancelled': self.cancelled_count}
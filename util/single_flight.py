@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+import json
+
+# Single-flight request coalescing
+#
+# Measuring a path, re-clicking a wavefunction block or re-running an inline completion often asks for the same
+# (model, prompt, params) again while the first request is still in flight. Calls with the same key made while
+# one is in flight join it instead of starting another: one request reaches the scheduler and the provider, and
+# every caller gets its result (the same object, so callers mustn't assume they own it).
+#
+# Runs on the generation engine's event loop (see util/gen_engine.py), which owns the only SingleFlight.
+
+
+def request_key(*parts):
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class Flight:
+    __slots__ = ('task', 'cancelled', 'listeners')
+
+    def __init__(self):
+        self.task = None
+        # each caller's cancelled(), None if it can't be cancelled
+        self.cancelled = []
+        # each streaming caller's on_text
+        self.listeners = []
+
+    # the request is only dropped if every caller has been cancelled
+    def all_cancelled(self):
+        return all(cancelled is not None and cancelled() for cancelled in self.cancelled)
+
+    def on_text(self, index, text):
+        for listener in self.listeners:
+            listener(index, text)
+
+
+class SingleFlight:
+    def __init__(self):
+        # {key: Flight}, only touched from the loop
+        self.flights = {}
+        self.calls = 0
+        self.joined = 0
+
+    # Awaits run(cancelled, on_text), or the call with the same key already in flight
+    # run is given cancelled(), true once every caller's cancelled() is (pass it on to the scheduler), and, if the
+    # first caller streams, an on_text(index, text) that calls every streaming caller's on_text
+    # A caller being cancelled doesn't cancel the call for the others
+    async def run(self, key, run, cancelled=None, on_text=None):
+        self.calls += 1
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            flight.task = asyncio.ensure_future(run(flight.all_cancelled, flight.on_text if on_text else None))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self.finished(key, flight))
+        else:
+            self.joined += 1
+        flight.cancelled.append(cancelled)
+        if on_text:
+            flight.listeners.append(on_text)
+        return await asyncio.shield(flight.task)
+
+    def finished(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self):
+        return {'in_flight': len(self.flights), 'calls': self.calls, 'joined': self.joined}
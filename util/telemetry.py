@@ -0,0 +1,215 @@
+import bisect
+import contextlib
+import contextvars
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+from util.scheduler import PRIORITY_NAMES
+
+# Generation telemetry
+#
+# Each request made on the generation engine (gpt.agenerate and agenerate_batch) is recorded when it's done:
+#   model, type, priority, prompts     what was requested
+#   queue_wait          seconds waiting for a scheduler slot (see util/scheduler.py)
+#   rate_wait           seconds waiting on the rate limiter, over all attempts (see util/rate_limit.py)
+#   ttfb                seconds from sending the last attempt to the first byte of its response
+#   latency             seconds from getting a slot to the response being parsed, retries included
+#   prompt_tokens, completion_tokens
+#                       the provider's usage if it reports it, else counted from the response's tokens, else
+#                       estimated from the text
+#   retries             failed attempts that were retried
+#   error               the error the request failed with, None if it didn't
+#   cost                tokens * the model's 'token_price' (per 1000 tokens) in model_config, if it has one
+# The most recent records are kept, and each model's are aggregated into histograms. export writes them as CSV
+# (records) or JSON (per model summaries and records).
+#
+# While a request is being made its metrics are the context's current metrics, so the code sending it (e.g.
+# GenerationEngine.post_json) can call first_byte without them being passed down.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2000, 4000, 8000)
+RECENT_RECORDS = 1000
+FIELDS = ('timestamp', 'model', 'type', 'priority', 'prompts', 'queue_wait', 'rate_wait', 'ttfb', 'latency',
+          'prompt_tokens', 'completion_tokens', 'retries', 'error', 'cost')
+
+_current = contextvars.ContextVar('generation_metrics', default=None)
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # counts[i] is values <= bounds[i] (and > bounds[i - 1]); the last is values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        if value is None:
+            return
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    # upper bound of the bucket the q quantile is in, or the max if it's lower
+    def quantile(self, q):
+        if not self.count:
+            return None
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_json(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'bounds': list(self.bounds),
+                'counts': list(self.counts)}
+
+
+class ModelMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = None
+        self.histograms = {'queue_wait': Histogram(LATENCY_BUCKETS),
+                           'ttfb': Histogram(LATENCY_BUCKETS),
+                           'latency': Histogram(LATENCY_BUCKETS),
+                           'completion_tokens': Histogram(TOKEN_BUCKETS)}
+
+    def add(self, record):
+        self.requests += 1
+        self.errors += record['error'] is not None
+        self.retries += record['retries']
+        self.prompt_tokens += record['prompt_tokens']
+        self.completion_tokens += record['completion_tokens']
+        if record['cost'] is not None:
+            self.cost = (self.cost or 0) + record['cost']
+        for field, histogram in self.histograms.items():
+            histogram.add(record[field])
+
+    def to_json(self):
+        latency = self.histograms['latency']
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                # completion tokens per second of latency
+                'throughput': self.completion_tokens / latency.total if latency.total else None,
+                'cost': self.cost,
+                'histograms': {field: histogram.to_json() for field, histogram in self.histograms.items()}}
+
+
+class Telemetry:
+    def __init__(self, recent=RECENT_RECORDS):
+        self.lock = threading.Lock()
+        self.records = deque(maxlen=recent)
+        # {model: ModelMetrics}
+        self.models = {}
+
+    def record(self, record):
+        with self.lock:
+            self.records.append(record)
+            self.models.setdefault(record['model'], ModelMetrics()).add(record)
+
+    # {model: aggregated metrics}
+    def summary(self):
+        with self.lock:
+            return {model: metrics.to_json() for model, metrics in self.models.items()}
+
+    def recent(self):
+        with self.lock:
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.models = {}
+
+    # writes the recent records as CSV if path ends with .csv, else the summary and the records as JSON
+    def export(self, path):
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(self.recent())
+        else:
+            with open(path, 'w') as f:
+                json.dump({'models': self.summary(), 'records': self.recent()}, f, indent=2)
+
+
+# fields of a request waiting for a scheduler slot since submitted (a time.monotonic())
+def queued(submitted, priority):
+    return {'queue_wait': time.monotonic() - submitted, 'priority': PRIORITY_NAMES.get(priority, priority)}
+
+
+# metrics of a request that got its slot now; fields (e.g. queue_wait, priority) are recorded with it
+def start_request(model, model_type, prompts=1, **fields):
+    return dict(fields, model=model, type=model_type, prompts=prompts, started=time.monotonic(), sent=None,
+                ttfb=None, rate_wait=0.0, retries=0)
+
+
+# makes metrics the current metrics while the request is made
+@contextlib.contextmanager
+def track_request(metrics):
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+# called just before each attempt is sent
+def sending(metrics):
+    metrics['sent'] = time.monotonic()
+    metrics['ttfb'] = None
+
+
+# called when the current request's response starts arriving
+def first_byte():
+    metrics = _current.get()
+    if metrics is not None and metrics['sent'] is not None and metrics['ttfb'] is None:
+        metrics['ttfb'] = time.monotonic() - metrics['sent']
+
+
+# (prompt tokens, completion tokens) of prompts' response dicts, or of usage ({prompt_tokens, completion_tokens})
+def count_tokens(prompts, responses, usage=None):
+    if usage and 'prompt_tokens' in usage:
+        return usage['prompt_tokens'], usage.get('completion_tokens', 0)
+    prompt_tokens = completion_tokens = 0
+    for prompt, response in zip(prompts, responses):
+        if not response:
+            continue
+        tokens = response['prompt'].get('tokens')
+        # chat prompts come back as one token
+        prompt_tokens += len(tokens) if tokens is not None and len(tokens) > 1 else len(prompt) // 4
+        for completion in response['completions']:
+            tokens = completion.get('tokens')
+            completion_tokens += len(tokens) if tokens is not None else len(completion['text']) // 4
+    return prompt_tokens, completion_tokens
+
+
+# the record of a finished request, without its timestamp; token_price is per 1000 tokens
+def finish_request(metrics, prompts, responses, error=None, usage=None, token_price=None):
+    prompt_tokens, completion_tokens = count_tokens(prompts, responses, usage) if not error else (0, 0)
+    record = {field: metrics.get(field) for field in FIELDS}
+    record.update(latency=time.monotonic() - metrics['started'],
+                  prompt_tokens=prompt_tokens,
+                  completion_tokens=completion_tokens,
+                  error=f'{type(error).__name__}: {error}' if error else None,
+                  cost=(prompt_tokens + completion_tokens) * token_price / 1000 if token_price else None)
+    return record
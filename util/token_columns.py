@@ -0,0 +1,157 @@
+from collections.abc import Sequence
+
+import numpy as np
+
+# Columnar token data
+#
+# A response's prompt and completions each have a list of tokens, and most of them are never looked at.
+# TokenColumns keeps them as parallel columns (token strings, start and end offsets and logprobs as NumPy
+# arrays, and the provider's top logprobs as they came) and behaves like the list of token dicts
+# (see gpt.py) it replaces: indexing or iterating builds each token's dict only when it's asked for.
+#
+# Saved trees store the columns (to_json); restore_columns turns them back into TokenColumns on load.
+
+COLUMNS_KEY = 'token_columns'
+
+
+class TokenColumns(Sequence):
+    # top_logprobs[i] is the provider's top logprobs for token i (or None), turned into a {token: logprob} dict by
+    # counterfactuals if given
+    def __init__(self, tokens, starts, logprobs, top_logprobs=None, ends=None, counterfactuals=None):
+        self.tokens = list(tokens)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        # None (the first prompt token) is nan
+        self.logprobs = np.asarray(logprobs, dtype=np.float64)
+        if ends is None:
+            self.ends = self.starts + np.fromiter((len(token) for token in self.tokens), dtype=np.int64,
+                                                  count=len(self.tokens))
+        else:
+            self.ends = np.asarray(ends, dtype=np.int64)
+        self.top_logprobs = top_logprobs
+        self.convert = counterfactuals
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.token_dict(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+        return self.token_dict(index)
+
+    # equal if they hold the same tokens; nan logprobs (the first prompt token's) are equal to each other
+    def __eq__(self, other):
+        if not isinstance(other, TokenColumns):
+            return NotImplemented
+        return self.tokens == other.tokens \
+            and np.array_equal(self.starts, other.starts) \
+            and np.array_equal(self.ends, other.ends) \
+            and np.array_equal(self.logprobs, other.logprobs, equal_nan=True) \
+            and self.top_dicts() == other.top_dicts()
+
+    __hash__ = None
+
+    def logprob(self, index):
+        logprob = self.logprobs[index]
+        return None if np.isnan(logprob) else float(logprob)
+
+    # {token: logprob}, most likely first, or None
+    def counterfactuals(self, index):
+        if not self.top_logprobs or not self.top_logprobs[index]:
+            return None
+        top = self.top_logprobs[index]
+        if self.convert:
+            top = self.convert(top)
+        return dict(sorted(top.items(), key=lambda item: item[1], reverse=True))
+
+    def token_dict(self, index):
+        return {'generatedToken': {'token': self.tokens[index], 'logprob': self.logprob(index)},
+                'position': {'start': int(self.starts[index]), 'end': int(self.ends[index])},
+                'counterfactuals': self.counterfactuals(index)}
+
+    def to_json(self):
+        top_logprobs = self.top_dicts() if self.top_logprobs else None
+        return {COLUMNS_KEY: True,
+                'tokens': self.tokens,
+                'starts': self.starts.tolist(),
+                'ends': self.ends.tolist(),
+                'logprobs': [None if np.isnan(logprob) else logprob for logprob in self.logprobs.tolist()],
+                'top_logprobs': top_logprobs}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['tokens'], data['starts'], data['logprobs'], data.get('top_logprobs'), data.get('ends'))
+
+    # tokens start:end as TokenColumns
+    def take(self, start=0, end=None):
+        return TokenColumns(self.tokens[start:end], self.starts[start:end], self.logprobs[start:end],
+                            self.top_logprobs[start:end] if self.top_logprobs else None, self.ends[start:end],
+                            self.convert)
+
+    # top logprobs as {token: logprob} dicts (or None), not sorted
+    def top_dicts(self):
+        if not self.top_logprobs:
+            return [None] * len(self)
+        return [self.convert(top) if self.convert and top else top for top in self.top_logprobs]
+
+
+# start offsets of tokens (TokenColumns or a list of token dicts), without building token dicts
+def token_starts(tokens):
+    if isinstance(tokens, TokenColumns):
+        return tokens.starts.tolist()
+    return [token_data['position']['start'] for token_data in tokens]
+
+
+# tokens (TokenColumns or a list of token dicts) as TokenColumns
+def as_columns(tokens):
+    if isinstance(tokens, TokenColumns):
+        return tokens
+    return TokenColumns([token_data['generatedToken']['token'] for token_data in tokens],
+                        [token_data['position']['start'] for token_data in tokens],
+                        [token_data['generatedToken']['logprob'] for token_data in tokens],
+                        [token_data.get('counterfactuals') for token_data in tokens],
+                        [token_data['position']['end'] for token_data in tokens])
+
+
+# token sequences, in order, as one TokenColumns
+def concat_columns(parts):
+    parts = [as_columns(part) for part in parts]
+    top_logprobs = None
+    if any(part.top_logprobs for part in parts):
+        top_logprobs = [top for part in parts for top in part.top_dicts()]
+    return TokenColumns([token for part in parts for token in part.tokens],
+                        np.concatenate([part.starts for part in parts]) if parts else [],
+                        np.concatenate([part.logprobs for part in parts]) if parts else [],
+                        top_logprobs,
+                        np.concatenate([part.ends for part in parts]) if parts else [])
+
+
+# json.dump default: TokenColumns as their columns
+def json_default(obj):
+    if isinstance(obj, TokenColumns):
+        return obj.to_json()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+# json.dumps default for hashing: like json_default, but anything else is hashed as its str
+def hash_default(obj):
+    return obj.to_json() if isinstance(obj, TokenColumns) else str(obj)
+
+
+def is_columns(tokens):
+    return isinstance(tokens, dict) and tokens.get(COLUMNS_KEY)
+
+
+# replaces saved columns in {response id: response} with TokenColumns, in place
+def restore_columns(responses):
+    for response in responses.values():
+        prompt = response.get('prompt')
+        if prompt and is_columns(prompt.get('tokens')):
+            prompt['tokens'] = TokenColumns.from_json(prompt['tokens'])
+        for completion in response.get('completions', []):
+            if is_columns(completion.get('tokens')):
+                completion['tokens'] = TokenColumns.from_json(completion['tokens'])
+    return responses
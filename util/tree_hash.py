@@ -0,0 +1,99 @@
+import hashlib
+import json
+from util.util_tree import walk_subtree
+
+# Merkle hashes of trees
+#
+# A node's content hash covers everything except its children and session state. Its subtree hash combines
+# the content hash with the subtree hashes of its children, in order, so two subtrees with equal subtree
+# hashes are identical. Subtree hashes are cached on the nodes as node['subtree_hash'] while the tree is open
+# (they aren't written out, see without_hashes); an edit must invalidate the hashes along the edited node's ancestry.
+
+HASH_ATTRIBUTE = 'subtree_hash'
+# not part of a node's content
+HASH_EXCLUDED = ('children', 'parent_id', 'open', 'visited', HASH_ATTRIBUTE)
+
+
+def digest(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode('utf-8'))
+    return h.hexdigest()
+
+
+def content_hash(node):
+    content = {k: v for k, v in node.items() if k not in HASH_EXCLUDED}
+    return digest(json.dumps(content, sort_keys=True, default=str))
+
+
+# The node itself may be new (never hashed) under a hashed parent. Above it, a hashed node's descendants are
+# all hashed, so invalidation can stop at the first ancestor without a hash
+def invalidate(node, node_dict):
+    node.pop(HASH_ATTRIBUTE, None)
+    parent = node_dict.get(node['parent_id']) if 'parent_id' in node else None
+    while parent is not None and parent.pop(HASH_ATTRIBUTE, None) is not None:
+        parent = node_dict.get(parent['parent_id']) if 'parent_id' in parent else None
+
+
+def clear_hashes(root):
+    for node, _ in walk_subtree(root):
+        node.pop(HASH_ATTRIBUTE, None)
+
+
+# copy of the tree under root for writing out, without cached hashes (each node is copied shallowly)
+def without_hashes(root):
+    copy = {k: v for k, v in root.items() if k != HASH_ATTRIBUTE}
+    stack = [copy]
+    while stack:
+        node = stack.pop()
+        if 'children' in node:
+            node['children'] = [{k: v for k, v in child.items() if k != HASH_ATTRIBUTE} for child in node['children']]
+            stack.extend(node['children'])
+    return copy
+
+
+# subtree hash of root, only recomputing subtrees whose cached hash was invalidated
+# iterative postorder so deep trees don't hit the recursion limit
+def subtree_hash(root):
+    if HASH_ATTRIBUTE in root:
+        return root[HASH_ATTRIBUTE]
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if HASH_ATTRIBUTE in node:
+            continue
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node['children'] if HASH_ATTRIBUTE not in child)
+        else:
+            node[HASH_ATTRIBUTE] = digest(content_hash(node), *(child[HASH_ATTRIBUTE] for child in node['children']))
+    return root[HASH_ATTRIBUTE]
+
+
+# Finds the differences between two trees, descending only into subtrees whose hashes differ
+# Children are matched by id. Returns [{'id', 'change'}], change being
+#   'changed': node content differs (its subtree is still compared)
+#   'added': subtree only in tree b
+#   'removed': subtree only in tree a
+def tree_diff(root_a, root_b):
+    changes = []
+    if root_a['id'] != root_b['id']:
+        return [{'id': root_a['id'], 'change': 'removed'}, {'id': root_b['id'], 'change': 'added'}]
+    stack = [(root_a, root_b)]
+    while stack:
+        a, b = stack.pop()
+        if subtree_hash(a) == subtree_hash(b):
+            continue
+        if content_hash(a) != content_hash(b):
+            changes.append({'id': a['id'], 'change': 'changed'})
+        children_a = {child['id']: child for child in a['children']}
+        children_b = {child['id']: child for child in b['children']}
+        for child_id in children_a:
+            if child_id not in children_b:
+                changes.append({'id': child_id, 'change': 'removed'})
+        for child_id, child_b in children_b.items():
+            if child_id not in children_a:
+                changes.append({'id': child_id, 'change': 'added'})
+            else:
+                stack.append((children_a[child_id], child_b))
+    return changes
@@ -15,6 +15,7 @@ import operator
 from pprint import pprint
 from random import shuffle
 from util.gpt_util import tokenize_ada
+from util.token_columns import json_default
 import difflib
 import re
 
@@ -299,7 +300,7 @@ def json_open(filename):
 def json_create(filename, data=None):
     data = data if data else []
     with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
+        json.dump(data, f, indent=4, default=json_default)
 
 
 def json_append_dict(filename, data_dict):
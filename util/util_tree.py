@@ -55,6 +55,24 @@ def subtree_list(root, filter=None, depth_limit=None):
     return sub_list
 
 
+# Iterative preorder walk of the subtree under root, yields (node, depth) for depths < depth_limit (like subtree_list)
+# Children that fail filter are skipped along with their subtrees
+# Holds one child iterator per level, so memory is O(depth) rather than O(subtree)
+def walk_subtree(root, filter=None, depth_limit=None):
+    if depth_limit == 0:
+        return
+    yield root, 0
+    stack = [iter(filtered_children(root, filter))] if depth_limit is None or depth_limit > 1 else []
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        yield child, len(stack)
+        if depth_limit is None or len(stack) + 1 < depth_limit:
+            stack.append(iter(filtered_children(child, filter)))
+
+
 def depth_limited_tree(root, depth_limit):
     new_root = {'id': root['id'], 'children': []}
     if depth_limit == 0:
@@ -317,6 +335,33 @@ def flatten_tree(d, reverse=False):
     return [d, *flat_children]
 
 
+# Like flatten_tree, but for a subtree being brought into an existing tree: ids that are missing, already in
+# taken or repeated within the subtree are replaced with new ones. Old -> new ids are recorded in id_map.
+# Masked heads of compound nodes are remapped too but not included in the returned list.
+# Iterative, so only the incoming subtree is visited
+def remap_subtree_ids(root, taken, id_map=None):
+    id_map = {} if id_map is None else id_map
+    seen = set()
+    flat = []
+    for node, _ in walk_subtree(root):
+        if 'children' not in node:
+            node['children'] = []
+        node.pop('parentId', None)
+        old_id = node.get('id', None)
+        if old_id is None or old_id in taken or old_id in seen:
+            node['id'] = str(uuid.uuid1())
+            if old_id is not None:
+                id_map[old_id] = node['id']
+        seen.add(node['id'])
+        for child in node['children']:
+            child['parent_id'] = node['id']
+        if 'masked_head' in node:
+            remap_subtree_ids(node['masked_head'], taken, id_map)
+            node['tail_id'] = id_map.get(node.get('tail_id'), node.get('tail_id'))
+        flat.append(node)
+    return flat, id_map
+
+
 def flatten_tree_revisit_parents(d, parent=None):
     if "id" not in d:
         d["id"] = str(uuid.uuid1())
@@ -32,6 +32,7 @@ modules = {'edit': Edit,
            'read children': ReadChildren,
            'run': Run,
            'debug': DebugConsole,
+           'generation metrics': GenerationMetrics,
            'input': Input,
            'janus/playground': JanusPlayground,
            'transformers': Transformers,